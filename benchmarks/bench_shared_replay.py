@@ -0,0 +1,88 @@
+"""
+Write and sample throughput of the shared-memory replay buffer with 1-16 writer processes.
+
+Each writer puts pre-generated 81-agent transitions into its own shard for a fixed time while the
+learner process samples chunks concurrently. Reports the total write rate and the learner's sample rate.
+Scaling is bounded by the number of CPU cores: with fewer cores than writers + 1, processes time-share.
+
+    python benchmarks/bench_shared_replay.py --writers 1 2 4 8 16 --seconds 10
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.replay.shared import SERIAL, SharedReplayBuffer
+
+OBS_SHAPE = (13, 13, 5)
+
+
+def write(buffer, writer, ready, stop):
+    rng = np.random.default_rng(writer)
+    frames = (rng.random((8, buffer.num_agents, *OBS_SHAPE)) < 0.1).astype(np.float32)
+    actions = rng.integers(0, 21, buffer.num_agents)
+    rewards = rng.standard_normal(buffer.num_agents).astype(np.float32)
+    dones = np.zeros(buffer.num_agents, dtype=bool)
+    shard = buffer.writer(writer)
+    parent = os.getppid()
+    ready.wait(timeout=600)
+    step = 0
+    # Also stop if the learner process died without setting the event
+    while not stop.is_set() and os.getppid() == parent:
+        shard.put((frames[step % 8], actions, rewards, frames[(step + 1) % 8], dones))
+        step += 1
+        if step % 200 == 0:
+            shard.end_episode()
+
+
+def run(num_writers, args):
+    buffer = SharedReplayBuffer(args.buffer_limit, args.n_agents, OBS_SHAPE, num_writers=num_writers)
+    ctx = mp.get_context('spawn')
+    # Writers start together once all of them have started up, so process startup is not timed
+    ready, stop = ctx.Barrier(num_writers + 1), ctx.Event()
+    writers = [ctx.Process(target=write, daemon=True, args=(buffer, k, ready, stop)) for k in range(num_writers)]
+    try:
+        for process in writers:
+            process.start()
+        ready.wait(timeout=600)
+        while buffer.size() < args.chunk_size * num_writers + 1:
+            time.sleep(0.01)
+
+        written_before = int(buffer.cursors[:, SERIAL].sum())
+        began = time.time()
+        sampled = 0
+        while time.time() - began < args.seconds:
+            buffer.sample_chunk_arrays(args.batch_size, args.chunk_size)
+            sampled += args.batch_size * args.chunk_size
+        elapsed = time.time() - began
+        written = int(buffer.cursors[:, SERIAL].sum()) - written_before
+    finally:
+        stop.set()
+        for process in writers:
+            process.join()
+        buffer.close()
+    return written / elapsed, sampled / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the shared-memory replay buffer')
+    parser.add_argument('--writers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--buffer_limit', type=int, default=100000)
+    parser.add_argument('--n_agents', type=int, default=81)
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--chunk_size', type=int, default=1)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    print(f'cpu_count={os.cpu_count()}', flush=True)
+    for num_writers in args.writers:
+        write_rate, sample_rate = run(num_writers, args)
+        print(f'writers={num_writers:>2} write={write_rate:9.0f} transitions/s sample={sample_rate:9.0f} samples/s', flush=True)
+
+
+if __name__ == '__main__':
+    main()
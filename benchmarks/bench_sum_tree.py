@@ -0,0 +1,46 @@
+"""
+Microbenchmark of the sum tree behind the DQN prioritized replay buffer.
+
+Measures batched prefix-sum sampling and batched priority updates on a full tree.
+
+    python benchmarks/bench_sum_tree.py --capacity 1000000 --batch_size 512
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.replay.sum_tree import SumTree
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SumTree sampling and priority updates')
+    parser.add_argument('--capacity', type=int, default=1000000)
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument('--iters', type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    tree = SumTree(args.capacity)
+    tree.update(np.arange(args.capacity), rng.random(args.capacity))
+
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        indices, _ = tree.sample(args.batch_size)
+    sample_ms = 1000 * (time.perf_counter() - start) / args.iters
+
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        tree.update(rng.integers(0, args.capacity, args.batch_size), rng.random(args.batch_size))
+    update_ms = 1000 * (time.perf_counter() - start) / args.iters
+
+    print(f'capacity={args.capacity} batch_size={args.batch_size}')
+    print(f'sample: {sample_ms:.3f} ms/batch')
+    print(f'update: {update_ms:.3f} ms/batch')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Microbenchmark of the vectorized TD target builders of src.td_targets against per-timestep Python loops.
+
+Checks that both give the same targets, then times TD(0), n-step and TD(lambda) targets, with and without
+terminal masking, on [batch_size, seq_len, num_agents] rewards (QMIX / RNN episodes are 300 steps long).
+
+    python benchmarks/bench_td_targets.py --batch_size 2 32 --seq_len 300 --num_agents 1
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.td_targets import lambda_returns, n_step_targets, td0_targets
+
+
+def loop_td0(rewards, next_values, continues, gamma):
+    ret = torch.zeros_like(rewards)
+    for t in range(rewards.shape[1]):
+        ret[:, t] = rewards[:, t] + gamma * continues[:, t, None] * next_values[:, t]
+    return ret
+
+
+def loop_n_step(rewards, next_values, continues, gamma, n):
+    length = rewards.shape[1]
+    ret = torch.zeros_like(rewards)
+    for t in range(length):
+        discount = torch.ones_like(continues[:, t, None])
+        for k in range(t, min(t + n, length)):
+            ret[:, t] += discount * rewards[:, k]
+            discount = discount * gamma * continues[:, k, None]
+        ret[:, t] += discount * next_values[:, min(t + n, length) - 1]
+    return ret
+
+
+def loop_lambda(rewards, next_values, continues, gamma, td_lambda):
+    ret = torch.zeros_like(rewards)
+    ret[:, -1] = rewards[:, -1] + gamma * continues[:, -1, None] * next_values[:, -1]
+    for t in range(rewards.shape[1] - 2, -1, -1):
+        ret[:, t] = rewards[:, t] + gamma * continues[:, t, None] * (
+            (1 - td_lambda) * next_values[:, t] + td_lambda * ret[:, t + 1])
+    return ret
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vectorized TD targets against loops')
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[2, 32])
+    parser.add_argument('--seq_len', type=int, default=300)
+    parser.add_argument('--num_agents', type=int, default=1)
+    parser.add_argument('--n_steps', type=int, default=5)
+    parser.add_argument('--gamma', type=float, default=0.99)
+    parser.add_argument('--td_lambda', type=float, default=0.6)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    gamma = args.gamma
+
+    for batch_size in args.batch_size:
+        shape = (batch_size, args.seq_len, args.num_agents)
+        rewards = torch.randn(shape, device=device)
+        next_values = torch.randn(shape, device=device)
+        for masked in (False, True):
+            continues = torch.ones(batch_size, args.seq_len, device=device)
+            if masked:
+                # Episodes end at random steps, padded after
+                ends = torch.randint(1, args.seq_len, (batch_size, 1), device=device)
+                continues = (torch.arange(args.seq_len, device=device) < ends).float()
+            cases = (
+                ('td0', lambda: loop_td0(rewards, next_values, continues, gamma),
+                 lambda: td0_targets(rewards, next_values, continues, gamma)),
+                (f'{args.n_steps}-step', lambda: loop_n_step(rewards, next_values, continues, gamma, args.n_steps),
+                 lambda: n_step_targets(rewards, next_values, args.n_steps, continues, gamma)),
+                ('lambda', lambda: loop_lambda(rewards, next_values, continues, gamma, args.td_lambda),
+                 lambda: lambda_returns(rewards, next_values, args.td_lambda, continues, gamma)),
+            )
+            for name, loop_fn, vector_fn in cases:
+                error = (loop_fn() - vector_fn()).abs().max().item()
+                loop_time = timeit(loop_fn, args.iters, device)
+                vector_time = timeit(vector_fn, args.iters, device)
+                print(f'batch {batch_size:<4} {"masked" if masked else "full  "} {name:<7} '
+                      f'loop {loop_time * 1e3:8.3f} ms  vectorized {vector_time * 1e3:8.3f} ms  '
+                      f'speedup {loop_time / vector_time:6.1f}x  max error {error:.1e}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
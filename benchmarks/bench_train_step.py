@@ -0,0 +1,102 @@
+"""
+A/B benchmark of the training step engine (src/train_step.py) on the VDN and RNN learners.
+
+Times learner gradient steps per second on fixed synthetic batches for every combination of autocast
+precision, fused optimizer and torch.compile, against the fp32 eager baseline.
+
+    python benchmarks/bench_train_step.py --precision fp32 bf16 --batch_size 256 --chunk_size 4
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+import numpy as np
+import torch
+import torch.optim as optim
+from gymnasium.spaces import Box, Discrete
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'src', 'vdn'))
+sys.path.append(ROOT)
+
+from model import VdnQNet
+from train import make_train_step
+from src.cnn import CNNFeatureExtractor
+from src.rnn_agent.rnn_agent import RNN_Trainer, ReplayBufferGRU
+from src.train_step import make_optimizer
+
+N_AGENTS, OBS_SHAPE, N_ACTIONS = 81, (13, 13, 5), 21
+
+
+def vdn_case(args, precision, fused, compile):
+    agents = [f'blue_{i}' for i in range(N_AGENTS)]
+    observation_spaces = {agent: Box(0, 1, OBS_SHAPE) for agent in agents}
+    action_spaces = {agent: Discrete(N_ACTIONS) for agent in agents}
+    torch.manual_seed(0)
+    q = VdnQNet(agents, observation_spaces, action_spaces, recurrent=True)
+    q_target = VdnQNet(agents, observation_spaces, action_spaces, recurrent=True)
+    q_target.load_state_dict(q.state_dict())
+    q.train()
+    q_target.eval()
+    optimizer = make_optimizer(optim.Adam, q.parameters(), fused=fused, lr=1e-3)
+    engine = make_train_step(q, q_target, optimizer, 0.99, precision, compile)
+
+    shape = (args.batch_size, args.chunk_size, N_AGENTS)
+    frames = (torch.rand(args.batch_size, args.chunk_size + 1, N_AGENTS, *OBS_SHAPE) < 0.2).float()
+    batch = (frames[:, :-1], torch.randint(0, N_ACTIONS, shape).float(), torch.randn(shape),
+             frames[:, 1:], (torch.rand(shape) < 0.01).float())
+    return lambda: engine(*batch)
+
+
+def rnn_case(args, precision, fused, compile):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    buffer = ReplayBufferGRU(args.batch_size)
+    length = args.chunk_size * 8
+    for _ in range(args.batch_size):
+        frames = (np.random.rand(length + 1, N_AGENTS, *OBS_SHAPE) < 0.2).astype(np.float32)
+        hidden = torch.zeros(1, 1, N_AGENTS, 64)
+        buffer.push(hidden, hidden, frames[:-1], np.random.randint(0, N_ACTIONS, (length, N_AGENTS, 1)),
+                    np.random.randn(length, N_AGENTS).astype(np.float32), frames[1:])
+    obs_dim = CNNFeatureExtractor().get_output_dim(OBS_SHAPE[:2])
+    trainer = RNN_Trainer(buffer, n_agents=N_AGENTS, obs_dim=obs_dim,
+                          precision=precision, compile=compile, fused_optim=fused)
+    batch = trainer._prepare_batch(min(args.batch_size, 4))
+    return lambda: trainer._gradient_step(batch)
+
+
+def timeit(step, iters):
+    step()  # warm-up, includes compilation
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    return iters / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark learner training steps per second')
+    parser.add_argument('--learners', nargs='+', choices=('vdn', 'rnn'), default=['vdn', 'rnn'])
+    parser.add_argument('--precision', nargs='+', default=['fp32', 'bf16'])
+    parser.add_argument('--fused', nargs='+', type=int, default=[0, 1])
+    parser.add_argument('--compile', nargs='+', type=int, default=[0, 1])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--chunk_size', type=int, default=4, help='VDN chunk length, RNN episodes are 8 chunks long')
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    cases = {'vdn': vdn_case, 'rnn': rnn_case}
+    for learner in args.learners:
+        baseline = None
+        for precision, fused, compile in itertools.product(args.precision, args.fused, args.compile):
+            rate = timeit(cases[learner](args, precision, bool(fused), bool(compile)), args.iters)
+            baseline = baseline or rate
+            print(f'{learner:<4} {precision:<5} fused={fused} compile={compile}  '
+                  f'{rate:7.2f} steps/s  {rate / baseline:5.2f}x', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Collection throughput of the vectorized VDN rollout against the single-environment path.
+
+Collects the same number of episodes with run_episode (one battle environment, one sample_action call
+per team and step) and with run_episodes over K environments stepped together (one batched
+sample_action call per team and step), writing into a replay buffer, and reports env steps per second.
+
+    python benchmarks/bench_vector_rollout.py --num_envs 1 4 8 --episodes 8
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+from magent2.environments import battle_v4
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'vdn'))
+
+from buffer import ReplayBuffer
+from model import VdnQNet
+from team import TeamManager
+from train import run_episode, run_episodes
+from utils import device
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vectorized VDN episode collection')
+    parser.add_argument('--num_envs', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--episodes', type=int, default=8, help='episodes collected per measurement')
+    parser.add_argument('--map_size', type=int, default=45)
+    parser.add_argument('--max_cycles', type=int, default=300)
+    parser.add_argument('--epsilon', type=float, default=0.1)
+    args = parser.parse_args()
+
+    def make_env():
+        return battle_v4.parallel_env(map_size=args.map_size, max_cycles=args.max_cycles)
+
+    env = make_env()
+    env.reset(seed=0)
+    team_manager = TeamManager(env.agents)
+    q = VdnQNet(team_manager.get_my_agents(), env.observation_spaces, env.action_spaces).to(device).eval()
+    opponent_q = VdnQNet(team_manager.get_other_agents(), env.observation_spaces, env.action_spaces).to(device).eval()
+    memory = ReplayBuffer(100000)
+
+    with torch.no_grad():
+        began, steps = time.time(), memory.steps
+        for _ in range(args.episodes):
+            run_episode(env, q, opponent_q, memory, epsilon=args.epsilon)
+        rate = (memory.steps - steps) / (time.time() - began)
+        print(f'run_episode            {rate:8.1f} env steps/s', flush=True)
+
+        for num_envs in args.num_envs:
+            envs = [make_env() for _ in range(num_envs)]
+            began, steps = time.time(), memory.steps
+            for _ in range(-(-args.episodes // num_envs)):
+                run_episodes(envs, q, opponent_q, memory, epsilon=args.epsilon)
+            rate = (memory.steps - steps) / (time.time() - began)
+            print(f'run_episodes K={num_envs:<4}  {rate:8.1f} env steps/s', flush=True)
+            for vector_env in envs:
+                vector_env.close()
+    env.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Concurrency stress test of the shared-memory replay buffer.
+
+Writer processes fill their shards with self-describing transitions while the learner process keeps
+sampling chunks. Every frame encodes (step, writer, episode) in its HP planes and every transition
+repeats them in its rewards, so the learner can check that each sampled transition is internally
+consistent and that its next state is the next frame of the same episode. A small buffer makes the
+writers lap the readers constantly, which exercises the seqlock and stamp checks.
+
+    python benchmarks/stress_shared_replay.py --writers 4 --seconds 20
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.replay.codec import MY_HP, OTHER_HP
+from src.replay.shared import SERIAL, SharedReplayBuffer
+
+OBS_SHAPE = (13, 13, 5)
+
+
+def make_frame(num_agents, step, writer, episode):
+    frame = np.zeros((num_agents, *OBS_SHAPE), dtype=np.float32)
+    frame[:, 0, 0, MY_HP] = (step % 100) / 100
+    frame[:, 0, 0, OTHER_HP] = writer / 100
+    frame[:, 0, 1, OTHER_HP] = (episode % 100) / 100
+    return frame
+
+
+def read_frame(frame):
+    """Decode (step % 100, writer, episode % 100) from frames [..., n_agents, H, W, C] of agent 0"""
+    return (np.rint(frame[..., 0, 0, 0, MY_HP] * 100).astype(np.int64),
+            np.rint(frame[..., 0, 0, 0, OTHER_HP] * 100).astype(np.int64),
+            np.rint(frame[..., 0, 0, 1, OTHER_HP] * 100).astype(np.int64))
+
+
+def write(buffer, writer, stop, seed):
+    rng = np.random.default_rng(seed)
+    shard = buffer.writer(writer)
+    parent = os.getppid()
+    episode = 0
+    # Also stop if the learner process died without setting the event
+    while not stop.is_set() and os.getppid() == parent:
+        length = int(rng.integers(1, 40))
+        for step in range(length):
+            reward = np.zeros(buffer.num_agents, dtype=np.float32)
+            reward[:4] = step, writer, episode, length
+            shard.put((make_frame(buffer.num_agents, step, writer, episode), step % 21, reward,
+                       make_frame(buffer.num_agents, step + 1, writer, episode),
+                       np.full(buffer.num_agents, step == length - 1)))
+        shard.end_episode()
+        episode += 1
+
+
+def check(frames, actions, rewards, dones):
+    """Return the number of inconsistent transitions in a sampled batch"""
+    step, writer, episode = read_frame(frames)
+    next_step, next_writer, next_episode = step[:, 1:], writer[:, 1:], episode[:, 1:]
+    step, writer, episode = step[:, :-1], writer[:, :-1], episode[:, :-1]
+    boundary = dones.all(axis=-1) & (rewards == 0).all(axis=-1) & (actions == 0).all(axis=-1)
+
+    r_step, r_writer, r_episode, r_length = (rewards[..., k].astype(np.int64) for k in range(4))
+    ok = (step == r_step % 100) & (writer == r_writer) & (episode == r_episode % 100)
+    ok &= actions[..., 0] == r_step % 21
+    ok &= dones[..., 0] == (r_step == r_length - 1)
+    ok &= (next_step == (r_step + 1) % 100) & (next_writer == writer) & (next_episode == episode)
+    # A boundary slot only carries the last next state of its episode, the slot after it starts a new one
+    return int((~(ok | boundary)).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress test the shared-memory replay buffer')
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--buffer_limit', type=int, default=256)
+    parser.add_argument('--n_agents', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--chunk_size', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=20)
+    args = parser.parse_args()
+
+    buffer = SharedReplayBuffer(args.buffer_limit, args.n_agents, OBS_SHAPE, num_writers=args.writers)
+    ctx = mp.get_context('spawn')
+    stop = ctx.Event()
+    writers = [ctx.Process(target=write, daemon=True, args=(buffer, k, stop, k)) for k in range(args.writers)]
+    try:
+        for process in writers:
+            process.start()
+        while buffer.size() < args.chunk_size * args.writers + 1:
+            time.sleep(0.01)
+
+        checked, errors, batches = 0, 0, 0
+        deadline = time.time() + args.seconds
+        while time.time() < deadline:
+            batch = buffer.sample_chunk_arrays(args.batch_size, args.chunk_size)
+            errors += check(*batch)
+            checked += args.batch_size * args.chunk_size
+            batches += 1
+    finally:
+        stop.set()
+        for process in writers:
+            process.join()
+        written = int(buffer.cursors[:, SERIAL].sum())
+        buffer.close()
+
+    print(f'writers={args.writers} written={written} sampled_batches={batches} '
+          f'checked={checked} inconsistent={errors}')
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
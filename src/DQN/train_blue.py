@@ -3,13 +3,20 @@ import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 from dataclasses import dataclass
-from collections import deque
 from typing import Dict, Tuple, Optional
 from pathlib import Path
 import logging
+import time
 from magent2.environments import battle_v4
 from torch_model import QNetwork
-from torch.utils.data import Dataset, DataLoader
+
+import sys
+import os
+# Thêm thư mục gốc của project vào PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from src.replay.codec import PackedObsArray
+from src.replay.sum_tree import SumTree
 
 @dataclass
 class Config:
@@ -18,6 +25,7 @@ class Config:
     gamma: float = 0.99
     target_update_freq: int = 1000
     train_freq: int = 4
+    gradient_steps: int = 20  # minibatches per optimize_model call, ~one pass over a full buffer
     epsilon_start: float = 1.0
     epsilon_end: float = 0.1
     epsilon_decay: float = 0.995
@@ -27,28 +35,129 @@ class Config:
     checkpoint_freq: int = 100
     map_size: int = 45
     max_cycles: int = 300
+    prioritized: bool = False  # prioritized experience replay
+    per_alpha: float = 0.6
+    per_beta_start: float = 0.4
+    per_beta_steps: int = 100000  # gradient steps to anneal beta to 1
+    per_eps: float = 1e-6
 
-class ReplayBuffer(Dataset):
-    """Experience replay buffer implementation"""
-    def __init__(self, capacity: int):
+class ReplayBuffer:
+    """Experience replay buffer implementation
+
+    Each observation is stored once. Transitions of the same agent are linked by index, so the next
+    state of a transition is the state of the agent's following transition. Until that transition
+    arrives the next state passed to add() is kept aside; when the episode ends, transitions that
+    were never followed (dead or truncated agents) become terminal with a zero next state.
+    """
+    def __init__(self, capacity: int, compact_obs: bool = True):
         self.capacity = capacity
-        self.buffer = deque(maxlen=capacity)
-    
-    def add(self, state, action, reward, next_state, done):
-        self.buffer.append((state, action, reward, next_state, done))
-    
-    def __len__(self):
-        return len(self.buffer)
-    
-    def __getitem__(self, idx):
-        state, action, reward, next_state, done = self.buffer[idx]
+        self.compact_obs = compact_obs
+        self.position = 0
+        self.count = 0
+        self.total = 0  # number of transitions ever added
+        self.last_slot: Dict[Optional[str], Tuple[int, int]] = {}  # agent -> (slot, serial) of its latest transition
+        self.pending: Dict[int, np.ndarray] = {}  # slot -> next_state passed to add(), until linked
+        # Storage is allocated on the first add, when the observation shape is known
+        self.states = None
+
+    def _allocate(self, obs_shape: Tuple[int, ...]):
+        self.obs_shape = obs_shape
+        if self.compact_obs:
+            self.states = PackedObsArray((self.capacity,), obs_shape)
+        else:
+            self.states = np.zeros((self.capacity, *obs_shape), dtype=np.float32)
+        self.actions = np.zeros(self.capacity, dtype=np.int64)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.dones = np.zeros(self.capacity, dtype=np.float32)
+        self.next_index = np.full(self.capacity, -1, dtype=np.int64)  # slot of the next state, -1 if not linked
+        self.serial = np.zeros(self.capacity, dtype=np.int64)  # insertion number of the transition in each slot
+
+    def add(self, state, action, reward, next_state, done, agent: Optional[str] = None):
+        if self.states is None:
+            self._allocate(np.shape(state))
+        i = self.position
+        self.pending.pop(i, None)
+        self.total += 1
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.dones[i] = done
+        self.next_index[i] = -1
+        self.serial[i] = self.total
+        self.position = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+        # Link the agent's previous transition to this state, unless it has been overwritten meanwhile
+        prev = self.last_slot.pop(agent, None)
+        if prev is not None and self.serial[prev[0]] == prev[1]:
+            self.pending.pop(prev[0], None)
+            self.next_index[prev[0]] = i
+        if not done:
+            self.last_slot[agent] = (i, self.total)
+            self.pending[i] = next_state
+
+    def end_episode(self):
+        """Mark transitions that were never followed by another step of their agent as terminal"""
+        for slot, serial in self.last_slot.values():
+            if self.serial[slot] == serial:
+                self.pending.pop(slot, None)
+                self.dones[slot] = 1.0
+        self.last_slot.clear()
+
+    def _next_states(self, slots: np.ndarray) -> np.ndarray:
+        """Gather the next states of a batch of slots"""
+        next_slots = self.next_index[slots]
+        linked = next_slots >= 0
+        next_states = np.zeros((len(slots), *self.obs_shape), dtype=np.float32)
+        if linked.any():
+            next_states[linked] = self.states[next_slots[linked]]
+        for k in np.flatnonzero(~linked):
+            if slots[k] in self.pending:
+                next_states[k] = self.pending[slots[k]]
+        return next_states
+
+    def batch(self, slots: np.ndarray) -> Tuple[torch.Tensor, ...]:
+        """Collate the transitions stored in `slots` straight from the array storage"""
         return (
-            torch.FloatTensor(state).permute(2, 0, 1),
-            torch.LongTensor([action]),
-            torch.FloatTensor([reward]),
-            torch.FloatTensor(next_state).permute(2, 0, 1),
-            torch.FloatTensor([done])
+            torch.from_numpy(self.states[slots]).permute(0, 3, 1, 2),
+            torch.from_numpy(self.actions[slots]).unsqueeze(1),
+            torch.from_numpy(self.rewards[slots]).unsqueeze(1),
+            torch.from_numpy(self._next_states(slots)).permute(0, 3, 1, 2),
+            torch.from_numpy(self.dones[slots]).unsqueeze(1)
         )
+    
+    def sample(self, batch_size: int):
+        """Sample a uniform minibatch, returns (slots, batch tensors)"""
+        # Slots fill from 0, so the filled slots are always [0, count)
+        slots = np.random.randint(0, self.count, batch_size)
+        return slots, self.batch(slots)
+
+    def __len__(self):
+        return self.count
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Prioritized experience replay: transitions are sampled proportionally to priority^alpha
+    from a sum tree, new transitions get the current maximum priority"""
+    def __init__(self, capacity: int, alpha: float = 0.6, eps: float = 1e-6, compact_obs: bool = True):
+        super().__init__(capacity, compact_obs)
+        self.alpha = alpha
+        self.eps = eps
+        self.tree = SumTree(capacity)
+
+    def add(self, state, action, reward, next_state, done, agent: Optional[str] = None):
+        slot = self.position
+        super().add(state, action, reward, next_state, done, agent=agent)
+        self.tree.update([slot], [self.tree.max_priority])
+
+    def sample(self, batch_size: int, beta: float):
+        """Sample a minibatch, returns (slots, importance-sampling weights [batch, 1], batch tensors)"""
+        slots, probabilities = self.tree.sample(batch_size)
+        weights = (self.count * probabilities) ** (-beta)
+        weights = torch.from_numpy((weights / weights.max()).astype(np.float32)).unsqueeze(1)
+        return slots, weights, self.batch(slots)
+
+    def update_priorities(self, slots: np.ndarray, td_errors: np.ndarray):
+        self.tree.update(slots, (np.abs(td_errors) + self.eps) ** self.alpha)
 
 class DQNAgent:
     """DQN Agent implementation"""
@@ -74,9 +183,14 @@ class DQNAgent:
         self.target_network.eval()
         
         self.optimizer = optim.Adam(self.q_network.parameters(), lr=config.learning_rate)
-        self.replay_buffer = ReplayBuffer(config.buffer_capacity)
+        if config.prioritized:
+            self.replay_buffer = PrioritizedReplayBuffer(config.buffer_capacity, config.per_alpha, config.per_eps)
+        else:
+            self.replay_buffer = ReplayBuffer(config.buffer_capacity)
         self.epsilon = config.epsilon_start
         self.step_count = 0
+        self.gradient_steps = 0
+        self.optimize_time = 0.0  # seconds spent in optimize_model
 
     def select_action(self, state: np.ndarray) -> int:
         """Select action using epsilon-greedy policy"""
@@ -88,33 +202,48 @@ class DQNAgent:
             q_values = self.q_network(state_tensor)
         return q_values.argmax().item()
 
+    def _gradient_step(self, states, actions, rewards, next_states, dones, weights=None) -> torch.Tensor:
+        """Perform one optimizer step on a minibatch and return its TD errors"""
+        states = states.to(self.device)
+        actions = actions.to(self.device)
+        rewards = rewards.to(self.device)
+        next_states = next_states.to(self.device)
+        dones = dones.to(self.device)
+
+        q_values = self.q_network(states).gather(1, actions)
+        with torch.no_grad():
+            next_q_values = self.target_network(next_states).max(1)[0].unsqueeze(1)
+        target_q_values = rewards + self.config.gamma * next_q_values * (1 - dones)
+
+        if weights is None:
+            loss = F.mse_loss(q_values, target_q_values)
+        else:
+            # Importance-sampling weights correct the bias of prioritized sampling
+            loss = (weights.to(self.device) * (q_values - target_q_values).pow(2)).mean()
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        self.gradient_steps += 1
+        return (q_values - target_q_values).detach()
+
     def optimize_model(self):
-        """Perform one step of optimization"""
+        """Perform a fixed budget of config.gradient_steps minibatch updates"""
         if len(self.replay_buffer) < self.config.batch_size:
             return
-            
-        train_loader = DataLoader(
-            self.replay_buffer,
-            batch_size=self.config.batch_size,
-            shuffle=True
-        )
-        
-        for states, actions, rewards, next_states, dones in train_loader:
-            states = states.to(self.device)
-            actions = actions.to(self.device)
-            rewards = rewards.to(self.device)
-            next_states = next_states.to(self.device)
-            dones = dones.to(self.device)
-
-            q_values = self.q_network(states).gather(1, actions)
-            with torch.no_grad():
-                next_q_values = self.target_network(next_states).max(1)[0].unsqueeze(1)
-            target_q_values = rewards + self.config.gamma * next_q_values * (1 - dones)
 
-            loss = F.mse_loss(q_values, target_q_values)
-            self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+        start = time.time()
+        for _ in range(self.config.gradient_steps):
+            if self.config.prioritized:
+                # Priorities are updated from each batch's TD errors
+                beta = min(1.0, self.config.per_beta_start +
+                           (1.0 - self.config.per_beta_start) * self.gradient_steps / self.config.per_beta_steps)
+                slots, weights, batch = self.replay_buffer.sample(self.config.batch_size, beta)
+                td_errors = self._gradient_step(*batch, weights=weights)
+                self.replay_buffer.update_priorities(slots, td_errors.squeeze(1).cpu().numpy())
+            else:
+                _, batch = self.replay_buffer.sample(self.config.batch_size)
+                self._gradient_step(*batch)
+        self.optimize_time += time.time() - start
 
     def train(self):
         """Main training loop"""
@@ -124,6 +253,8 @@ class DQNAgent:
         for episode in range(self.config.num_episodes):
             self.env.reset()
             total_reward = 0
+            episode_start = time.time()
+            start_steps, start_gradient_steps, start_optimize_time = self.step_count, self.gradient_steps, self.optimize_time
             done = {agent: False for agent in self.env.agents}
 
             while not all(done.values()):
@@ -138,7 +269,7 @@ class DQNAgent:
                         if agent_team == "blue":
                             action = self.select_action(obs)
                             next_obs = self.env.observe(agent)
-                            self.replay_buffer.add(obs, action, reward, next_obs, termination or truncation)
+                            self.replay_buffer.add(obs, action, reward, next_obs, termination or truncation, agent=agent)
                             self.step_count += 1
                             total_reward += reward
                         else:
@@ -149,13 +280,20 @@ class DQNAgent:
                 if self.step_count % self.config.train_freq == 0:
                     self.optimize_model()
 
+            self.replay_buffer.end_episode()
+
             self.epsilon = max(self.config.epsilon_end, self.epsilon * self.config.epsilon_decay)
 
             if self.step_count % self.config.target_update_freq == 0:
                 self.target_network.load_state_dict(self.q_network.state_dict())
 
+            # Env steps/s over the whole episode, gradient steps/s over the time spent optimizing
+            env_steps_per_sec = (self.step_count - start_steps) / (time.time() - episode_start)
+            optimize_time = self.optimize_time - start_optimize_time
+            grad_steps_per_sec = (self.gradient_steps - start_gradient_steps) / optimize_time if optimize_time > 0 else 0.0
             print(f"Episode {episode + 1}/{self.config.num_episodes}, "
-                  f"Total Reward: {total_reward:.2f}, Epsilon: {self.epsilon:.4f}")
+                  f"Total Reward: {total_reward:.2f}, Epsilon: {self.epsilon:.4f}, "
+                  f"Env steps/s: {env_steps_per_sec:.0f}, Grad steps/s: {grad_steps_per_sec:.1f}")
 
             if (episode + 1) % self.config.checkpoint_freq == 0:
                 self.save_checkpoint(episode + 1)
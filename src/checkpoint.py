@@ -0,0 +1,240 @@
+import glob
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+import numpy as np
+import torch
+
+from src.replay.snapshot import EpisodeSnapshotter
+
+LATEST = 'latest'
+
+
+def atomic_save(obj, path):
+    '''
+    @brief: torch.save under a temporary name and rename, so a crash never leaves a partial file behind
+    '''
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def rng_state():
+    '''
+    @return: states of the python, numpy and torch (CPU and CUDA) random generators
+    '''
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_cpu(obj):
+    '''
+    @brief: copy of a nested structure of state dicts with every tensor cloned to CPU
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+class Checkpointer:
+    '''
+    @brief:
+        Full-state training checkpoints written on a background thread.
+        save() copies the state (state dicts of models, target networks, optimizers, counters, ...)
+        to CPU on the calling thread, together with the random generator states, and the background
+        thread writes it to checkpoint{step:08d}.pt with an atomic rename, then atomically points the
+        'latest' file at it. Old checkpoints are removed according to the retention policy.
+        Replay snapshotters (src.replay.snapshot) passed in are snapshotted with every checkpoint under a
+        manifest of its own, recorded in the checkpoint, so the replay buffer restored on resume matches the
+        trainer state. The manifests are removed with their checkpoints. Without snapshotters the replay buffer
+        is not saved: a resumed run starts with an empty buffer, so it does not continue exactly.
+    '''
+    def __init__(self, directory, keep_last=3, keep_every=None, snapshotters=()):
+        '''
+        @params:
+            directory: directory of the checkpoint files
+            keep_last: number of most recent checkpoints kept
+            keep_every: also keep the checkpoints whose step is a multiple of keep_every, None to disable
+            snapshotters: replay snapshotters saved with every checkpoint
+        '''
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.snapshotters = list(snapshotters)
+        os.makedirs(directory, exist_ok=True)
+        self.jobs = queue.Queue(maxsize=1)
+        self.busy = threading.Lock()
+        self.error = None
+        self.last_duration = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--checkpoint_dir', type=str, default=None, help='Directory of full-state checkpoints, the run resumes from the latest one if present')
+        parser.add_argument('--checkpoint_interval', type=int, default=20, help='Episodes between full-state checkpoints')
+        parser.add_argument('--keep_checkpoints', type=int, default=3, help='Number of most recent checkpoints kept')
+        parser.add_argument('--checkpoint_replay', action='store_true', help='Snapshot the replay buffer with every checkpoint. Needed for an exact resume, without it a resumed run starts with an empty replay buffer')
+
+    @classmethod
+    def from_args(cls, args, replay_buffer=None):
+        '''
+        @brief: create a checkpointer from the --checkpoint_dir, --keep_checkpoints and --checkpoint_replay arguments,
+            None without --checkpoint_dir. With --checkpoint_replay, the episode replay buffer is snapshotted
+            under checkpoint_dir/replay with every checkpoint
+        '''
+        if not args.checkpoint_dir:
+            return None
+        snapshotters = []
+        if args.checkpoint_replay and replay_buffer is not None:
+            snapshotters.append(EpisodeSnapshotter(replay_buffer, os.path.join(args.checkpoint_dir, 'replay')))
+        return cls(args.checkpoint_dir, keep_last=args.keep_checkpoints, snapshotters=snapshotters)
+
+    def save(self, step, state, block=False):
+        '''
+        @params:
+            step: step (e.g. episode) of the checkpoint, names the file
+            state: dict of state dicts and values to save, the random generator states are added as 'rng'
+                and the replay manifest names as 'replay'
+            block: wait for the previous checkpoint to finish instead of skipping this one
+        @return: True if the checkpoint was started, False if the previous one is still being written
+        '''
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        if not self.busy.acquire(blocking=block):
+            return False
+        try:
+            manifests = [self._manifest(step)] * len(self.snapshotters)
+            state = _to_cpu(dict(state, rng=rng_state(), replay=manifests))
+            for snapshotter, manifest in zip(self.snapshotters, manifests):
+                snapshotter.snapshot(block=True, name=manifest)
+        except BaseException:
+            self.busy.release()
+            raise
+        self.jobs.put((step, state))
+        return True
+
+    def _run(self):
+        while True:
+            step, state = self.jobs.get()
+            try:
+                start = time.time()
+                # The replay snapshots must be complete before the checkpoint refers to them
+                for snapshotter in self.snapshotters:
+                    snapshotter.wait()
+                self._write(step, state)
+                self.last_duration = time.time() - start
+            except Exception as error:
+                self.error = error
+            finally:
+                self.busy.release()
+
+    def _path(self, step):
+        return os.path.join(self.directory, f'checkpoint{step:08d}.pt')
+
+    @staticmethod
+    def _manifest(step):
+        return f'manifest{step:08d}.json'
+
+    def _write(self, step, state):
+        atomic_save(state, self._path(step))
+        tmp_path = os.path.join(self.directory, LATEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(os.path.basename(self._path(step)))
+        os.replace(tmp_path, os.path.join(self.directory, LATEST))
+        self._prune()
+
+    def steps(self):
+        '''
+        @return: sorted steps of the checkpoints in the directory
+        '''
+        names = (os.path.basename(path) for path in glob.glob(os.path.join(self.directory, 'checkpoint*.pt')))
+        return sorted(int(match.group(1)) for match in map(re.compile(r'checkpoint(\d+)\.pt$').match, names) if match)
+
+    def _prune(self):
+        steps = self.steps()
+        recent = set(steps[-self.keep_last:]) if self.keep_last > 0 else set()
+        for step in steps:
+            if step in recent or (self.keep_every and step % self.keep_every == 0):
+                continue
+            os.remove(self._path(step))
+        self._prune_replay()
+
+    def _prune_replay(self):
+        '''
+        @brief: remove the replay snapshots of removed checkpoints, and those newer than the latest one
+        '''
+        keep = [self._manifest(step) for step in self.steps()]
+        for snapshotter in self.snapshotters:
+            snapshotter.prune(keep)
+
+    def wait(self):
+        '''
+        @brief: block until the checkpoint in progress is written
+        '''
+        with self.busy:
+            pass
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def latest(self):
+        '''
+        @return: path of the latest complete checkpoint, None if there is none
+        '''
+        path = os.path.join(self.directory, LATEST)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            path = os.path.join(self.directory, f.read().strip())
+        return path if os.path.exists(path) else None
+
+    def load(self, path=None, map_location='cpu'):
+        '''
+        @params:
+            path: checkpoint file, the latest one if None
+        @return: the saved state, None if there is no checkpoint
+        '''
+        path = path or self.latest()
+        if path is None:
+            return None
+        # Checkpoints hold optimizer and random generator states (numpy arrays, tuples), not only tensors
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def restore(self, map_location='cpu'):
+        '''
+        @brief: resume from the latest checkpoint: restore the replay snapshots and the random generator states.
+            Call it once everything else is set up (seeding included), right before training continues
+        @return: the saved state to load into the trainer, None if there is no checkpoint
+        '''
+        state = self.load(map_location=map_location)
+        if state is None:
+            return None
+        for snapshotter, manifest in zip(self.snapshotters, state['replay']):
+            snapshotter.restore(manifest)
+        # Snapshots of a checkpoint that was never published (a crash in between) are ahead of it
+        self._prune_replay()
+        set_rng_state(state['rng'])
+        return state
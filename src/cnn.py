@@ -29,7 +29,7 @@ class CNNFeatureExtractor(nn.Module):
         orig_shape = x.shape[:-3]
         h, w = x.shape[-3:-1]
         
-        x = x.view(-1, h, w, 5)
+        x = x.reshape(-1, h, w, 5)
         x = x.permute(0, 3, 1, 2)  # [..., 5, H, W]
         x = self.cnn(x)
         x = x.reshape(*orig_shape, -1)  # Flatten CNN output
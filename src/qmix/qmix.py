@@ -7,10 +7,16 @@ import torch.nn.functional as F
 from torch.distributions import Categorical
 import random
 import os
+import threading
 
 from rewards import _calc_reward
 from src.cnn import CNNFeatureExtractor
-from src.rnn_agent.rnn_agent import ReplayBufferGRU, RNNAgent
+from src.rnn_agent.rnn_agent import ReplayBufferGRU, RNNAgent, masked_mse_loss, split_frames
+from src.replay.prefetch import BatchPrefetcher
+from src.replay.augment import augment_batch
+from src.update_scheduler import UpdateScheduler
+from src.td_targets import discounted_scan, following_step, td0_targets
+from src.train_step import TrainStep, make_optimizer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(device)
@@ -21,41 +27,33 @@ class ReplayBuffer(ReplayBufferGRU):
     initial input hidden state and output hidden state of GRU.
     And each sample contains the whole episode instead of a single step.
     'hidden_in' and 'hidden_out' are only the initial hidden state for each episode, for GRU initialization.
+    Global states are stored as T+1 frames like the observations.
 
     """
     def push(self, hidden_in, hidden_out, observation, state, next_state, action, reward, next_observation):      
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(None)
-        self.buffer[self.position] = (
-            hidden_in, hidden_out, observation, state, next_state, action, reward, next_observation)
-        self.position = int((self.position + 1) %
-                            self.capacity)  # as a ring buffer
-
-    def sample(self, batch_size):
-        obs_lst, a_lst, r_lst, nobs_lst, hi_lst, ho_lst, s_lst, ns_lst = [], [], [], [], [], [], [], []
-        batch = random.sample(self.buffer, batch_size)
-        min_seq_len = float('inf')
-        for sample in batch:
-            h_in, h_out, observation, state, next_state, action, reward, next_observation = sample
-            min_seq_len = min(len(observation), min_seq_len)
-            hi_lst.append(h_in) # h_in: (1, batch_size=1, n_agents, hidden_size)
-            ho_lst.append(h_out)
-        hi_lst = torch.cat(hi_lst, dim=-3).detach()  # cat along the batch dim
-        ho_lst = torch.cat(ho_lst, dim=-3).detach()
-
-        # strip sequence length
-        for sample in batch:
-            h_in, h_out, observation, state, next_state, action, reward, next_observation = sample
-            sample_len = len(observation)
-            start_idx = int((sample_len - min_seq_len)/2)
-            end_idx = start_idx+min_seq_len
-            obs_lst.append(observation[start_idx:end_idx])
-            s_lst.append(state[start_idx:end_idx])
-            ns_lst.append(next_state[start_idx:end_idx])
-            a_lst.append(action[start_idx:end_idx])
-            r_lst.append(reward[start_idx:end_idx])
-            nobs_lst.append(next_observation[start_idx:end_idx])
-        return hi_lst, ho_lst, obs_lst, s_lst, ns_lst, a_lst, r_lst, nobs_lst
+        episode = self._episode(hidden_in, hidden_out, observation, action, reward, next_observation)
+        episode['state_frames'] = self._frames(state, next_state)  # [T+1, ...state_shape]
+        self._store(episode)
+
+    def sample(self, batch_size, seq_len=None, rng=None):
+        """
+        @params:
+            seq_len, rng: see ReplayBufferGRU.sample
+        @return:
+            hidden_in, hidden_out, frames, state_frames, action, reward, mask
+            with state_frames: [#batch, #sequence + 1, ...state_shape], see ReplayBufferGRU.sample for the rest
+        """
+        batch = self._sample_episodes(batch_size, rng)
+        hi_lst = torch.cat([episode['hidden_in'] for episode in batch], dim=-3).detach()  # cat along the batch dim
+        ho_lst = torch.cat([episode['hidden_out'] for episode in batch], dim=-3).detach()
+
+        starts, lengths, mask = self._windows(batch, seq_len, np.random if rng is None else rng)
+        seq_len = mask.shape[1]
+        frames = self._gather_frames(batch, 'frames', starts, lengths, seq_len)
+        state_frames = self._gather_frames(batch, 'state_frames', starts, lengths, seq_len)
+        action = self._gather(batch, 'action', starts, lengths, seq_len)
+        reward = self._gather(batch, 'reward', starts, lengths, seq_len)
+        return hi_lst, ho_lst, frames, state_frames, action, reward, mask
 
 class QMix(nn.Module):
     def __init__(self, state_dim, n_agents, action_shape, embed_dim=64, hypernet_embed=128, abs=True):
@@ -127,8 +125,29 @@ class QMix(nn.Module):
         return q_tot
 
 class QMix_Trainer():
-    def __init__(self, replay_buffer=None, n_agents=81, obs_dim=300, state_dim=405, action_shape=1, action_dim=21, hidden_dim=64, hypernet_dim=128, target_update_interval=10, lr=5e-4, epsilon_start=1.0, epsilon_end=0.05, epsilon_decay=0.995):
+    def __init__(self, replay_buffer=None, n_agents=81, obs_dim=300, state_dim=405, action_shape=1, action_dim=21, hidden_dim=64, hypernet_dim=128, target_update_interval=10, lr=5e-4, epsilon_start=1.0, epsilon_end=0.05, epsilon_decay=0.995, prefetch=1, scheduler=None,
+                 precision='fp32', compile=False, fused_optim=False, augment=False, seed=None):
+        '''
+        @params:
+            prefetch: number of batches sampled ahead on a background thread, 0 to sample in update
+            scheduler: UpdateScheduler setting the gradient step budget of update, the original fit-until-loss budget if None
+            precision, compile: autocast precision and torch.compile of the training step, see src.train_step.TrainStep
+            fused_optim: use the fused (or foreach) AdamW implementation
+            augment: transform every sampled episode (observations, global states and actions) by a random
+                symmetry of the map, see src.replay.augment
+            seed: seed of the replay sampling generator. Batches are drawn from their own generator, not from the
+                global ones the rollouts use, so the prefetch thread does not change the episodes and seeded runs
+                stay reproducible
+        '''
         self.replay_buffer = replay_buffer
+        self.scheduler = scheduler if scheduler is not None else UpdateScheduler()
+        self.augment = augment
+        self.sample_rng = np.random.RandomState(seed)
+        # Episodes are pushed by the training loop while the prefetch thread samples
+        self.buffer_lock = threading.Lock()
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.prefetch_args = None
 
         self.action_dim = action_dim
         self.action_shape = action_shape
@@ -151,12 +170,13 @@ class QMix_Trainer():
         self._update_targets()
         self.update_cnt = 0
         
-        self.criterion = nn.MSELoss()
-
-        self.optimizer = optim.AdamW(
+        self.optimizer = make_optimizer(
+            optim.AdamW,
             list(self.agent.parameters())+list(self.mixer.parameters()), 
+            fused=fused_optim,
             lr=lr,
             weight_decay=0.001)
+        self.train_step = TrainStep(self._loss, self.optimizer, precision=precision, compile=compile)
 
     def get_action(self, state, hidden_in):
         '''
@@ -173,60 +193,98 @@ class QMix_Trainer():
         '''
         @brief: push arguments into replay buffer
         '''
-        self.replay_buffer.push(ini_hidden_in, ini_hidden_out, episode_observation, episode_state, episode_next_state, episode_action,
-                                episode_reward, episode_next_observation)
-
-    def update(self, batch_size):
-        current_loss = 100
-        total_epoch = 0
-        num_epoch = 100
-        # 1. Lấy batch từ replay buffer
-        hidden_in, hidden_out, observation, state, next_state, action, reward, next_observation = self.replay_buffer.sample(
-            batch_size)
-
-        # Converting the list to a single numpy.ndarray with numpy.array() before converting to a tensor.
-        observation = np.array(observation)
-        state = np.array(state)
-        next_state = np.array(next_state)
-        next_observation = np.array(next_observation)
-        action = np.array(action)
-        reward = np.array(reward)
-        
-        observation = torch.FloatTensor(observation).to(device) # [#batch, sequence, #agents, #features*action_shape]
-        state = torch.FloatTensor(state).to(device) #
-        next_state = torch.FloatTensor(next_state).to(device)
-        next_observation = torch.FloatTensor(next_observation).to(device)
-        action = torch.LongTensor(action).to(device) # [#batch, sequence, #agents, #action_shape]
-        reward = torch.FloatTensor(reward).unsqueeze(-1).to(device) # reward is scalar, add 1 dim to be [reward] at the same dim
-
-        # 3. Tính target Q values
-        target_agent_outs, _ = self.target_agent(next_observation, hidden_out)
-        target_max_qvals = target_agent_outs.max(dim=-1, keepdim=True)[0] # [#batch, #sequence, #agents, action_shape]
-        target_qtot = self.target_mixer(target_max_qvals, next_state)
-        # 4. Tính reward và targets
-        reward_epoch = _calc_reward(reward)
-        targets = self._build_td0_targets(reward_epoch, target_qtot)
-        # Vòng lặp huấn luyện đảm bảo model fit trước khi chuyển sang episode tiếp theo
-        while(current_loss > 0.1 and total_epoch < 10):
-            for epoch in range(1, num_epoch + 1):
-                # 2. Tính current Q values
-                agent_outs, _ = self.agent(observation, hidden_in) # [#batch, #sequence, #agent, action_shape, num_actions]
-                chosen_action_qvals = torch.gather(  # [#batch, #sequence, #agent, action_shape]
-                    agent_outs, dim=-1, index=action.unsqueeze(-1)).squeeze(-1)
-                qtot = self.mixer(chosen_action_qvals, state) # [#batch, #sequence, 1]
-
-                # 5. Tính loss và update
-                loss = self.criterion(qtot, targets.detach())
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                
-                current_loss = loss.item()
-            
-                if epoch % 100 == 0:
-                    print(f'Epoch {epoch}/{total_epoch+1}, Loss: {current_loss}')
-            total_epoch += 1
-        
+        if self.prefetcher is not None:
+            # The batches prefetched since the last update are all sampled before the episode is added
+            self.prefetcher.wait_ahead()
+        with self.buffer_lock:
+            self.replay_buffer.push(ini_hidden_in, ini_hidden_out, episode_observation, episode_state, episode_next_state, episode_action,
+                                    episode_reward, episode_next_observation)
+
+    def _sample(self, batch_size, seq_len=None):
+        '''
+        @brief: get the next batch as tensors on device. With prefetching the batch was sampled
+            while the previous update was running, so it does not include the episode pushed since then.
+        '''
+        if self.prefetch == 0:
+            batch = self._sample_arrays(batch_size, seq_len)
+            return tuple(torch.from_numpy(x).to(device) if isinstance(x, np.ndarray) else x for x in batch)
+        if self.prefetcher is None or self.prefetch_args != (batch_size, seq_len):
+            self._close_prefetcher()
+            self.prefetcher = BatchPrefetcher(lambda: self._sample_arrays(batch_size, seq_len),
+                                              depth=self.prefetch, device=device, lock=self.buffer_lock)
+            self.prefetch_args = (batch_size, seq_len)
+        return self.prefetcher.get()
+
+    def _close_prefetcher(self):
+        '''
+        @brief: stop the prefetch thread and drop the batches it sampled ahead, the next update starts a new one
+        '''
+        if self.prefetcher is not None:
+            # Let it finish its batches first, so the number of draws from the sampling generator does not depend on timing
+            self.prefetcher.wait_ahead()
+            self.prefetcher.close()
+            self.prefetcher = None
+            self.prefetch_args = None
+
+    def _sample_arrays(self, batch_size, seq_len=None):
+        batch = self.replay_buffer.sample(batch_size, seq_len, rng=self.sample_rng)
+        if self.augment:
+            # Frames, state frames and actions of a sample share its symmetry
+            batch = augment_batch(batch, frames=(2, 3), actions=(4,), rng=self.sample_rng)
+        return batch
+
+    def _prepare_batch(self, batch_size, seq_len=None):
+        '''
+        @brief: sample a batch and compute its TD targets with the target networks
+        '''
+        # observation: [#batch, sequence, #agents, #features*action_shape], action: [#batch, sequence, #agents, #action_shape]
+        # mask: [#batch, sequence], 0 for padded steps
+        hidden_in, hidden_out, frames, state_frames, action, reward, mask = self._sample(batch_size, seq_len)
+        # Current and next steps share one T+1 frame window
+        observation, next_observation = split_frames(frames, mask)
+        state, next_state = split_frames(state_frames, mask)
+        reward = reward.unsqueeze(-1) # reward is scalar, add 1 dim to be [reward] at the same dim
+
+        # Tính target Q values
+        with torch.no_grad():
+            target_agent_outs, _ = self.target_agent(next_observation, hidden_out)
+            target_max_qvals = target_agent_outs.max(dim=-1, keepdim=True)[0] # [#batch, #sequence, #agents, action_shape]
+            target_qtot = self.target_mixer(target_max_qvals, next_state)
+            # Tính reward và targets
+            reward_epoch = _calc_reward(reward)
+            targets = self._build_td0_targets(reward_epoch, target_qtot, mask)
+        return hidden_in, observation, state, action, mask, targets, reward_epoch
+
+    def _loss(self, hidden_in, observation, state, action, mask, targets, reward_epoch):
+        # Tính current Q values
+        agent_outs, _ = self.agent(observation, hidden_in) # [#batch, #sequence, #agent, action_shape, num_actions]
+        chosen_action_qvals = torch.gather(  # [#batch, #sequence, #agent, action_shape]
+            agent_outs, dim=-1, index=action.unsqueeze(-1)).squeeze(-1)
+        qtot = self.mixer(chosen_action_qvals, state) # [#batch, #sequence, 1]
+        return masked_mse_loss(qtot, targets, mask)
+
+    def _gradient_step(self, batch):
+        # Tính loss và update
+        return self.train_step(*batch)
+
+    def update(self, batch_size, seq_len=None, env_steps=0):
+        '''
+        @params:
+            env_steps: environment steps collected since the previous update, for the replay ratio of the scheduler
+        @return: loss of the last gradient step (None if the budget was 0) and the total reward of the last batch
+        '''
+        batches = []
+
+        def sample():
+            batches.append(self._prepare_batch(batch_size, seq_len))
+            return batches[-1]
+
+        stats = self.scheduler.run(sample, self._gradient_step, env_steps)
+        current_loss = stats.losses[-1] if stats.losses else None
+
+        if self.prefetcher is not None:
+            print(self.prefetcher.summary())
+
         self.update_cnt += 1
         if self.update_cnt % self.target_update_interval == 0:
             self._update_targets()
@@ -234,7 +292,8 @@ class QMix_Trainer():
         self.epsilon = max(self.epsilon_end, self.epsilon * self.epsilon_decay)
         self.agent.epsilon = self.epsilon
 
-        return current_loss, reward_epoch.sum(dim=1)[0].cpu().item()
+        target_reward = batches[-1][-1].sum(dim=1)[0].cpu().item() if batches else None
+        return current_loss, target_reward
 
     def _build_td_lambda_targets(self, rewards, target_qs, gamma=0.99, td_lambda=0.6):
         '''
@@ -242,29 +301,24 @@ class QMix_Trainer():
             rewards: [#batch, #sequence, 1]
             target_qs: [#batch, #sequence, 1]
         '''
-        ret = target_qs.new_zeros(*target_qs.shape)
-        ret[:, -1] = target_qs[:, -1]
-        # backwards recursive update of the "forward view"
-        for t in range(ret.shape[1] - 2, -1, -1):
-            ret[:, t] = td_lambda * gamma * ret[:, t+1] + (rewards[:, t] + (1 - td_lambda) * gamma * target_qs[:, t+1])
-        return ret
-
-    def _build_td0_targets(self, rewards, target_qs, gamma=0.99):
+        # backwards recursive update of the "forward view", as one discounted scan
+        values = rewards + (1 - td_lambda) * gamma * following_step(target_qs)
+        values[:, -1] = target_qs[:, -1]
+        return discounted_scan(values, td_lambda * gamma)
+
+    def _build_td0_targets(self, rewards, target_qs, mask=None, gamma=0.99):
         """
         Tính toán target Q-values theo công thức Q-learning: Q(s,a) = r + γ max_a' Q(s',a')
         
         @params:
             rewards: [#batch, #sequence, 1] - Phần thưởng tức thời
             target_qs: [#batch, #sequence, 1] - Q values từ target network
+            mask: [#batch, #sequence] - 1 for valid steps, padded steps are not bootstrapped from
         @return:
             ret: [#batch, #sequence, 1] - Target Q values
         """
-        ret = target_qs.new_zeros(*target_qs.shape)
-        ret[:, -1] = rewards[:, -1]
         # Q(s,a) = r + γ max_a' Q(s',a')
-        for t in range(ret.shape[1] - 2, -1, -1):
-            ret[:, t] = rewards[:, t] + gamma * target_qs[:, t+1]
-        return ret
+        return td0_targets(rewards, following_step(target_qs, mask), gamma=gamma)
 
     def _update_targets(self):
         for target_param, param in zip(self.target_mixer.parameters(), self.mixer.parameters()):
@@ -283,4 +337,38 @@ class QMix_Trainer():
         self.mixer.load_state_dict(torch.load(path+'_mixer', map_location=map_location, weights_only=True))
 
         self.agent.eval()
-        self.mixer.eval()
\ No newline at end of file
+        self.mixer.eval()
+
+    def state_dict(self):
+        '''
+        @brief: the batches prefetched so far are dropped first, so the sampling generator is saved after their draws
+            and the run that continues samples the same batches as a run resumed from this state
+        @return: full training state (networks, target networks, optimizer, schedule counters, replay sampling
+            generator) for src.checkpoint, the replay buffer is saved by its snapshotter
+        '''
+        self._close_prefetcher()
+        return {
+            'agent': self.agent.state_dict(),
+            'mixer': self.mixer.state_dict(),
+            'target_agent': self.target_agent.state_dict(),
+            'target_mixer': self.target_mixer.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'train_step': self.train_step.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'epsilon': self.epsilon,
+            'update_cnt': self.update_cnt,
+            'sample_rng': self.sample_rng.get_state(),
+        }
+
+    def load_state_dict(self, state):
+        self.agent.load_state_dict(state['agent'])
+        self.mixer.load_state_dict(state['mixer'])
+        self.target_agent.load_state_dict(state['target_agent'])
+        self.target_mixer.load_state_dict(state['target_mixer'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.train_step.load_state_dict(state['train_step'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.epsilon = state['epsilon']
+        self.agent.epsilon = self.epsilon
+        self.update_cnt = state['update_cnt']
+        self.sample_rng.set_state(state['sample_rng'])
\ No newline at end of file
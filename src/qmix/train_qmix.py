@@ -13,6 +13,11 @@ from qmix import QMix_Trainer, ReplayBuffer
 from src.cnn import CNNFeatureExtractor
 from utils import get_all_states, make_action
 from src.torch_model import QNetwork
+from src.replay.episode_store import CompressedEpisodeStore
+from src.replay.snapshot import EpisodeSnapshotter
+from src.update_scheduler import UpdateScheduler
+from src.train_step import TrainStep
+from src.checkpoint import Checkpointer
 
 # Thêm đoạn parse arguments trước khi định nghĩa các biến
 parser = argparse.ArgumentParser(description='Train QMIX agents')
@@ -29,11 +34,24 @@ parser.add_argument('--checkpoint', type=str, default=None, help='Path to checkp
 parser.add_argument('--model_path', type=str, default='model/qmix', help='Path to save model')
 parser.add_argument('--red_pretrained', action='store_true', help='Use red.pt pretrained model')
 parser.add_argument('--learning_rate', type=float, default=1e-3, help='Learning rate for optimizer')
+parser.add_argument('--prefetch', type=int, default=1, help='number of batches sampled ahead on a background thread, 0 to disable')
+parser.add_argument('--snapshot_dir', type=str, default=None, help='Directory of incremental replay snapshots, restored on start if present')
+parser.add_argument('--snapshot_interval', type=int, default=10, help='Episodes between replay snapshots')
+parser.add_argument('--buffer_size', type=int, default=None, help='Number of episodes kept in the replay buffer, batch_size if not set')
+parser.add_argument('--compress_replay', action='store_true', help='Compress every stored episode and keep an LRU cache of decompressed ones')
+parser.add_argument('--replay_dir', type=str, default=None, help='Directory to spill compressed episodes to, kept in memory if not set')
+parser.add_argument('--episode_cache', type=int, default=16, help='Number of decompressed episodes cached for sampling')
+parser.add_argument('--dedup_obs', action='store_true', help='Store each distinct observation once in the replay buffer')
+parser.add_argument('--seq_len', type=int, default=None, help='Length of sampled episode windows, full padded episodes if not set')
+parser.add_argument('--augment', action='store_true', help='Transform every sampled episode by a random symmetry of the map')
+UpdateScheduler.add_arguments(parser)
+TrainStep.add_arguments(parser)
+Checkpointer.add_arguments(parser)
 
 args = parser.parse_args()
 
 dummy_cnn = CNNFeatureExtractor()
-replay_buffer_size = args.batch_size
+replay_buffer_size = args.buffer_size or args.batch_size
 hidden_dim = 64
 hypernet_dim = 128
 max_steps = args.max_steps
@@ -55,7 +73,10 @@ action_dim = env.action_space("blue_0").n
 action_shape = 1
 n_agents = len(env.agents)//2
 
-replay_buffer = ReplayBuffer(replay_buffer_size)
+episode_store = None
+if args.compress_replay:
+    episode_store = CompressedEpisodeStore(args.replay_dir, cache_size=args.episode_cache)
+replay_buffer = ReplayBuffer(replay_buffer_size, dedup_obs=args.dedup_obs, store=episode_store)
 learner = QMix_Trainer(
     replay_buffer=replay_buffer,
     n_agents=n_agents,
@@ -70,10 +91,21 @@ learner = QMix_Trainer(
     epsilon_start=args.epsilon_start,
     epsilon_end=args.epsilon_end,
     epsilon_decay=args.epsilon_decay,
+    prefetch=args.prefetch,
+    scheduler=UpdateScheduler.from_args(args),
+    augment=args.augment,
+    seed=args.seed,
+    **TrainStep.options_from_args(args),
 )
 
 if args.checkpoint:
     learner.load_model(args.checkpoint, map_location=device)
+
+snapshotter = None
+if args.snapshot_dir:
+    snapshotter = EpisodeSnapshotter(replay_buffer, args.snapshot_dir)
+    if snapshotter.restore():
+        print(f"Restored {len(replay_buffer)} episodes from {args.snapshot_dir}")
     
 red_agent = None
 if args.red_pretrained:
@@ -87,7 +119,7 @@ if args.red_pretrained:
     red_agent.to(device)
 
 def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=32, 
-                    save_interval=100, model_path='model/qmix'):
+                    save_interval=100, model_path='model/qmix', start_episode=0, checkpointer=None, env_steps=0):
     """
     Train blue team using QMIX algorithm
     
@@ -99,15 +131,22 @@ def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=3
         batch_size: Batch size for training
         save_interval: Interval to save model
         model_path: Path to save model
+        start_episode: First episode, after the episode of the checkpoint the run resumes from
+        checkpointer: Checkpointer saving the full training state every args.checkpoint_interval episodes
+        env_steps: Environment steps since the last update, from the checkpoint
     """
     learner.agent.train()
     learner.target_agent.train()
     learner.mixer.train()
     learner.target_mixer.train()
     loss, target_reward = None, None
-    for episode in range(max_episodes):
+    for episode in range(start_episode, max_episodes):
         print(f"Start episode {episode} ----------------------")
-        env.reset()
+        if checkpointer is not None:
+            # Episodes do not depend on the environment state before them, so a resumed run replays them exactly
+            env.reset(seed=args.seed + episode)
+        else:
+            env.reset()
         episode_reward = 0
         
         # Clear memory after each episode
@@ -172,6 +211,7 @@ def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=3
         # print(np.stack(episode_rewards).shape) #(1000, 81)
         # print(np.stack(episode_next_states).shape) #(1000, 81, 845)
 
+        env_steps += len(episode_observations)
         # Push entire episode to replay buffer
         episode_states = np.stack(episode_states)
         episode_next_states = np.stack(episode_next_states)
@@ -187,23 +227,41 @@ def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=3
                 episode_next_observation=episode_next_observations
             )
         
+        if args.dedup_obs:
+            print(f"Replay {replay_buffer.dedup_summary()}")
+        if args.compress_replay:
+            print(f"Replay {replay_buffer.store_summary()}")
+
         # Clear unnecessary tensors
         del hidden_out
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
-        # Training step
-        if episode + 1 >= batch_size:
-            loss, target_reward = learner.update(batch_size)
+        if snapshotter is not None and (episode + 1) % args.snapshot_interval == 0:
+            snapshotter.snapshot()
+
+        # Training step, right away when the buffer was restored from a snapshot
+        if learner.replay_buffer.get_length() >= batch_size:
+            loss, target_reward = learner.update(batch_size, args.seq_len, env_steps)
+            env_steps = 0
 
         # Save model periodically
         if episode % save_interval == 0:
             learner.save_model(f"{model_path}_episode_{episode}")
             
+        if checkpointer is not None and (episode + 1) % args.checkpoint_interval == 0:
+            checkpointer.save(episode, {'learner': learner.state_dict(), 'episode': episode, 'env_steps': env_steps})
+
         print(f"Episode {episode}: Reward = {episode_reward/n_agents:.2f}, TR = {np.round(target_reward,2) if target_reward else 'N/A'}, Loss = {loss if loss else 'N/A'}")
     
+    print(learner.scheduler.summary())
     # Save final model
     learner.save_model(model_path)
+    if checkpointer is not None:
+        checkpointer.wait()
+    if snapshotter is not None:
+        snapshotter.snapshot(block=True)
+        snapshotter.wait()
     env.close()
     
     return learner
@@ -222,6 +280,14 @@ def set_seed(seed):
 
 if __name__ == "__main__":
     set_seed(args.seed)
+    start_episode, env_steps = 0, 0
+    checkpointer = Checkpointer.from_args(args, replay_buffer)
+    if checkpointer is not None:
+        state = checkpointer.restore(map_location=device)
+        if state is not None:
+            learner.load_state_dict(state['learner'])
+            start_episode, env_steps = state['episode'] + 1, state['env_steps']
+            print(f"Resumed from {checkpointer.latest()} at episode {start_episode}")
     # Sử dụng hàm training
     trained_qmix = train_blue_qmix(
         env=env,
@@ -230,5 +296,8 @@ if __name__ == "__main__":
         max_steps=max_steps,
         batch_size=batch_size,
         save_interval=save_interval,
-        model_path=model_path
+        model_path=model_path,
+        start_episode=start_episode,
+        checkpointer=checkpointer,
+        env_steps=env_steps,
     )
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+Symmetry augmentation of sampled replay batches.
+
+The battle map, the agent views and the action set are symmetric under the 8 symmetries of the square
+(the dihedral group: 4 rotations, each with or without a left/right reflection). A sampled episode or
+chunk transformed by one of them, with its actions remapped accordingly, is another valid trajectory,
+so every collected transition can be trained on in 8 variants.
+
+Observations and global states are [..., H, W, C] square maps, transformed with one strided copy per sample
+(faster than a gather of their cells), and actions are remapped through precomputed permutation tables
+with one gather for the whole batch.
+"""
+import numpy as np
+
+# (dy, dx) offsets of the 21 battle actions, in action order: 13 moves within distance 2 (6 stays in place),
+# then 8 attacks on the neighbouring cells, see RuleBasedAgent
+MOVE_OFFSETS = [(-2, 0), (-1, -1), (-1, 0), (-1, 1), (0, -2), (0, -1), (0, 0), (0, 1), (0, 2),
+                (1, -1), (1, 0), (1, 1), (2, 0)]
+ATTACK_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+NUM_SYMMETRIES = 8
+
+
+def transform_grid(grid, symmetry):
+    """
+    Apply a symmetry to a single [H, W, ...] grid.
+
+    Args:
+        grid: array whose first two axes are square
+        symmetry: 0-7, the identity is 0. Symmetry 4 * flip + k is an optional left/right reflection
+            followed by k quarter turns
+
+    Returns:
+        transformed view of grid
+    """
+    if symmetry >= 4:
+        grid = grid[:, ::-1]
+    return np.rot90(grid, symmetry % 4, axes=(0, 1))
+
+
+def _offset_permutation(offsets, symmetry):
+    # Mark every offset on a grid around the agent and read where the symmetry moves it
+    radius = max(max(abs(dy), abs(dx)) for dy, dx in offsets)
+    grid = np.full((2 * radius + 1, 2 * radius + 1), -1)
+    for i, (dy, dx) in enumerate(offsets):
+        grid[radius + dy, radius + dx] = i
+    moved = transform_grid(grid, symmetry)
+    permutation = [0] * len(offsets)
+    for y, x in zip(*np.nonzero(moved >= 0)):
+        permutation[moved[y, x]] = offsets.index((int(y) - radius, int(x) - radius))
+    return permutation
+
+
+def _action_permutations():
+    tables = []
+    for g in range(NUM_SYMMETRIES):
+        moves = _offset_permutation(MOVE_OFFSETS, g)
+        attacks = _offset_permutation(ATTACK_OFFSETS, g)
+        tables.append(moves + [len(MOVE_OFFSETS) + i for i in attacks])
+    return np.array(tables, dtype=np.int64)
+
+
+# Action a of a trajectory is action ACTION_PERMUTATIONS[g, a] of the trajectory transformed by symmetry g
+ACTION_PERMUTATIONS = _action_permutations()
+
+
+def transform_frames(frames, symmetries):
+    """
+    Transform the observations (or global states) of every sample with its own symmetry.
+
+    Args:
+        frames: [B, ..., H, W, C] with H == W, every frame of sample b gets symmetries[b]
+        symmetries: [B] (int)
+
+    Returns:
+        transformed copy of frames
+    """
+    out = np.empty_like(frames)
+    for b, symmetry in enumerate(symmetries):
+        # transform_grid on the spatial axes of all frames of the sample at once
+        grid = np.moveaxis(frames[b], (-3, -2), (0, 1))
+        np.moveaxis(out[b], (-3, -2), (0, 1))[...] = transform_grid(grid, symmetry)
+    return out
+
+
+def transform_actions(actions, symmetries):
+    """
+    Args:
+        actions: [B, ...] integer actions, every action of sample b gets symmetries[b]
+        symmetries: [B] (int)
+
+    Returns:
+        remapped copy of actions, same dtype
+    """
+    flat = actions.reshape(len(actions), -1).astype(np.int64)
+    remapped = np.take_along_axis(ACTION_PERMUTATIONS[symmetries], flat, axis=1)
+    return remapped.reshape(actions.shape).astype(actions.dtype)
+
+
+def augment_batch(batch, frames=(), actions=(), rng=np.random):
+    """
+    Apply one random symmetry per sample to a sampled batch.
+
+    Args:
+        batch: tuple of numpy arrays (and other items) whose first axis is the sample
+        frames: indices in batch of the observation and global state arrays, [B, ..., H, W, C]
+        actions: indices in batch of the action arrays, [B, ...]
+        rng: np.random or a np.random.RandomState, draws the symmetries
+
+    Returns:
+        tuple with the frames and actions transformed, the other items unchanged
+    """
+    batch = list(batch)
+    symmetries = rng.randint(0, NUM_SYMMETRIES, len(batch[frames[0] if frames else actions[0]]))
+    for i in frames:
+        batch[i] = transform_frames(batch[i], symmetries)
+    for i in actions:
+        batch[i] = transform_actions(batch[i], symmetries)
+    return tuple(batch)
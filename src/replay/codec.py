@@ -0,0 +1,120 @@
+import numpy as np
+
+# Plane layout of MAgent battle observations (minimap_mode=False, extra_features=False).
+# The global state returned by env.state() uses the same layout with red/blue in place of my/other team.
+WALL, MY_PRESENCE, MY_HP, OTHER_PRESENCE, OTHER_HP = range(5)
+BINARY_PLANES = (WALL, MY_PRESENCE, OTHER_PRESENCE)
+HP_PLANES = (MY_HP, OTHER_HP)
+
+
+class ObsCodec:
+    """
+    Compact encoding of MAgent battle observations.
+
+    Binary planes (walls and presence) are bit-packed, HP planes are quantized to uint8.
+    MAgent normalizes HP by max_hp, and with battle's max_hp=10 and step_recover=0.1 every
+    HP value sits on a 0.01 grid, so hp_levels=100 round-trips them exactly (up to float32 rounding).
+    A 13x13x5 observation takes 402 bytes instead of 3380 (float32) or 6760 (float64).
+    """
+    def __init__(self, obs_shape, binary_planes=BINARY_PLANES, hp_planes=HP_PLANES, hp_levels=100):
+        self.obs_shape = tuple(obs_shape)
+        self.binary_planes = list(binary_planes)
+        self.hp_planes = list(hp_planes)
+        self.hp_levels = hp_levels
+        assert sorted(self.binary_planes + self.hp_planes) == list(range(self.obs_shape[-1])), \
+            "Every observation plane must be either binary or HP."
+
+        height, width, _ = self.obs_shape
+        self.num_bits = height * width * len(self.binary_planes)
+        self.bits_size = (self.num_bits + 7) // 8
+        self.hp_shape = (height, width, len(self.hp_planes))
+
+    def encode(self, obs):
+        """
+        Encode a batch of observations.
+
+        Args:
+            obs: array-like of shape [..., H, W, C]
+
+        Returns:
+            bits: uint8 array [..., bits_size] with the packed binary planes
+            hp: uint8 array [..., H, W, #hp_planes] with the quantized HP planes
+        """
+        obs = np.asarray(obs, dtype=np.float32)
+        lead_shape = obs.shape[:-3]
+        binary = obs[..., self.binary_planes] > 0.5
+        bits = np.packbits(binary.reshape(*lead_shape, -1), axis=-1)
+        hp = np.rint(obs[..., self.hp_planes] * self.hp_levels).astype(np.uint8)
+        return bits, hp
+
+    def decode(self, bits, hp):
+        """
+        Decode a batch of observations back to float32.
+
+        Args:
+            bits: uint8 array [..., bits_size]
+            hp: uint8 array [..., H, W, #hp_planes]
+
+        Returns:
+            float32 array [..., H, W, C]
+        """
+        lead_shape = bits.shape[:-1]
+        height, width, _ = self.obs_shape
+        binary = np.unpackbits(bits, axis=-1, count=self.num_bits)
+        out = np.empty((*lead_shape, *self.obs_shape), dtype=np.float32)
+        out[..., self.binary_planes] = binary.reshape(*lead_shape, height, width, len(self.binary_planes))
+        out[..., self.hp_planes] = hp * np.float32(1.0 / self.hp_levels)
+        return out
+
+
+class PackedObsArray:
+    """
+    Array-like storage of observations in ObsCodec encoding.
+
+    Supports the same indexing as a numpy array of shape [*shape, *obs_shape]:
+    assignments encode, reads decode to float32. Any numpy index (int, slice, fancy) works,
+    so replay buffers can use it as a drop-in replacement for a dense float array.
+    """
+    def __init__(self, shape, obs_shape, allocator=np.zeros, codec=None):
+        """
+        Args:
+            shape: leading shape of the storage, e.g. (capacity, n_agents)
+            obs_shape: shape of a single observation (H, W, C)
+            allocator: callable (shape, dtype) -> array used for the underlying storage
+            codec: ObsCodec to use, created from obs_shape if None
+        """
+        self.codec = codec if codec is not None else ObsCodec(obs_shape)
+        self.shape = (*shape, *self.codec.obs_shape)
+        self.bits = allocator((*shape, self.codec.bits_size), np.uint8)
+        self.hp = allocator((*shape, *self.codec.hp_shape), np.uint8)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __setitem__(self, key, obs):
+        bits, hp = self.codec.encode(obs)
+        self.bits[key] = bits
+        self.hp[key] = hp
+
+    def __getitem__(self, key):
+        return self.codec.decode(self.bits[key], self.hp[key])
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.hp.nbytes
+
+
+def pack_obs(obs):
+    """
+    Encode a stack of observations into a new PackedObsArray.
+
+    Args:
+        obs: array-like (or list of arrays) of shape [..., H, W, C]
+
+    Returns:
+        PackedObsArray of the same shape
+    """
+    obs = np.asarray(obs)
+    packed = PackedObsArray(obs.shape[:-3], obs.shape[-3:])
+    packed[...] = obs
+    return packed
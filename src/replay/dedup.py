@@ -0,0 +1,195 @@
+import hashlib
+import sys
+import numpy as np
+
+from src.replay.codec import ObsCodec, PackedObsArray
+
+
+class DedupPool:
+    """
+    Content-addressed pool of encoded observations with reference counting.
+
+    Each distinct observation (its ObsCodec bytes) is stored once, so the zero-padded observations of dead
+    agents, agents in empty regions and agents that did not move share one entry. Entries are looked up by
+    a 16-byte digest of their content and checked against the stored row, so a digest collision never
+    aliases two observations. Entries are freed when their last reference is released, which for ring buffers
+    happens when the cursor overwrites the slots that used them. Entry 0 is the all-zero observation
+    and is never freed.
+    """
+    def __init__(self, obs_shape, codec=None, capacity=1024):
+        """
+        Args:
+            obs_shape: shape of a single observation (H, W, C)
+            codec: ObsCodec to use, created from obs_shape if None
+            capacity: initial number of entries, the pool doubles when it is full
+        """
+        self.codec = codec if codec is not None else ObsCodec(obs_shape)
+        self.row_size = self.codec.bits_size + int(np.prod(self.codec.hp_shape))
+        self.bits = np.zeros((capacity, self.codec.bits_size), dtype=np.uint8)
+        self.hp = np.zeros((capacity, *self.codec.hp_shape), dtype=np.uint8)
+        self.refs = np.zeros(capacity, dtype=np.int64)
+        self.keys = [None] * capacity  # entry -> content digest, to drop it from the index when freed
+        self.free = list(range(capacity - 1, 0, -1))
+        zero_key = self._digest(np.zeros(self.row_size, dtype=np.uint8))
+        self.index = {zero_key: 0}
+        self.keys[0] = zero_key
+
+    @staticmethod
+    def _digest(row):
+        return hashlib.blake2b(row, digest_size=16).digest()
+
+    def _matches(self, entry, row):
+        bits_size = self.codec.bits_size
+        return (np.array_equal(self.bits[entry], row[:bits_size])
+                and np.array_equal(self.hp[entry].reshape(-1), row[bits_size:]))
+
+    def _grow(self):
+        capacity = len(self.refs)
+        self.bits = np.concatenate([self.bits, np.zeros_like(self.bits)])
+        self.hp = np.concatenate([self.hp, np.zeros_like(self.hp)])
+        self.refs = np.concatenate([self.refs, np.zeros_like(self.refs)])
+        self.keys.extend([None] * capacity)
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def intern(self, bits, hp):
+        """
+        Find or insert encoded observations, without taking references.
+
+        Args:
+            bits: uint8 array [..., bits_size]
+            hp: uint8 array [..., H, W, #hp_planes]
+
+        Returns:
+            int64 array [...] of entry ids
+        """
+        lead_shape = bits.shape[:-1]
+        n = int(np.prod(lead_shape))
+        rows = np.concatenate([bits.reshape(n, -1), hp.reshape(n, -1)], axis=1)
+        ids = np.empty(n, dtype=np.int64)
+        # Rows inserted earlier in the batch are found in the index like any other entry
+        for k, row in enumerate(rows):
+            key = self._digest(row)
+            entry = self.index.get(key)
+            if entry is None or not self._matches(entry, row):
+                if not self.free:
+                    self._grow()
+                collision = entry is not None
+                entry = self.free.pop()
+                self.bits[entry] = row[:self.codec.bits_size]
+                self.hp[entry] = row[self.codec.bits_size:].reshape(self.codec.hp_shape)
+                # An entry whose digest collides with another one is stored but not indexed
+                if not collision:
+                    self.index[key] = entry
+                    self.keys[entry] = key
+            ids[k] = entry
+        return ids.reshape(lead_shape)
+
+    def acquire(self, ids):
+        np.add.at(self.refs, np.ravel(ids), 1)
+
+    def release(self, ids):
+        """Drop one reference per id and free the entries that are no longer referenced"""
+        ids = np.ravel(ids)
+        np.subtract.at(self.refs, ids, 1)
+        for entry in np.unique(ids[self.refs[ids] == 0]):
+            if entry != 0:
+                if self.keys[entry] is not None:
+                    del self.index[self.keys[entry]]
+                self.keys[entry] = None
+                self.free.append(int(entry))
+
+    def get(self, ids):
+        """Decode the observations of entry ids [...] to float32 [..., H, W, C]"""
+        return self.codec.decode(self.bits[ids], self.hp[ids])
+
+    @property
+    def unique(self):
+        """Number of live entries"""
+        return len(self.refs) - len(self.free)
+
+    @property
+    def references(self):
+        return int(self.refs.sum())
+
+    @property
+    def dedup_ratio(self):
+        """Stored observations per unique entry"""
+        return self.references / max(self.unique, 1)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.hp.nbytes + self.refs.nbytes
+
+    @property
+    def index_nbytes(self):
+        """Approximate memory of the digest index: the dict, the digests and the entry -> digest and free lists"""
+        digest_size = sys.getsizeof(self.keys[0])
+        return (sys.getsizeof(self.index) + len(self.index) * digest_size
+                + sys.getsizeof(self.keys) + sys.getsizeof(self.free))
+
+    def summary(self):
+        # Against storing every reference as a packed row: the pool rows (allocated capacity included),
+        # the reference counts, the digest index and the int32 id of every reference
+        cost = self.nbytes + self.index_nbytes + 4 * self.references
+        saved = self.references * self.row_size - cost
+        return (f'dedup {self.references} obs -> {self.unique} unique ({self.dedup_ratio:.2f}x), '
+                f'saved {saved / 2**20:.1f} MB')
+
+
+class DedupObsArray:
+    """
+    Array-like storage of observations as ids into a DedupPool.
+
+    Supports the same indexing as PackedObsArray (assignments encode, reads decode to float32),
+    so replay buffers can use it as a drop-in replacement. Assigning over a position releases the
+    observation it referenced. Several arrays can share one pool, e.g. all episodes of a buffer.
+    """
+    def __init__(self, shape, obs_shape=None, pool=None):
+        """
+        Args:
+            shape: leading shape of the storage, e.g. (capacity, n_agents)
+            obs_shape: shape of a single observation (H, W, C), only needed without a pool
+            pool: DedupPool to store the observations in, a new one if None
+        """
+        self.pool = pool if pool is not None else DedupPool(obs_shape)
+        self.shape = (*shape, *self.pool.codec.obs_shape)
+        # -1 marks positions that were never written, they read as zero observations
+        self.ids = np.full(shape, -1, dtype=np.int32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __setitem__(self, key, obs):
+        self.set_encoded(key, *self.pool.codec.encode(obs))
+
+    def set_encoded(self, key, bits, hp):
+        """Assign observations given in ObsCodec encoding"""
+        old = np.array(self.ids[key])
+        new = np.broadcast_to(self.pool.intern(bits, hp), old.shape)
+        # Take the new references before releasing the old ones, they may be the same entries
+        self.pool.acquire(new)
+        self.ids[key] = new
+        self.pool.release(old[old >= 0])
+
+    def __getitem__(self, key):
+        return self.pool.get(np.maximum(self.ids[key], 0))
+
+    def encoded(self, key):
+        """Return the (bits, hp) ObsCodec encoding of the indexed observations"""
+        ids = np.maximum(self.ids[key], 0)
+        return self.pool.bits[ids], self.pool.hp[ids]
+
+    def to_packed(self):
+        """Copy the observations into a standalone PackedObsArray"""
+        packed = PackedObsArray(self.ids.shape, self.pool.codec.obs_shape, codec=self.pool.codec)
+        packed.bits[...], packed.hp[...] = self.encoded(...)
+        return packed
+
+    def release(self):
+        """Release every observation of the array, e.g. when its episode leaves the buffer"""
+        self.pool.release(self.ids[self.ids >= 0])
+        self.ids[...] = -1
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes
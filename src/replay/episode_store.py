@@ -0,0 +1,104 @@
+import glob
+import io
+import os
+from collections import OrderedDict
+
+from src.replay.snapshot import episode_arrays, episode_from_arrays, load_arrays, write_arrays
+
+
+class CompressedEpisodeStore:
+    """
+    Finished episodes compressed into standalone blobs, with an LRU cache of decompressed episodes.
+
+    Every episode is serialized with episode_arrays and deflated into one .npz blob, kept in memory or
+    written to a file per episode in `directory`. Packed observations are mostly zero bits and compress
+    well, so many more episodes fit in the same footprint than as packed arrays, at the cost of
+    decompressing an episode when it is sampled and not in the cache. Episodes are never modified once
+    stored, so cached episodes are shared with the caller and must not be mutated.
+    """
+    def __init__(self, directory=None, compresslevel=1, cache_size=16):
+        """
+        Args:
+            directory: directory to spill the blobs to, None to keep them in memory
+            compresslevel: deflate level of the blobs
+            cache_size: number of decompressed episodes kept for sampling
+        """
+        self.directory = directory
+        self.compresslevel = compresslevel
+        self.cache_size = cache_size
+        self.blobs = {}  # key -> compressed bytes, or file size when spilled to disk
+        self.cache = OrderedDict()
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            # Blobs are only valid within a run, resumed runs restore episodes from snapshots
+            for stale in glob.glob(os.path.join(directory, 'episode*.npz')):
+                os.remove(stale)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'episode{key:08d}.npz')
+
+    def _remember(self, key, episode):
+        self.cache[key] = episode
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def put(self, episode):
+        """
+        Compress and store an episode dict.
+
+        Returns:
+            key of the episode
+        """
+        key = self.next_key
+        self.next_key += 1
+        blob = io.BytesIO()
+        write_arrays(blob, episode_arrays(episode), self.compresslevel)
+        if self.directory is None:
+            self.blobs[key] = blob.getvalue()
+        else:
+            with open(self._path(key), 'wb') as f:
+                f.write(blob.getbuffer())
+            self.blobs[key] = blob.tell()
+        # The newest episode is likely to be sampled soon
+        self._remember(key, episode)
+        return key
+
+    def get(self, key):
+        """Return the episode dict of key, decompressed unless it is in the cache"""
+        episode = self.cache.get(key)
+        if episode is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return episode
+        self.misses += 1
+        if self.directory is None:
+            episode = episode_from_arrays(load_arrays(io.BytesIO(self.blobs[key])))
+        else:
+            episode = episode_from_arrays(load_arrays(self._path(key)))
+        self._remember(key, episode)
+        return episode
+
+    def discard(self, key):
+        """Drop an episode, e.g. when its replay slot is overwritten"""
+        del self.blobs[key]
+        self.cache.pop(key, None)
+        if self.directory is not None:
+            os.remove(self._path(key))
+
+    def __len__(self):
+        return len(self.blobs)
+
+    @property
+    def nbytes(self):
+        """Total size of the compressed blobs"""
+        return sum(len(blob) if isinstance(blob, bytes) else blob for blob in self.blobs.values())
+
+    def summary(self):
+        lookups = max(self.hits + self.misses, 1)
+        where = 'memory' if self.directory is None else self.directory
+        return (f'{len(self)} episodes, {self.nbytes / 2**20:.1f} MB compressed in {where}, '
+                f'cache {len(self.cache)}/{self.cache_size} hit rate {self.hits / lookups:.0%}')
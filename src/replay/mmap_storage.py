@@ -0,0 +1,112 @@
+import glob
+import mmap
+import os
+import numpy as np
+
+
+class SegmentedArray:
+    """
+    Array split along its first axis into fixed-size memory-mapped segment files.
+
+    Segment files are created on first write, so disk usage grows with the data actually stored,
+    and reads only touch the pages they gather; the OS page cache holds the working set.
+    Supports integer, slice and integer-array indexing along the first axis.
+    """
+    def __init__(self, directory, name, shape, dtype, segment_slots):
+        self.directory = directory
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.segment_slots = segment_slots
+        self.num_segments = (self.shape[0] + segment_slots - 1) // segment_slots
+        self.segments = [None] * self.num_segments
+
+    def _segment(self, k, create):
+        if self.segments[k] is None:
+            path = os.path.join(self.directory, f'{self.name}_{k:05d}.bin')
+            exists = os.path.exists(path)
+            if not exists and not create:
+                return None
+            slots = min(self.segment_slots, self.shape[0] - k * self.segment_slots)
+            segment = np.memmap(path, dtype=self.dtype, mode='r+' if exists else 'w+', shape=(slots, *self.shape[1:]))
+            # Replay reads are random, read-ahead would only pollute the page cache
+            if hasattr(mmap, 'MADV_RANDOM'):
+                segment._mmap.madvise(mmap.MADV_RANDOM)
+            self.segments[k] = segment
+        return self.segments[k]
+
+    def _index(self, key):
+        if isinstance(key, slice):
+            return np.arange(*key.indices(self.shape[0]))
+        return np.asarray(key)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            k, offset = divmod(int(key), self.segment_slots)
+            segment = self._segment(k, create=False)
+            return segment[offset] if segment is not None else np.zeros(self.shape[1:], dtype=self.dtype)
+
+        index = self._index(key)
+        flat = index.ravel()
+        seg, offset = np.divmod(flat, self.segment_slots)
+        out = np.zeros((flat.size, *self.shape[1:]), dtype=self.dtype)
+        for k in np.unique(seg):
+            segment = self._segment(k, create=False)
+            if segment is not None:
+                mask = seg == k
+                out[mask] = segment[offset[mask]]
+        return out.reshape(*index.shape, *self.shape[1:])
+
+    def __setitem__(self, key, value):
+        if isinstance(key, (int, np.integer)):
+            k, offset = divmod(int(key), self.segment_slots)
+            self._segment(k, create=True)[offset] = value
+            return
+
+        index = self._index(key)
+        flat = index.ravel()
+        value = np.broadcast_to(value, (*index.shape, *self.shape[1:])).reshape(flat.size, *self.shape[1:])
+        seg, offset = np.divmod(flat, self.segment_slots)
+        for k in np.unique(seg):
+            mask = seg == k
+            self._segment(k, create=True)[offset[mask]] = value[mask]
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def flush(self):
+        for segment in self.segments:
+            if segment is not None:
+                segment.flush()
+
+
+class MmapAllocator:
+    """
+    Allocator (shape, dtype) -> SegmentedArray storing arrays in segment files under `directory`.
+
+    Arrays are named in allocation order, so a buffer allocating the same fields in the same order
+    maps onto the same files.
+    """
+    def __init__(self, directory, segment_slots=4096):
+        self.directory = directory
+        self.segment_slots = segment_slots
+        self.arrays = []
+        os.makedirs(directory, exist_ok=True)
+
+    def clear(self):
+        """Remove segment files left in the directory by a previous allocator"""
+        for path in glob.glob(os.path.join(self.directory, 'array*_*.bin')):
+            os.remove(path)
+
+    def __call__(self, shape, dtype):
+        array = SegmentedArray(self.directory, f'array{len(self.arrays):02d}', shape, dtype, self.segment_slots)
+        self.arrays.append(array)
+        return array
+
+    def flush(self):
+        for array in self.arrays:
+            array.flush()
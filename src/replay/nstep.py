@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def n_step_returns(rewards, dones, n, gamma):
+    """
+    Truncated n-step discounted returns of an episode (or of the staged tail of one), for all agents at once.
+
+    The return of step t sums the rewards of steps t..t+h-1, where the horizon h = min(n, T - t) stops at
+    the end of the given steps, and the rewards of an agent stop after its done step. The n-step target
+    is then returns[t] + discounts[t] * max_a Q(s_{t+h}, a), with discounts[t] = gamma^h, zeroed for agents
+    done within the horizon.
+
+    Args:
+        rewards: [T, n_agents]
+        dones: [T, n_agents], done of the transition of every step
+        n: maximum horizon
+        gamma: discount factor
+
+    Returns:
+        returns: [T, n_agents] (float32)
+        discounts: [T, n_agents] (float32)
+        horizons: [T] (int64), the bootstrap state of step t is the state of step t + horizons[t]
+    """
+    rewards = np.asarray(rewards, dtype=np.float32)
+    continues = 1 - np.asarray(dones, dtype=np.float32)
+    length = len(rewards)
+    returns = np.zeros_like(rewards)
+    alive = np.ones_like(rewards)  # agents not done before step t + k
+    discount = 1.0
+    for k in range(n):
+        # Rows t with t + k inside the steps, the others have reached their horizon
+        rows = length - k
+        if rows <= 0:
+            break
+        returns[:rows] += discount * alive[:rows] * rewards[k:]
+        alive[:rows] *= continues[k:]
+        discount *= gamma
+    horizons = np.minimum(n, length - np.arange(length))
+    discounts = (gamma ** horizons.astype(np.float32))[:, None] * alive
+    return returns, discounts.astype(np.float32), horizons
@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+import numpy as np
+import torch
+
+
+class _Slot:
+    """Reusable host staging tensors for one in-flight batch"""
+    def __init__(self):
+        self.staging = []
+        self.event = None
+
+    def stage(self, i, array, pin_memory):
+        """Copy `array` into the i-th staging tensor, growing it only when it is too small"""
+        array = np.ascontiguousarray(array)
+        source = torch.from_numpy(array)
+        if i == len(self.staging):
+            self.staging.append(None)
+        buffer = self.staging[i]
+        if buffer is None or buffer.dtype != source.dtype or buffer.numel() < source.numel():
+            buffer = torch.empty(source.numel(), dtype=source.dtype, pin_memory=pin_memory)
+            self.staging[i] = buffer
+        view = buffer[:source.numel()].view(source.shape)
+        view.copy_(source)
+        return view
+
+
+class BatchPrefetcher:
+    """
+    Prepares replay batches on a background thread while the learner computes.
+
+    `sample_fn` returns a tuple of numpy arrays (other items, e.g. hidden state tensors, are passed
+    through). Each array is copied into reusable, pinned host tensors and sent to `device`,
+    on CUDA with a non-blocking copy on a side stream. At most `depth` batches are prepared ahead,
+    so the learner only waits when sampling is slower than its own step.
+
+    On CPU the returned tensors are the staging tensors themselves: a batch stays valid until
+    the next one is fetched.
+    """
+    def __init__(self, sample_fn, num_batches=None, depth=2, device=None, lock=None):
+        """
+        Args:
+            sample_fn: callable () -> tuple of arrays, called on the background thread
+            num_batches: number of batches to produce, None for an endless stream
+            depth: maximum number of batches prepared ahead
+            device: device of the returned tensors
+            lock: optional lock held around sample_fn, shared with the writers of the buffer
+        """
+        self.sample_fn = sample_fn
+        self.num_batches = num_batches
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.lock = lock
+        self.depth = depth
+        self.pin_memory = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.pin_memory else None
+
+        # One extra slot is held by the learner while `depth` others are being filled
+        self.free = queue.Queue()
+        for _ in range(depth + 1):
+            self.free.put(_Slot())
+        self.ready = queue.Queue()
+        self.current = None
+
+        self.produced = 0
+        self.consumed = 0
+        self.sample_time = 0.0  # background time spent sampling and staging
+        self.wait_time = 0.0    # learner time spent blocked on the queue
+        self.stopped = False
+        self.progress = threading.Condition()
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _transfer(self, slot, batch):
+        out = []
+        num_staged = 0
+        for item in batch:
+            if isinstance(item, np.ndarray):
+                item = slot.stage(num_staged, item, self.pin_memory)
+                num_staged += 1
+            out.append(item)
+        if self.stream is None:
+            return tuple(out)
+        with torch.cuda.stream(self.stream):
+            out = tuple(item.to(self.device, non_blocking=True) if isinstance(item, torch.Tensor) else item for item in out)
+            slot.event = torch.cuda.Event()
+            slot.event.record(self.stream)
+        return out
+
+    def _run(self):
+        try:
+            self._produce()
+        finally:
+            # Wake up wait_ahead when the thread stops
+            with self.progress:
+                self.finished = True
+                self.progress.notify_all()
+
+    def _produce(self):
+        while self.num_batches is None or self.produced < self.num_batches:
+            slot = self.free.get()
+            if slot is None or self.stopped:
+                return
+            # The previous copy out of this slot's staging tensors must be finished before reuse
+            if slot.event is not None:
+                slot.event.synchronize()
+            try:
+                start = time.perf_counter()
+                if self.lock is not None:
+                    with self.lock:
+                        batch = self.sample_fn()
+                else:
+                    batch = self.sample_fn()
+                batch = self._transfer(slot, batch)
+                self.sample_time += time.perf_counter() - start
+            except Exception as error:
+                self.ready.put((None, error))
+                return
+            self.ready.put((slot, batch))
+            with self.progress:
+                self.produced += 1
+                self.progress.notify_all()
+
+    def get(self):
+        """Return the next batch, blocking until it is ready"""
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+        if self.num_batches is not None and self.consumed >= self.num_batches:
+            raise StopIteration
+        start = time.perf_counter()
+        slot, batch = self.ready.get()
+        self.wait_time += time.perf_counter() - start
+        if slot is None:
+            raise batch
+        if slot.event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(slot.event)
+            # The tensors were allocated on the side stream but are used on the learner's stream
+            for item in batch:
+                if isinstance(item, torch.Tensor) and item.is_cuda:
+                    item.record_stream(stream)
+        self.current = slot
+        self.consumed += 1
+        return batch
+
+    def wait_ahead(self):
+        """
+        Block until the background thread has prepared all the batches it may prepare ahead (or stopped),
+        e.g. before the buffer is modified, so the prefetched batches never depend on thread timing
+        """
+        with self.progress:
+            self.progress.wait_for(lambda: self.finished or self.produced - self.consumed >= self.depth)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def stats(self):
+        """
+        Returns:
+            dict with the number of consumed batches, the background sampling time, the time the learner
+            waited and the overlap, the fraction of sampling time hidden behind the learner's compute
+        """
+        overlap = 1.0 - min(self.wait_time / self.sample_time, 1.0) if self.sample_time > 0 else 0.0
+        return {
+            'batches': self.consumed,
+            'sample_time': self.sample_time,
+            'wait_time': self.wait_time,
+            'overlap': overlap,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"Prefetch: {stats['batches']} batches, sampling {stats['sample_time']:.3f}s, "
+                f"waited {stats['wait_time']:.3f}s, overlap {100 * stats['overlap']:.0f}%")
+
+    def close(self):
+        """Stop the background thread"""
+        self.stopped = True
+        self.free.put(None)
+        self.thread.join()
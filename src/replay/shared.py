@@ -0,0 +1,278 @@
+import sys
+import uuid
+import numpy as np
+from multiprocessing import shared_memory
+
+from src.replay.codec import PackedObsArray
+
+# Cursor fields of a shard
+POSITION, COUNT, EPISODE_OPEN, SERIAL = range(4)
+
+
+class SharedMemoryAllocator:
+    """
+    Allocator (shape, dtype) -> numpy array backed by a named multiprocessing.shared_memory block.
+
+    Blocks are named `{prefix}_{n:02d}` in allocation order, so another process creating an allocator
+    with the same prefix and create=False attaches to the same arrays by allocating them in the same order.
+    """
+    def __init__(self, prefix, create=True):
+        self.prefix = prefix
+        self.create = create
+        self.blocks = []
+
+    def __call__(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        name = f'{self.prefix}_{len(self.blocks):02d}'
+        if self.create:
+            block = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+        else:
+            # Only the creator owns the block. Child processes started by multiprocessing share its
+            # resource tracker, where registering the same name again is a no-op
+            if sys.version_info >= (3, 13):
+                block = shared_memory.SharedMemory(name=name, track=False)
+            else:
+                block = shared_memory.SharedMemory(name=name)
+        self.blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        if self.create:
+            array.fill(0)
+        return array
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+        if self.create:
+            for block in self.blocks:
+                block.unlink()
+        self.blocks = []
+
+
+class ShardWriter:
+    """
+    Write handle of one shard of a SharedReplayBuffer.
+
+    Every actor process writes through its own shard, so writers never contend for a cursor.
+    Within a shard, frames are index-linked as in the VDN ReplayBuffer: next_state of the
+    transition in slot i is the frame in slot i+1, and end_episode() closes an episode with a
+    boundary slot that is done for every agent and carries no reward.
+    """
+    def __init__(self, buffer, shard):
+        self.buffer = buffer
+        self.shard = shard
+        self.base = shard * buffer.shard_slots
+        self.cursor = buffer.cursors[shard]
+
+    def _begin(self, i):
+        # Seqlock: an odd sequence number marks a slot being written
+        self.buffer.seq[i] += 1
+
+    def _commit(self, i):
+        self.buffer.seq[i] += 1
+
+    def _write_slot(self, action, reward, done, boundary, state=None):
+        buffer, cursor = self.buffer, self.cursor
+        i = self.base + cursor[POSITION]
+        self._begin(i)
+        if state is not None:
+            buffer.states[i] = state
+        buffer.actions[i] = action
+        buffer.rewards[i] = reward
+        buffer.dones[i] = done
+        buffer.boundary[i] = boundary
+        buffer.stamps[i] = cursor[SERIAL]
+        self._commit(i)
+        # Publish the slot only after its content is written
+        cursor[SERIAL] += 1
+        cursor[POSITION] = (cursor[POSITION] + 1) % buffer.shard_slots
+        cursor[COUNT] = min(cursor[COUNT] + 1, buffer.shard_capacity)
+
+    def put(self, transition):
+        """
+        Add a transition to the shard.
+
+        Args:
+            transition: tuple of (state, action, reward, next_state, done)
+        """
+        s, a, r, s_prime, done = transition
+        self._write_slot(a, r, done, False, state=s)
+
+        # The next state goes into the following slot, which is not sampled until it is committed
+        # by the next put of the episode or by end_episode()
+        i = self.base + self.cursor[POSITION]
+        self._begin(i)
+        self.buffer.states[i] = s_prime
+        # Break the stamp sequence: a reader holding an older cursor may still see this slot as the oldest
+        # transition of the shard, and must not pair the new frame with the old slot content
+        self.buffer.stamps[i] = -1
+        self._commit(i)
+        self.cursor[EPISODE_OPEN] = 1
+
+    def end_episode(self):
+        """Close the current episode, keeping the next state of its last transition"""
+        if not self.cursor[EPISODE_OPEN]:
+            return
+        self._write_slot(0, 0, True, True)
+        self.cursor[EPISODE_OPEN] = 0
+
+
+class SharedReplayBuffer:
+    """
+    Replay buffer of team transitions in shared memory, written concurrently by several actor processes.
+
+    The storage is split into one ring shard per writer, each with its own cursor, so writes need no locks.
+    The learner samples chunks from any shard and validates them without blocking the writers:
+    - a per-slot seqlock rejects slots that were being written while they were gathered,
+    - per-slot insertion stamps reject chunks whose slots are not consecutive transitions of one shard,
+      which happens when a writer laps the chunk between reading the cursor and gathering it.
+    Rejected rows are resampled.
+
+    The buffer can be passed to child processes (it pickles to the shared-memory names) and each
+    process writes through writer(k) with its own k.
+    """
+    def __init__(self, buffer_limit, num_agents, obs_shape, num_writers=1, compact_obs=True, name=None):
+        """
+        Args:
+            buffer_limit: maximum number of transitions over all shards
+            num_agents: number of agents per transition
+            obs_shape: shape of a single agent observation
+            num_writers: number of shards, one per writer process
+            compact_obs: store observations bit-packed with ObsCodec instead of float32
+            name: prefix of the shared-memory blocks, random if None
+        """
+        self.buffer_limit = buffer_limit
+        self.num_agents = num_agents
+        self.obs_shape = tuple(obs_shape)
+        self.num_writers = num_writers
+        self.compact_obs = compact_obs
+        self.name = name if name is not None else f'replay_{uuid.uuid4().hex[:12]}'
+        self.shard_capacity = -(-buffer_limit // num_writers)
+        # One spare slot per shard always holds the next state of its newest transition
+        self.shard_slots = self.shard_capacity + 1
+        self._attach(create=True)
+
+    def _attach(self, create):
+        self.allocator = SharedMemoryAllocator(self.name, create=create)
+        num_slots = self.num_writers * self.shard_slots
+        if self.compact_obs:
+            self.states = PackedObsArray((num_slots, self.num_agents), self.obs_shape, allocator=self.allocator)
+        else:
+            self.states = self.allocator((num_slots, self.num_agents, *self.obs_shape), np.float32)
+        self.actions = self.allocator((num_slots, self.num_agents), np.int8)
+        self.rewards = self.allocator((num_slots, self.num_agents), np.float32)
+        self.dones = self.allocator((num_slots, self.num_agents), bool)
+        self.boundary = self.allocator((num_slots,), bool)
+        self.seq = self.allocator((num_slots,), np.int64)
+        self.stamps = self.allocator((num_slots,), np.int64)
+        self.cursors = self.allocator((self.num_writers, 4), np.int64)
+
+    def __getstate__(self):
+        # Only the configuration is pickled, the receiving process attaches to the shared memory by name
+        return {key: self.__dict__[key] for key in ('buffer_limit', 'num_agents', 'obs_shape', 'num_writers',
+                                                     'compact_obs', 'name', 'shard_capacity', 'shard_slots')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach(create=False)
+
+    def writer(self, shard):
+        return ShardWriter(self, shard)
+
+    def put(self, transition):
+        """Add a transition through shard 0, for single-process use"""
+        self.writer(0).put(transition)
+
+    def end_episode(self):
+        self.writer(0).end_episode()
+
+    def size(self):
+        return int(self.cursors[:, COUNT].sum())
+
+    def _draw(self, batch_size, chunk_size):
+        """Draw chunk slot indices [batch_size, chunk_size + 1] from the current shard cursors"""
+        cursors = self.cursors.copy()
+        valid_starts = np.maximum(cursors[:, COUNT] - chunk_size, 0)
+        if valid_starts.sum() == 0:
+            raise ValueError('Not enough transitions in the buffer to sample a chunk.')
+        # Every valid chunk start is equally likely, across all shards
+        shards = np.random.choice(self.num_writers, batch_size, p=valid_starts / valid_starts.sum())
+        start_idx = (np.random.random(batch_size) * valid_starts[shards]).astype(np.int64)
+        oldest = (cursors[shards, POSITION] - cursors[shards, COUNT]) % self.shard_slots
+        offsets = (oldest + start_idx)[:, None] + np.arange(chunk_size + 1)
+        return shards[:, None] * self.shard_slots + offsets % self.shard_slots
+
+    def sample_chunk_arrays(self, batch_size, chunk_size, max_retries=100):
+        """
+        Sample a batch of chunk_size transitions as numpy arrays.
+
+        Returns:
+            frames: [batch_size, chunk_size + 1, n_agents, ...obs_shape], states are frames[:, :-1]
+                and next states frames[:, 1:]
+            actions: [batch_size, chunk_size, n_agents] (int8)
+            rewards: [batch_size, chunk_size, n_agents]
+            dones: [batch_size, chunk_size, n_agents] (bool)
+        """
+        frames = np.empty((batch_size, chunk_size + 1, self.num_agents, *self.obs_shape), dtype=np.float32)
+        actions = np.empty((batch_size, chunk_size, self.num_agents), dtype=np.int8)
+        rewards = np.empty((batch_size, chunk_size, self.num_agents), dtype=np.float32)
+        dones = np.empty((batch_size, chunk_size, self.num_agents), dtype=bool)
+
+        missing = np.arange(batch_size)
+        for _ in range(max_retries):
+            idx = self._draw(len(missing), chunk_size)
+            before = self.seq[idx]
+            stamps = self.stamps[idx]
+            # Copy the raw bytes inside the seqlock window and decode only the rows that pass
+            if self.compact_obs:
+                chunk_frames = (self.states.bits[idx], self.states.hp[idx])
+            else:
+                chunk_frames = self.states[idx]
+            chunk_actions = self.actions[idx[:, :-1]]
+            chunk_rewards = self.rewards[idx[:, :-1]]
+            chunk_dones = self.dones[idx[:, :-1]]
+            after = self.seq[idx]
+
+            ok = ((before == after) & (before % 2 == 0)).all(axis=1)
+            ok &= (np.diff(stamps, axis=1) == 1).all(axis=1)
+            rows = missing[ok]
+            if self.compact_obs:
+                frames[rows] = self.states.codec.decode(chunk_frames[0][ok], chunk_frames[1][ok])
+            else:
+                frames[rows] = chunk_frames[ok]
+            actions[rows] = chunk_actions[ok]
+            rewards[rows] = chunk_rewards[ok]
+            dones[rows] = chunk_dones[ok]
+            missing = missing[~ok]
+            if len(missing) == 0:
+                return frames, actions, rewards, dones
+        raise RuntimeError(f'Could not sample {len(missing)} consistent chunks in {max_retries} attempts.')
+
+    def sample_chunk(self, batch_size, chunk_size):
+        """
+        Sample a batch of chunk_size transitions, with the same layout as the VDN ReplayBuffer.
+
+        Returns:
+            tuple of CPU tensors (states, actions, rewards, next_states, dones), their shapes are respectively:
+            [batch_size, chunk_size, n_agents, ...obs_shape],
+            [batch_size, chunk_size, n_agents],
+            [batch_size, chunk_size, n_agents],
+            [batch_size, chunk_size, n_agents, ...obs_shape],
+            [batch_size, chunk_size, n_agents]
+        """
+        # Writer processes only need numpy, torch is imported by the learner when it samples tensors
+        import torch
+
+        frames, actions, rewards, dones = self.sample_chunk_arrays(batch_size, chunk_size)
+        frames = torch.from_numpy(frames)
+        return (
+            frames[:, :-1],
+            torch.from_numpy(actions).float(),
+            torch.from_numpy(rewards),
+            frames[:, 1:],
+            torch.from_numpy(dones).float()
+        )
+
+    def close(self):
+        """Release the shared memory, the creating process also unlinks it"""
+        self.allocator.close()
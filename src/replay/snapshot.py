@@ -0,0 +1,345 @@
+import abc
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+from src.replay.codec import PackedObsArray
+from src.replay.dedup import DedupObsArray
+
+MANIFEST = 'manifest.json'
+
+
+def write_arrays(file, arrays, compresslevel=1):
+    """
+    Write named arrays in compressed .npz format, readable with np.load.
+
+    Like np.savez_compressed but with a configurable (by default fast) deflate level.
+
+    Args:
+        file: path or writable binary file object
+    """
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as archive:
+        for name, array in arrays.items():
+            with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asarray(array), allow_pickle=False)
+
+
+def save_arrays(path, arrays, compresslevel=1):
+    """
+    Write named arrays to a compressed .npz file, see write_arrays.
+
+    The file is written under a temporary name and renamed so a crash never leaves a partial file behind.
+    """
+    tmp_path = path + '.tmp'
+    write_arrays(tmp_path, arrays, compresslevel)
+    os.replace(tmp_path, path)
+
+
+def load_arrays(file):
+    with np.load(file, allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def episode_arrays(episode):
+    """
+    Convert a stored episode dict (tensors, packed observations, ints and arrays) to named arrays.
+
+    The kind of every value is kept as a suffix of its name so episode_from_arrays can rebuild it.
+    Deduplicated observations are converted to packed observations.
+    """
+    arrays = {}
+    for key, value in episode.items():
+        if isinstance(value, DedupObsArray):
+            value = value.to_packed()
+        if isinstance(value, torch.Tensor):
+            arrays[key + '.tensor'] = value.detach().cpu().numpy()
+        elif isinstance(value, PackedObsArray):
+            arrays[key + '.bits'] = value.bits
+            arrays[key + '.hp'] = value.hp
+            arrays[key + '.obs_shape'] = np.array(value.codec.obs_shape)
+        elif isinstance(value, (int, np.integer)):
+            arrays[key + '.int'] = np.array(value)
+        else:
+            arrays[key + '.array'] = np.asarray(value)
+    return arrays
+
+
+def episode_from_arrays(arrays):
+    """Rebuild an episode dict from the output of episode_arrays"""
+    episode = {}
+    for name, array in arrays.items():
+        key, kind = name.rsplit('.', 1)
+        if kind == 'tensor':
+            episode[key] = torch.from_numpy(array)
+        elif kind == 'int':
+            episode[key] = int(array)
+        elif kind == 'bits':
+            episode[key] = PackedObsArray(array.shape[:-1], arrays[key + '.obs_shape'])
+            episode[key].bits[...] = array
+            episode[key].hp[...] = arrays[key + '.hp']
+        elif kind == 'array':
+            episode[key] = array
+    return episode
+
+
+class _Snapshotter(abc.ABC):
+    """
+    Incremental snapshots of a replay buffer, written on a background thread.
+
+    The buffer is split into chunks. snapshot() copies the chunks written since the previous snapshot
+    on the calling thread (a memory copy), and a background thread compresses them into one file per chunk
+    and then atomically writes the manifest. The manifest maps every chunk to its latest file
+    and stores the buffer cursors, so an interrupted snapshot leaves the previous one intact.
+
+    Snapshots can be written under their own manifest name (e.g. one per checkpoint) and restored by name.
+    Chunk files are shared between manifests and removed once no manifest refers to them.
+    """
+    def __init__(self, buffer, directory, compresslevel=1, num_workers=4):
+        """
+        Args:
+            buffer: replay buffer to snapshot and restore
+            directory: directory of the snapshot files
+            compresslevel: deflate level of the chunk files
+            num_workers: number of threads decompressing chunk files on restore
+        """
+        self.buffer = buffer
+        self.directory = directory
+        self.compresslevel = compresslevel
+        self.num_workers = num_workers
+        os.makedirs(directory, exist_ok=True)
+        self.generation = 0
+        self.files = {}  # chunk -> file name in the last written manifest
+        self.jobs = queue.Queue(maxsize=1)
+        self.busy = threading.Lock()
+        self.error = None
+        self.last_duration = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @abc.abstractmethod
+    def _current_marker(self):
+        """Return the marker of the current state of the buffer, compared by _dirty to the previous one"""
+
+    @abc.abstractmethod
+    def _dirty(self):
+        """Return the chunks written since the previous snapshot and the marker of the current state"""
+
+    @abc.abstractmethod
+    def _copy_chunk(self, chunk):
+        """Return a dict of arrays holding a copy of the chunk, taken on the calling thread"""
+
+    @abc.abstractmethod
+    def _apply_chunk(self, chunk, arrays):
+        """Write the arrays of a chunk file back into the buffer"""
+
+    def snapshot(self, block=False, name=MANIFEST):
+        """
+        Start an incremental snapshot.
+
+        Args:
+            block: wait for the previous snapshot to finish instead of skipping this one
+            name: file name of the manifest, an existing manifest of that name is replaced
+
+        Returns:
+            True if a snapshot was started, False if the previous one is still being written
+            (its dirty chunks are then included in the next snapshot)
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        if not self.busy.acquire(blocking=block):
+            return False
+        chunks, marker = self._dirty()
+        state = self.buffer.state_dict()
+        copies = {chunk: self._copy_chunk(chunk) for chunk in chunks}
+        self.jobs.put((copies, state, marker, name))
+        return True
+
+    def _run(self):
+        while True:
+            copies, state, marker, name = self.jobs.get()
+            try:
+                start = time.time()
+                self._write(copies, state, name)
+                self.marker = marker
+                self.last_duration = time.time() - start
+            except Exception as error:
+                self.error = error
+            finally:
+                self.busy.release()
+
+    def _write(self, copies, state, name=MANIFEST):
+        generation = self.generation + 1
+        files = dict(self.files)
+        for chunk, arrays in copies.items():
+            file_name = f'chunk{chunk:06d}_{generation:06d}.npz'
+            save_arrays(os.path.join(self.directory, file_name), arrays, self.compresslevel)
+            files[chunk] = file_name
+
+        manifest = {'generation': generation, 'state': state, 'files': {str(k): v for k, v in files.items()}}
+        tmp_path = os.path.join(self.directory, name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        self.generation, self.files = generation, files
+        # Files replaced by this snapshot are removed unless another manifest still refers to them
+        self._collect()
+
+    def _manifests(self):
+        """Return the manifests in the directory, by file name"""
+        manifests = {}
+        for path in glob.glob(os.path.join(self.directory, 'manifest*.json')):
+            with open(path) as f:
+                manifests[os.path.basename(path)] = json.load(f)
+        return manifests
+
+    def _collect(self):
+        """Remove the chunk files no manifest refers to, including those of interrupted snapshots"""
+        referenced = set()
+        for manifest in self._manifests().values():
+            referenced.update(manifest['files'].values())
+        for path in glob.glob(os.path.join(self.directory, 'chunk*.npz*')):
+            if os.path.basename(path) not in referenced:
+                os.remove(path)
+
+    def prune(self, keep):
+        """
+        Remove the manifests whose name is not in keep and the chunk files left unreferenced.
+
+        Args:
+            keep: names of the manifests to keep
+        """
+        with self.busy:
+            for name in self._manifests():
+                if name not in keep:
+                    os.remove(os.path.join(self.directory, name))
+            self._collect()
+
+    def wait(self):
+        """Block until the snapshot in progress is written"""
+        with self.busy:
+            pass
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def restore(self, name=MANIFEST):
+        """
+        Load a snapshot into the buffer.
+
+        Args:
+            name: file name of the manifest of the snapshot
+
+        Returns:
+            True if the snapshot was found and restored
+        """
+        manifests = self._manifests()
+        if name not in manifests:
+            return False
+        manifest = manifests[name]
+        files = {int(k): v for k, v in manifest['files'].items()}
+        # Remove files of snapshots that were interrupted before their manifest was written
+        self._collect()
+
+        self.buffer.load_state_dict(manifest['state'])
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            loaded = pool.map(lambda item: (item[0], load_arrays(os.path.join(self.directory, item[1]))),
+                              files.items())
+            for chunk, arrays in loaded:
+                self._apply_chunk(chunk, arrays)
+        # Later snapshots continue after every generation on disk, so their file names are new
+        self.generation = max(other['generation'] for other in manifests.values())
+        self.files = files
+        self.marker = self._current_marker()
+        return True
+
+
+class RingSnapshotter(_Snapshotter):
+    """
+    Snapshots of a ring replay buffer with preallocated storage, such as the VDN ReplayBuffer.
+
+    The buffer provides read_slots(start, end) / write_slots(start, arrays) to copy a block of slots
+    out of and back into its storage, state_dict()/load_state_dict() for its cursors, `states`
+    (None before the first write), `num_slots`, `position` and `steps`, the number of slots written so far.
+    A chunk is a block of `chunk_slots` consecutive slots.
+    """
+    def __init__(self, buffer, directory, chunk_slots=1024, **kwargs):
+        self.chunk_slots = chunk_slots
+        self.marker = (0, 0)  # (position, steps) at the previous snapshot
+        super().__init__(buffer, directory, **kwargs)
+
+    def _current_marker(self):
+        return self.buffer.position, self.buffer.steps
+
+    def _dirty(self):
+        position, steps = self.marker
+        marker = self._current_marker()
+        num_slots = self.buffer.num_slots
+        num_chunks = -(-num_slots // self.chunk_slots)
+        if self.buffer.states is None:
+            return [], marker
+        if marker[1] - steps >= num_slots:
+            return list(range(num_chunks)), marker
+        # Slots from the previous position up to and including the current one, which holds
+        # the next state of the newest transition
+        slots = (position + np.arange(marker[1] - steps + 1)) % num_slots
+        return sorted(set((slots // self.chunk_slots).tolist())), marker
+
+    def _copy_chunk(self, chunk):
+        start = chunk * self.chunk_slots
+        return self.buffer.read_slots(start, min(start + self.chunk_slots, self.buffer.num_slots))
+
+    def _apply_chunk(self, chunk, arrays):
+        self.buffer.write_slots(chunk * self.chunk_slots, arrays)
+
+
+class EpisodeSnapshotter(_Snapshotter):
+    """
+    Snapshots of an episode replay buffer, such as ReplayBufferGRU and the QMIX ReplayBuffer.
+
+    The buffer provides get_episode(index) / set_episode(index, episode), `capacity`, `position`,
+    `stored`, the number of episodes stored so far, and state_dict()/load_state_dict().
+    A chunk is one episode slot. Episodes are never modified once stored, so they are serialized
+    on the background thread.
+    """
+    def __init__(self, buffer, directory, **kwargs):
+        self.marker = 0  # episodes stored at the previous snapshot
+        super().__init__(buffer, directory, **kwargs)
+
+    def _current_marker(self):
+        return self.buffer.stored
+
+    def _dirty(self):
+        marker = self._current_marker()
+        new = min(marker - self.marker, self.buffer.capacity)
+        slots = (self.buffer.position - 1 - np.arange(new)) % self.buffer.capacity
+        return sorted(slots.tolist()), marker
+
+    def _copy_chunk(self, chunk):
+        # The episode dict is replaced, not mutated, when its slot is overwritten. Deduplicated observations
+        # live in a pool that keeps changing, so they are copied out now (and restored without dedup)
+        episode = {key: value.to_packed() if isinstance(value, DedupObsArray) else value
+                   for key, value in self.buffer.get_episode(chunk).items()}
+        return _LazyEpisode(episode)
+
+    def _write(self, copies, state, name=MANIFEST):
+        super()._write({chunk: episode.arrays() for chunk, episode in copies.items()}, state, name)
+
+    def _apply_chunk(self, chunk, arrays):
+        self.buffer.set_episode(chunk, episode_from_arrays(arrays))
+
+
+class _LazyEpisode:
+    """Reference to a stored episode, converted to arrays on the background thread"""
+    def __init__(self, episode):
+        self.episode = episode
+
+    def arrays(self):
+        return episode_arrays(self.episode)
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class SumTree:
+    """
+    Array-based sum tree over `capacity` non-negative priorities.
+
+    Node k has children 2k and 2k+1, leaves live at [size, 2*size) where size is capacity rounded up
+    to a power of two. Batched updates and prefix-sum sampling walk the log2(size) levels once,
+    vectorized over the whole batch.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 1 << max(int(np.ceil(np.log2(max(capacity, 1)))), 0)
+        self.depth = int(np.log2(self.size))
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+        self.max_priority = 1.0
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, priorities):
+        """
+        Set the priorities of the given leaves and refresh their ancestors.
+
+        Args:
+            indices: int array [batch] of leaf indices in [0, capacity)
+            priorities: array [batch] of new priorities
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
+        nodes = indices + self.size
+        self.tree[nodes] = priorities
+        if priorities.size:
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+        for _ in range(self.depth):
+            # Duplicate parents simply write the same sum twice
+            nodes >>= 1
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def get(self, indices):
+        return self.tree[np.asarray(indices, dtype=np.int64) + self.size]
+
+    def find(self, values):
+        """
+        Find the leaves whose prefix-sum interval contains each value.
+
+        Args:
+            values: array [batch] of values in [0, total)
+
+        Returns:
+            int array [batch] of leaf indices
+        """
+        values = np.asarray(values, dtype=np.float64).copy()
+        nodes = np.ones(values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            nodes <<= 1
+            left = self.tree[nodes]
+            # Never descend into an empty subtree because of float rounding near the boundary
+            go_right = (values >= left) & (self.tree[nodes + 1] > 0)
+            values -= left * go_right
+            nodes += go_right
+        return np.minimum(nodes - self.size, self.capacity - 1)
+
+    def sample(self, batch_size, rng=np.random):
+        """
+        Sample leaves proportionally to their priority, one per stratified segment of the total.
+
+        Returns:
+            indices: int array [batch_size]
+            probabilities: array [batch_size] of sampling probabilities
+        """
+        bounds = np.linspace(0.0, self.total, batch_size + 1)
+        values = rng.uniform(bounds[:-1], bounds[1:])
+        indices = self.find(values)
+        return indices, self.get(indices) / self.total
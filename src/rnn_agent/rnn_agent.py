@@ -8,6 +8,12 @@ import torch.nn.functional as F
 
 from torch.distributions import Categorical
 from src.cnn import CNNFeatureExtractor
+from src.replay.codec import pack_obs
+from src.replay.dedup import DedupObsArray, DedupPool
+from src.replay.augment import augment_batch
+from src.update_scheduler import UpdateScheduler
+from src.td_targets import following_step, td0_targets
+from src.train_step import TrainStep, make_optimizer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -17,44 +23,157 @@ class ReplayBufferGRU:
     initial input hidden state and output hidden state of GRU.
     And each sample contains the whole episode instead of a single step.
     'hidden_in' and 'hidden_out' are only the initial hidden state for each episode, for GRU initialization.
+    With compact_obs, observations are stored bit-packed (see src.replay.codec) and decoded at sample time.
+    Observations of an episode are kept once as T+1 frames: next_observation[t] is observation[t+1],
+    so only the last next_observation is appended and the next observations are sliced out at sample time.
+    Each episode is stored as contiguous arrays with its length, and sampling returns padded batches
+    together with a validity mask instead of cropping every episode to the shortest one.
+    With dedup_obs, all episodes store their frames in one content-addressed pool per frame shape
+    (see src.replay.dedup), so repeated observations across steps, agents and episodes are kept once.
+    With a store (see src.replay.episode_store), every episode is compressed once it is pushed
+    and decompressed when sampled, so the buffer can hold many more episodes.
 
     """
-    def __init__(self, capacity):
+    def __init__(self, capacity, compact_obs=True, dedup_obs=False, store=None):
+        if dedup_obs and store is not None:
+            raise ValueError('dedup_obs and a compressed episode store cannot be combined')
         self.capacity = capacity
+        self.compact_obs = compact_obs
+        self.dedup_obs = dedup_obs
+        self.store = store  # CompressedEpisodeStore, self.buffer then holds its keys
+        self.pools = {}  # frame shape -> DedupPool shared by all episodes
         self.buffer = []
         self.position = 0
+        self.stored = 0  # number of episodes stored so far, used by incremental snapshots
 
-    def push(self, hidden_in, hidden_out, observation, action, reward, next_observation):      
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(None)
-        self.buffer[self.position] = (
-            hidden_in, hidden_out, observation, action, reward, next_observation)
+    def _pack(self, frames):
+        if self.dedup_obs:
+            frames = np.asarray(frames)
+            obs_shape = frames.shape[-3:]
+            if obs_shape not in self.pools:
+                self.pools[obs_shape] = DedupPool(obs_shape)
+            packed = DedupObsArray(frames.shape[:-3], pool=self.pools[obs_shape])
+            packed[...] = frames
+            return packed
+        return pack_obs(frames) if self.compact_obs else np.stack(frames)
+
+    def _frames(self, observation, next_observation):
+        """Stack the T observations of an episode with its last next observation into T+1 frames"""
+        return self._pack(list(observation) + [next_observation[-1]])
+
+    def _episode(self, hidden_in, hidden_out, observation, action, reward, next_observation):
+        return {
+            'hidden_in': hidden_in,
+            'hidden_out': hidden_out,
+            'frames': self._frames(observation, next_observation),  # [T+1, n_agents, ...obs_shape]
+            'action': np.asarray(action, dtype=np.int64),  # [T, n_agents, action_shape]
+            'reward': np.asarray(reward, dtype=np.float32),  # [T, n_agents]
+            'length': len(observation),
+        }
+
+    def _store(self, episode):
+        self.set_episode(self.position, episode)
         self.position = int((self.position + 1) %
                             self.capacity)  # as a ring buffer
+        self.stored += 1
 
-    def sample(self, batch_size):
-        obs_lst, a_lst, r_lst, nobs_lst, hi_lst, ho_lst, = [], [], [], [], [], []
-        batch = random.sample(self.buffer, batch_size)
-        min_seq_len = float('inf')
-        for sample in batch:
-            h_in, h_out, observation, action, reward, next_observation = sample
-            min_seq_len = min(len(observation), min_seq_len)
-            hi_lst.append(h_in) # h_in: (1, batch_size=1, n_agents, hidden_size)
-            ho_lst.append(h_out)
-        hi_lst = torch.cat(hi_lst, dim=-3).detach()  # cat along the batch dim
-        ho_lst = torch.cat(ho_lst, dim=-3).detach()
-
-        # strip sequence length
-        for sample in batch:
-            h_in, h_out, observation, action, reward, next_observation = sample
-            sample_len = len(observation)
-            start_idx = int((sample_len - min_seq_len)/2)
-            end_idx = start_idx+min_seq_len
-            obs_lst.append(observation[start_idx:end_idx])
-            a_lst.append(action[start_idx:end_idx])
-            r_lst.append(reward[start_idx:end_idx])
-            nobs_lst.append(next_observation[start_idx:end_idx])
-        return hi_lst, ho_lst, obs_lst, a_lst, r_lst, nobs_lst
+    def get_episode(self, index):
+        entry = self.buffer[index]
+        return self.store.get(entry) if self.store is not None else entry
+
+    def set_episode(self, index, episode):
+        '''
+        Put an episode dict into slot `index`, replacing the episode stored there
+        '''
+        while len(self.buffer) <= index:
+            self.buffer.append(None)
+        old = self.buffer[index]
+        if self.store is not None:
+            if old is not None:
+                self.store.discard(old)
+            episode = self.store.put(episode)
+        elif old is not None:
+            # The overwritten episode drops its references to the shared observation pools
+            for value in old.values():
+                if isinstance(value, DedupObsArray):
+                    value.release()
+        self.buffer[index] = episode
+
+    def _sample_episodes(self, batch_size, rng=None):
+        if rng is None:
+            indices = random.sample(range(len(self.buffer)), batch_size)
+        else:
+            indices = rng.choice(len(self.buffer), batch_size, replace=False)
+        return [self.get_episode(index) for index in indices]
+
+    def push(self, hidden_in, hidden_out, observation, action, reward, next_observation):      
+        self._store(self._episode(hidden_in, hidden_out, observation, action, reward, next_observation))
+
+    @staticmethod
+    def _windows(batch, seq_len, rng=np.random):
+        """
+        Choose the sampled window of every episode.
+        @params:
+            seq_len: window length, None for full episodes padded to the longest one
+            rng: np.random or a np.random.RandomState, draws the window starts
+        @return:
+            starts: [#batch] first step of each window
+            lengths: [#batch] number of valid steps in each window
+            mask: [#batch, #sequence] 1 for valid steps, 0 for padding
+        """
+        episode_lengths = np.array([episode['length'] for episode in batch])
+        if seq_len is None:
+            seq_len = episode_lengths.max()
+            starts = np.zeros_like(episode_lengths)
+        else:
+            starts = rng.randint(0, np.maximum(episode_lengths - seq_len, 0) + 1)
+        lengths = np.minimum(episode_lengths - starts, seq_len)
+        mask = (np.arange(seq_len)[None, :] < lengths[:, None]).astype(np.float32)
+        return starts, lengths, mask
+
+    @staticmethod
+    def _gather(batch, key, starts, lengths, seq_len):
+        """Copy each episode window of `key` into a zero-padded [#batch, seq_len, ...] array"""
+        first = batch[0][key]
+        out = np.zeros((len(batch), seq_len, *first.shape[1:]), dtype=first.dtype)
+        for i, (episode, start, length) in enumerate(zip(batch, starts, lengths)):
+            out[i, :length] = episode[key][start:start+length]
+        return out
+
+    @staticmethod
+    def _gather_frames(batch, key, starts, lengths, seq_len):
+        """Decode each window of frames once into a zero-padded [#batch, seq_len + 1, ...] array holding
+        the current frames [:, :-1] and the next frames [:, 1:], see split_frames"""
+        first = batch[0][key]
+        frames = np.zeros((len(batch), seq_len + 1, *first.shape[1:]), dtype=np.float32)
+        for i, (episode, start, length) in enumerate(zip(batch, starts, lengths)):
+            frames[i, :length+1] = episode[key][start:start+length+1]
+        return frames
+
+    def sample(self, batch_size, seq_len=None, rng=None):
+        """
+        @params:
+            seq_len: length of the sampled windows, None to sample full episodes padded to the longest one.
+                A window that does not start at the beginning of its episode still uses the initial hidden states.
+            rng: np.random.RandomState drawing the episodes and windows, the global generators if None
+        @return:
+            hidden_in, hidden_out: [1, #batch, n_agents, hidden_size]
+            frames: [#batch, #sequence + 1, n_agents, ...obs_shape], observations and next observations
+                as one window, see split_frames
+            action: [#batch, #sequence, n_agents, action_shape]
+            reward: [#batch, #sequence, n_agents]
+            mask: [#batch, #sequence]
+        """
+        batch = self._sample_episodes(batch_size, rng)
+        hi_lst = torch.cat([episode['hidden_in'] for episode in batch], dim=-3).detach()  # cat along the batch dim
+        ho_lst = torch.cat([episode['hidden_out'] for episode in batch], dim=-3).detach()
+
+        starts, lengths, mask = self._windows(batch, seq_len, np.random if rng is None else rng)
+        seq_len = mask.shape[1]
+        frames = self._gather_frames(batch, 'frames', starts, lengths, seq_len)
+        action = self._gather(batch, 'action', starts, lengths, seq_len)
+        reward = self._gather(batch, 'reward', starts, lengths, seq_len)
+        return hi_lst, ho_lst, frames, action, reward, mask
 
     def __len__(self):  # cannot work in multiprocessing case, len(replay_buffer) is not available in proxy of manager!
         return len(self.buffer)
@@ -62,6 +181,55 @@ class ReplayBufferGRU:
     def get_length(self):
         return len(self.buffer)
 
+    def dedup_summary(self):
+        '''
+        @return: live dedup statistics of every observation pool, None without dedup_obs
+        '''
+        if not self.pools:
+            return None
+        return ', '.join(f'{shape}: {pool.summary()}' for shape, pool in self.pools.items())
+
+    def store_summary(self):
+        '''
+        @return: size and cache statistics of the compressed episode store, None without a store
+        '''
+        return self.store.summary() if self.store is not None else None
+
+    def state_dict(self):
+        '''
+        @return: cursors of the buffer, the episodes themselves are saved by src.replay.snapshot
+        '''
+        return {'position': self.position, 'stored': self.stored}
+
+    def load_state_dict(self, state):
+        self.position = state['position']
+        self.stored = state['stored']
+
+
+def split_frames(frames, mask):
+    """
+    Current and next frames of a [#batch, #sequence + 1, ...] window sampled by ReplayBufferGRU.
+    The window is decoded and moved to the device once. The next frames are a view of it, the current
+    frames a copy with the padded steps zeroed, as the batch norm statistics of the CNN include them.
+    @params:
+        frames: [#batch, #sequence + 1, ...]
+        mask: [#batch, #sequence]
+    @return: current, following: [#batch, #sequence, ...]
+    """
+    mask = mask.view(*mask.shape, *([1] * (frames.dim() - 2)))
+    return frames[:, :-1] * mask, frames[:, 1:]
+
+
+def masked_mse_loss(pred, target, mask):
+    """
+    Mean squared error over the valid steps only.
+    @params:
+        pred, target: [#batch, #sequence, ...]
+        mask: [#batch, #sequence]
+    """
+    mask = mask.view(*mask.shape, *([1] * (pred.dim() - mask.dim()))).expand_as(pred)
+    return ((pred - target) ** 2 * mask).sum() / mask.sum().clamp(min=1)
+
 class RNNAgent(nn.Module):
     '''
     @brief:
@@ -159,8 +327,22 @@ class RNNAgent(nn.Module):
 class RNN_Trainer():
     def __init__(self, replay_buffer=None, n_agents=81, obs_dim=300, action_shape=1, action_dim=21, hidden_dim=64, 
                  target_update_interval=10, lr=5e-4, epsilon_start=1.0, epsilon_end=0.05, 
-                 epsilon_decay=0.995):
+                 epsilon_decay=0.995, scheduler=None, precision='fp32', compile=False, fused_optim=False, augment=False,
+                 seed=None):
+        '''
+        @params:
+            scheduler: UpdateScheduler setting the gradient step budget of update, the original fit-until-loss budget if None
+            precision, compile: autocast precision and torch.compile of the training step, see src.train_step.TrainStep
+            fused_optim: use the fused (or foreach) AdamW implementation
+            augment: transform every sampled episode (observations and actions) by a random symmetry of the map,
+                see src.replay.augment
+            seed: seed of the replay sampling generator. Batches are drawn from their own generator, not from the
+                global ones the rollouts use, see QMix_Trainer
+        '''
         self.replay_buffer = replay_buffer
+        self.scheduler = scheduler if scheduler is not None else UpdateScheduler()
+        self.augment = augment
+        self.sample_rng = np.random.RandomState(seed)
         self.action_dim = action_dim
         self.action_shape = action_shape
         self.n_agents = n_agents
@@ -176,8 +358,8 @@ class RNN_Trainer():
         self._update_targets()
         self.update_cnt = 0
         
-        self.criterion = nn.MSELoss()
-        self.optimizer = optim.AdamW(self.agent.parameters(), lr=lr, weight_decay=0.001)
+        self.optimizer = make_optimizer(optim.AdamW, self.agent.parameters(), fused=fused_optim, lr=lr, weight_decay=0.001)
+        self.train_step = TrainStep(self._loss, self.optimizer, precision=precision, compile=compile)
 
     def get_action(self, state, hidden_in):
         '''
@@ -197,45 +379,48 @@ class RNN_Trainer():
         self.replay_buffer.push(ini_hidden_in, ini_hidden_out, episode_observation, episode_action,
                                 episode_reward, episode_next_observation)
     
-    def update(self, batch_size):
-        current_loss = 100
-        total_epoch = 0
-        num_epoch = 100
-
-        hidden_in, hidden_out, observation, action, reward, next_observation = self.replay_buffer.sample(batch_size)
+    def _prepare_batch(self, batch_size, seq_len=None):
+        '''
+        @brief: sample a batch and compute its TD targets with the target network
+        '''
+        batch = self.replay_buffer.sample(batch_size, seq_len, rng=self.sample_rng)
+        if self.augment:
+            batch = augment_batch(batch, frames=(2,), actions=(3,), rng=self.sample_rng)
+        hidden_in, hidden_out, frames, action, reward, mask = batch
 
         # Chuyển đổi dữ liệu
-        observation = torch.FloatTensor(np.array(observation)).to(device)
-        next_observation = torch.FloatTensor(np.array(next_observation)).to(device)
-        action = torch.LongTensor(np.array(action)).to(device)
-        reward = torch.FloatTensor(np.array(reward)).unsqueeze(-1).to(device)
+        action = torch.from_numpy(action).to(device)
+        reward = torch.from_numpy(reward).unsqueeze(-1).to(device)
+        mask = torch.from_numpy(mask).to(device)
+        observation, next_observation = split_frames(torch.from_numpy(frames).to(device), mask)
 
         # Tính target Q values
-        target_agent_outs, _ = self.target_agent(next_observation, hidden_out)
-        target_max_qvals = target_agent_outs.max(dim=-1)[0]
-        # Tính reward và targets
-        targets = self._build_td0_targets(reward, target_max_qvals)
-        # Vòng lặp huấn luyện đảm bảo model fit trước khi chuyển sang episode tiếp theo
-        while(current_loss > 0.1 and total_epoch < 10):
-            for epoch in range(1, num_epoch + 1):
-                # Tính current Q values
-                agent_outs, _ = self.agent(observation, hidden_in)
-                chosen_action_qvals = torch.gather(
-                    agent_outs, dim=-1, index=action.unsqueeze(-1)).squeeze(-1)
-                
-                # Tính loss và update
-                loss = self.criterion(chosen_action_qvals, targets.detach())
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                
-                current_loss = loss.item()
-            
-                if epoch % 100 == 0:
-                    print(f'Epoch {epoch}/{total_epoch+1}, Loss: {current_loss}')
+        with torch.no_grad():
+            target_agent_outs, _ = self.target_agent(next_observation, hidden_out)
+            target_max_qvals = target_agent_outs.max(dim=-1)[0]
+            # Tính reward và targets
+            targets = self._build_td0_targets(reward, target_max_qvals, mask)
+        return hidden_in, observation, action, mask, targets
+
+    def _loss(self, hidden_in, observation, action, mask, targets):
+        # Tính current Q values
+        agent_outs, _ = self.agent(observation, hidden_in)
+        chosen_action_qvals = torch.gather(
+            agent_outs, dim=-1, index=action.unsqueeze(-1)).squeeze(-1)
+        return masked_mse_loss(chosen_action_qvals, targets, mask)
+
+    def _gradient_step(self, batch):
+        # Tính loss và update
+        return self.train_step(*batch)
+
+    def update(self, batch_size, seq_len=None, env_steps=0):
+        '''
+        @params:
+            env_steps: environment steps collected since the previous update, for the replay ratio of the scheduler
+        @return: loss of the last gradient step, None if the budget was 0
+        '''
+        stats = self.scheduler.run(lambda: self._prepare_batch(batch_size, seq_len), self._gradient_step, env_steps)
 
-            total_epoch += 1
-        
         self.update_cnt += 1
         if self.update_cnt % self.target_update_interval == 0:
             self._update_targets()
@@ -243,24 +428,21 @@ class RNN_Trainer():
         self.epsilon = max(self.epsilon_end, self.epsilon * self.epsilon_decay)
         self.agent.epsilon = self.epsilon
 
-        return current_loss
+        return stats.losses[-1] if stats.losses else None
     
-    def _build_td0_targets(self, rewards, target_qs, gamma=0.99):
+    def _build_td0_targets(self, rewards, target_qs, mask=None, gamma=0.99):
         """
         Tính toán target Q-values theo công thức Q-learning: Q(s,a) = r + γ max_a' Q(s',a')
         
         @params:
             rewards: [#batch, #sequence, 1] - Phần thưởng tức thời
             target_qs: [#batch, #sequence, 1] - Q values từ target network
+            mask: [#batch, #sequence] - 1 for valid steps, padded steps are not bootstrapped from
         @return:
             ret: [#batch, #sequence, 1] - Target Q values
         """
-        ret = target_qs.new_zeros(*target_qs.shape)
-        ret[:, -1] = rewards[:, -1]
         # Q(s,a) = r + γ max_a' Q(s',a')
-        for t in range(ret.shape[1] - 2, -1, -1):
-            ret[:, t] = rewards[:, t] + gamma * target_qs[:, t+1]
-        return ret
+        return td0_targets(rewards, following_step(target_qs, mask), gamma=gamma)
 
     def _update_targets(self):
         for target_param, param in zip(self.target_agent.parameters(), self.agent.parameters()):
@@ -273,3 +455,30 @@ class RNN_Trainer():
     def load_model(self, path, map_location):
         self.agent.load_state_dict(torch.load(path+'_agent', map_location=map_location, weights_only=True))
         self.agent.eval()
+
+    def state_dict(self):
+        '''
+        @return: full training state (network, target network, optimizer, schedule counters, replay sampling
+            generator) for src.checkpoint, the replay buffer is saved by its snapshotter
+        '''
+        return {
+            'agent': self.agent.state_dict(),
+            'target_agent': self.target_agent.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'train_step': self.train_step.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'epsilon': self.epsilon,
+            'update_cnt': self.update_cnt,
+            'sample_rng': self.sample_rng.get_state(),
+        }
+
+    def load_state_dict(self, state):
+        self.agent.load_state_dict(state['agent'])
+        self.target_agent.load_state_dict(state['target_agent'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.train_step.load_state_dict(state['train_step'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.epsilon = state['epsilon']
+        self.agent.epsilon = self.epsilon
+        self.update_cnt = state['update_cnt']
+        self.sample_rng.set_state(state['sample_rng'])
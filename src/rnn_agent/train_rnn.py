@@ -13,6 +13,9 @@ from src.cnn import CNNFeatureExtractor
 from src.rnn_agent.utils import get_all_states, make_action
 from src.torch_model import QNetwork
 from src.rnn_agent.rnn_agent import RNN_Trainer, ReplayBufferGRU
+from src.update_scheduler import UpdateScheduler
+from src.train_step import TrainStep
+from src.checkpoint import Checkpointer
 
 # Thêm đoạn parse arguments trước khi định nghĩa các biến
 parser = argparse.ArgumentParser(description='Train QMIX agents')
@@ -29,6 +32,11 @@ parser.add_argument('--checkpoint', type=str, default=None, help='Path to checkp
 parser.add_argument('--model_path', type=str, default='model/rnn', help='Path to save model')
 parser.add_argument('--red_pretrained', action='store_true', help='Use red.pt pretrained model')
 parser.add_argument('--learning_rate', type=float, default=1e-3, help='Learning rate for optimizer')
+parser.add_argument('--seq_len', type=int, default=None, help='Length of sampled episode windows, full padded episodes if not set')
+parser.add_argument('--augment', action='store_true', help='Transform every sampled episode by a random symmetry of the map')
+UpdateScheduler.add_arguments(parser)
+TrainStep.add_arguments(parser)
+Checkpointer.add_arguments(parser)
 
 args = parser.parse_args()
 
@@ -68,6 +76,10 @@ learner = RNN_Trainer(
     epsilon_start=args.epsilon_start,
     epsilon_end=args.epsilon_end,
     epsilon_decay=args.epsilon_decay,
+    scheduler=UpdateScheduler.from_args(args),
+    augment=args.augment,
+    seed=args.seed,
+    **TrainStep.options_from_args(args),
 )
 
 if args.checkpoint:
@@ -85,7 +97,7 @@ if args.red_pretrained:
     red_agent.to(device)
 
 def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=32, 
-                    save_interval=100, model_path='model/qmix'):
+                    save_interval=100, model_path='model/qmix', start_episode=0, checkpointer=None, env_steps=0):
     """
     Train blue team using QMIX algorithm
     
@@ -97,13 +109,20 @@ def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=3
         batch_size: Batch size for training
         save_interval: Interval to save model
         model_path: Path to save model
+        start_episode: First episode, after the episode of the checkpoint the run resumes from
+        checkpointer: Checkpointer saving the full training state every args.checkpoint_interval episodes
+        env_steps: Environment steps since the last update, from the checkpoint
     """
     learner.agent.train()
     learner.target_agent.train()
     loss = None
-    for episode in range(max_episodes):
+    for episode in range(start_episode, max_episodes):
         print(f"Start episode {episode} ----------------------")
-        env.reset()
+        if checkpointer is not None:
+            # Episodes do not depend on the environment state before them, so a resumed run replays them exactly
+            env.reset(seed=args.seed + episode)
+        else:
+            env.reset()
         episode_reward = 0
         
         # Clear memory after each episode
@@ -159,6 +178,7 @@ def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=3
             
             episode_reward += rewards.sum()
         
+        env_steps += len(episode_observations)
         if len(episode_observations) > 0:
             learner.push_replay_buffer(
                 ini_hidden_in=ini_hidden_in,
@@ -174,18 +194,25 @@ def train_blue_qmix(env, learner, max_episodes=1000, max_steps=200, batch_size=3
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
-        # Training step
-        if episode + 1 >= batch_size:
-            loss = learner.update(batch_size)
+        # Training step, once the buffer holds a batch (a resumed run without replay snapshots starts empty)
+        if learner.replay_buffer.get_length() >= batch_size:
+            loss = learner.update(batch_size, args.seq_len, env_steps)
+            env_steps = 0
 
         # Save model periodically
         if episode % save_interval == 0:
             learner.save_model(f"{model_path}_episode_{episode}")
             
+        if checkpointer is not None and (episode + 1) % args.checkpoint_interval == 0:
+            checkpointer.save(episode, {'learner': learner.state_dict(), 'episode': episode, 'env_steps': env_steps})
+
         print(f"Episode {episode}: Reward = {episode_reward/n_agents:.2f}, Loss = {loss if loss else 'N/A'}")
     
+    print(learner.scheduler.summary())
     # Save final model
     learner.save_model(model_path)
+    if checkpointer is not None:
+        checkpointer.wait()
     env.close()
     
     return learner
@@ -204,6 +231,14 @@ def set_seed(seed):
 
 if __name__ == "__main__":
     set_seed(args.seed)
+    start_episode, env_steps = 0, 0
+    checkpointer = Checkpointer.from_args(args, replay_buffer)
+    if checkpointer is not None:
+        state = checkpointer.restore(map_location=device)
+        if state is not None:
+            learner.load_state_dict(state['learner'])
+            start_episode, env_steps = state['episode'] + 1, state['env_steps']
+            print(f"Resumed from {checkpointer.latest()} at episode {start_episode}")
     # Sử dụng hàm training
     trained_qmix = train_blue_qmix(
         env=env,
@@ -212,5 +247,8 @@ if __name__ == "__main__":
         max_steps=max_steps,
         batch_size=batch_size,
         save_interval=save_interval,
-        model_path=model_path
+        model_path=model_path,
+        start_episode=start_episode,
+        checkpointer=checkpointer,
+        env_steps=env_steps,
     )
\ No newline at end of file
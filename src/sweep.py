@@ -0,0 +1,357 @@
+'''
+Hyperparameter sweeps over the VDN learner (VdnHyperparameters) and the arguments of train_qmix.py / train_rnn.py.
+
+Trials run in a bounded pool of processes, each with its own torch thread count and working directory
+(sweep_dir/<trial id>), report their metric as they train, and are stopped early by a median stopping rule.
+Every event goes to an append-only ledger (sweep_dir/ledger.jsonl): an interrupted sweep skips the finished
+trials and reruns the interrupted ones, which resume from their own full-state checkpoints when checkpointing
+is part of the configuration (e.g. "checkpoint_interval" for VDN, "checkpoint_dir" for the scripts).
+
+    python src/sweep.py --target vdn --space '{"lr": [0.001, 0.002], "gamma": {"uniform": [0.95, 0.99]}}' \
+        --base '{"max_episodes": 100}' --search random --num_trials 8 --workers 2 --threads 1 --sweep_dir sweeps/vdn
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import queue
+import random
+import re
+import statistics
+import subprocess
+import sys
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = {
+    'qmix': os.path.join(ROOT, 'src', 'qmix', 'train_qmix.py'),
+    'rnn': os.path.join(ROOT, 'src', 'rnn_agent', 'train_rnn.py'),
+}
+EPISODE_LINE = re.compile(r'Episode (\d+): Reward = (-?[\d.]+)')
+FINISHED = ('done', 'stopped', 'failed')
+
+
+def sample_value(spec, rng):
+    '''
+    @params:
+        spec: list of choices, {'uniform': [low, high]}, {'loguniform': [low, high]}, {'randint': [low, high]}
+            (high included), or a fixed value
+        rng: random.Random
+    '''
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if isinstance(spec, dict) and len(spec) == 1:
+        (kind, (low, high)), = spec.items()
+        if kind == 'uniform':
+            return rng.uniform(low, high)
+        if kind == 'loguniform':
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        if kind == 'randint':
+            return rng.randint(low, high)
+        raise ValueError(f'Unknown distribution [{kind}].')
+    return spec
+
+
+def grid_configs(space):
+    '''
+    @params:
+        space: dict of name -> list of values (or a fixed value)
+    @return: list of every combination, as dicts
+    '''
+    names = sorted(space)
+    values = [space[name] if isinstance(space[name], list) else [space[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def random_configs(space, num_trials, seed=0):
+    '''
+    @params:
+        space: dict of name -> spec, see sample_value
+    @return: num_trials sampled configurations, the same ones for the same seed so a resumed sweep finds its trials
+    '''
+    rng = random.Random(seed)
+    return [{name: sample_value(space[name], rng) for name in sorted(space)} for _ in range(num_trials)]
+
+
+def trial_id(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+
+
+class Ledger:
+    '''
+    @brief:
+        Append-only JSON lines record of the sweep: trial starts, reported metrics and trial ends.
+        Reloading it rebuilds the state of every trial; a trial started but never ended was interrupted
+        and its metrics are dropped when it starts again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.trials = {}  # trial id -> {'params', 'status', 'history': [(step, value)], 'result'}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except json.JSONDecodeError:
+                        pass  # last line cut by an interruption
+        self.file = open(path, 'a')
+
+    def _apply(self, event):
+        trial = event['trial']
+        if event['event'] == 'start':
+            self.trials[trial] = {'params': event['params'], 'status': 'running', 'history': [], 'result': None}
+        elif event['event'] == 'metric':
+            self.trials[trial]['history'].append((event['step'], event['value']))
+        elif event['event'] == 'end':
+            self.trials[trial].update(status=event['status'], result=event['result'])
+
+    def record(self, **event):
+        self._apply(event)
+        self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def finished(self, trial):
+        return trial in self.trials and self.trials[trial]['status'] in FINISHED
+
+    def histories(self):
+        return {trial: state['history'] for trial, state in self.trials.items()}
+
+    def best(self, k=5, mode='max'):
+        '''
+        @return: the k best finished trials as (trial id, result, params), by result or their last metric if stopped
+        '''
+        scored = []
+        for trial, state in self.trials.items():
+            score = state['result'] if state['status'] == 'done' else (state['history'][-1][1] if state['history'] else None)
+            if state['status'] in FINISHED and isinstance(score, (int, float)):
+                scored.append((trial, score, state['params']))
+        return sorted(scored, key=lambda entry: entry[1], reverse=mode == 'max')[:k]
+
+
+class MedianStoppingRule:
+    '''
+    @brief:
+        Stop a trial once, after grace_steps, the mean of its metrics so far is worse than the median of
+        the means of the other trials over the same steps (median stopping rule of Google Vizier).
+    '''
+    def __init__(self, grace_steps=20, min_trials=3, mode='max'):
+        '''
+        @params:
+            grace_steps: steps (episodes) a trial always runs
+            min_trials: number of other trials that must have reached the step to compare against
+            mode: 'max' if higher metrics are better, 'min' otherwise
+        '''
+        self.grace_steps = grace_steps
+        self.min_trials = min_trials
+        self.mode = mode
+
+    def should_stop(self, trial, step, histories):
+        '''
+        @params:
+            histories: dict of trial id -> list of (step, value), including the trial
+        '''
+        if step < self.grace_steps:
+            return False
+        def running_mean(history):
+            values = [value for s, value in history if s <= step]
+            return sum(values) / len(values)
+        others = [running_mean(history) for other, history in histories.items()
+                  if other != trial and history and history[-1][0] >= step]
+        if len(others) < self.min_trials:
+            return False
+        mine, median = running_mean(histories[trial]), statistics.median(others)
+        return mine < median if self.mode == 'max' else mine > median
+
+
+class TrialStopped(Exception):
+    pass
+
+
+def run_vdn(params, report, threads):
+    '''
+    @brief: self-play training of two VDN teams as in train_vdn.ipynb, with VdnHyperparameters(**params)
+    @return: mean test score of team 1, or its mean training score over the last 10 episodes without a test phase
+    '''
+    import torch
+    sys.path.append(os.path.join(ROOT, 'src', 'vdn'))
+    from magent2.environments import battle_v4
+    from model import VdnQNet
+    from team import TeamManager
+    from utils import seed, device, VdnHyperparameters
+    from train import train, run_episode, run_model_train_test
+
+    torch.set_num_threads(threads)
+    hp = VdnHyperparameters(**params)
+    env = battle_v4.parallel_env(map_size=45)
+    test_env = battle_v4.parallel_env(map_size=45)
+    env.reset(seed=seed)
+    test_env.reset(seed=seed)
+    team_manager = TeamManager(env.agents)
+    models = [VdnQNet(agents, env.observation_spaces, env.action_spaces, recurrent=hp.recurrent).to(device)
+              for agents in (team_manager.get_my_agents(), team_manager.get_my_agents(),
+                             team_manager.get_other_agents(), team_manager.get_other_agents())]
+    q_team1, q_target_team1, q_team2, q_target_team2 = models
+    train_scores_team1, _, test_scores_team1, _, _, _ = run_model_train_test(
+        env, test_env, q_team1, q_team2, q_target_team1, q_target_team2, 'vdn_blue', 'vdn_red',
+        team_manager, hp, train, run_episode, report=report
+    )
+    scores = test_scores_team1 or train_scores_team1[-10:]
+    return float(sum(scores) / len(scores))
+
+
+def run_script(script, params, report, threads):
+    '''
+    @brief: run train_qmix.py / train_rnn.py with --name value arguments from params (flags for True, omitted
+        for False) and report the reward of every "Episode e: Reward = r" line
+    @return: mean reward of the last 10 episodes
+    '''
+    command = [sys.executable, '-u', script]
+    for name, value in params.items():
+        if value is True:
+            command.append(f'--{name}')
+        elif value is not False and value is not None:
+            command += [f'--{name}', str(value)]
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+    rewards = []
+    try:
+        with open('train.log', 'a') as log:
+            for line in process.stdout:
+                log.write(line)
+                match = EPISODE_LINE.search(line)
+                if match:
+                    rewards.append(float(match.group(2)))
+                    report(int(match.group(1)), rewards[-1])
+        if process.wait() != 0:
+            raise RuntimeError(f'{os.path.basename(script)} exited with code {process.returncode}, see train.log')
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return sum(rewards[-10:]) / max(len(rewards[-10:]), 1)
+
+
+def run_target(target, params, report, threads):
+    if target == 'vdn':
+        return run_vdn(params, report, threads)
+    return run_script(SCRIPTS[target], params, report, threads)
+
+
+def _worker(target, trial, params, directory, threads, events, stop):
+    '''
+    @brief: run one trial in its directory, sending ('metric', trial, step, value) and ('end', trial, status, result)
+        to events. The trial stops at its next report once stop is set
+    '''
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[name] = str(threads)
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+
+    def report(step, value):
+        events.put(('metric', trial, int(step), float(value)))
+        if stop.is_set():
+            raise TrialStopped()
+
+    try:
+        result = run_target(target, params, report, threads)
+        events.put(('end', trial, 'done', result))
+    except TrialStopped:
+        events.put(('end', trial, 'stopped', None))
+    except Exception:
+        traceback.print_exc()
+        events.put(('end', trial, 'failed', traceback.format_exc(limit=5)))
+
+
+def run_sweep(target, configs, sweep_dir, workers=2, threads=1, rule=None):
+    '''
+    @params:
+        target: 'vdn', 'qmix' or 'rnn'
+        configs: list of parameter dicts, merged base configuration and sampled values
+        sweep_dir: directory of the ledger and of the trial working directories
+        workers: number of trials running at once
+        threads: torch threads of every trial
+        rule: MedianStoppingRule, None to never stop trials early
+    @return: Ledger of the sweep
+    '''
+    os.makedirs(sweep_dir, exist_ok=True)
+    ledger = Ledger(os.path.join(sweep_dir, 'ledger.jsonl'))
+    # Identical configurations (e.g. repeated random samples) are one trial
+    trials = dict((trial_id(params), params) for params in configs)
+    pending = [(trial, params) for trial, params in trials.items() if not ledger.finished(trial)]
+    print(f'{len(trials) - len(pending)} of {len(trials)} trials already finished')
+
+    ctx = mp.get_context('spawn')
+    events = ctx.Queue()
+    running = {}  # trial id -> (process, stop event)
+    while pending or running:
+        while pending and len(running) < workers:
+            trial, params = pending.pop(0)
+            ledger.record(event='start', trial=trial, params=params)
+            stop = ctx.Event()
+            process = ctx.Process(target=_worker, daemon=True,
+                                  args=(target, trial, params, os.path.join(os.path.abspath(sweep_dir), trial), threads, events, stop))
+            process.start()
+            running[trial] = (process, stop)
+            print(f'Trial {trial} started: {params}')
+        try:
+            event = events.get(timeout=1)
+        except queue.Empty:
+            # Trials killed without reporting their end (e.g. out of memory)
+            for trial, (process, _) in list(running.items()):
+                if not process.is_alive():
+                    ledger.record(event='end', trial=trial, status='failed', result=f'exit code {process.exitcode}')
+                    del running[trial]
+            continue
+        kind, trial = event[:2]
+        if kind == 'metric':
+            ledger.record(event='metric', trial=trial, step=event[2], value=event[3])
+            if (rule is not None and trial in running and not running[trial][1].is_set()
+                    and rule.should_stop(trial, event[2], ledger.histories())):
+                print(f'Trial {trial} stopped early at step {event[2]}')
+                running[trial][1].set()
+        elif kind == 'end' and trial in running:
+            # Not when the trial was already recorded as failed after its process exited
+            ledger.record(event='end', trial=trial, status=event[2], result=event[3])
+            process, _ = running.pop(trial)
+            process.join()
+            print(f'Trial {trial} {event[2]}: {event[3] if event[2] != "failed" else ""}')
+    return ledger
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep of the VDN, QMIX or RNN learners')
+    parser.add_argument('--target', choices=('vdn', 'qmix', 'rnn'), required=True)
+    parser.add_argument('--space', type=str, required=True, help='JSON search space (or path to a JSON file), see sample_value')
+    parser.add_argument('--base', type=str, default='{}', help='JSON fixed parameters of every trial (or path to a JSON file)')
+    parser.add_argument('--search', choices=('grid', 'random'), default='grid')
+    parser.add_argument('--num_trials', type=int, default=10, help='Number of random search trials')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random search')
+    parser.add_argument('--workers', type=int, default=2, help='Number of trials running at once')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads per trial')
+    parser.add_argument('--sweep_dir', type=str, default='sweeps', help='Directory of the ledger and of the trials')
+    parser.add_argument('--grace_steps', type=int, default=20, help='Episodes before a trial can be stopped early')
+    parser.add_argument('--min_trials', type=int, default=3, help='Trials to compare against before stopping one, 0 to disable early stopping')
+    parser.add_argument('--mode', choices=('max', 'min'), default='max', help='Whether higher metrics are better')
+    args = parser.parse_args()
+
+    def load(text):
+        if os.path.exists(text):
+            with open(text) as f:
+                return json.load(f)
+        return json.loads(text)
+
+    space, base = load(args.space), load(args.base)
+    sampled = grid_configs(space) if args.search == 'grid' else random_configs(space, args.num_trials, args.seed)
+    configs = [dict(base, **params) for params in sampled]
+    rule = MedianStoppingRule(args.grace_steps, args.min_trials, args.mode) if args.min_trials > 0 else None
+    ledger = run_sweep(args.target, configs, args.sweep_dir, args.workers, args.threads, rule)
+    for trial, score, params in ledger.best(mode=args.mode):
+        print(f'{trial}  {score:10.3f}  {params}')
+
+
+if __name__ == '__main__':
+    main()
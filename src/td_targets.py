@@ -0,0 +1,168 @@
+'''
+Vectorized TD target builders shared by the QMIX, RNN and VDN trainers.
+
+All functions work on tensors with time as dim 1, [#batch, #sequence, ...], and replace per-timestep
+Python loops by matrix products with decay matrices (reverse discounted scans) or windowed cumulative products
+(n-step returns). See benchmarks/bench_td_targets.py for the comparison with the loops.
+next_values[:, t] is the bootstrap value of the state reached by step t, and continues[:, t] is 0 where
+step t ends the episode (or the step after it is padding), so nothing is bootstrapped or accumulated past it.
+'''
+import functools
+
+import torch
+
+
+@functools.lru_cache(maxsize=32)
+def _power_matrix(length, discount, dtype, device):
+    '''
+    @return: [#sequence, #sequence] matrix W with W[t, k] = discount^(k-t) for k >= t, 0 otherwise
+    '''
+    steps = torch.arange(length, device=device)
+    exponents = steps[None, :] - steps[:, None]
+    weights = torch.full((length, length), float(discount), dtype=dtype, device=device) ** exponents.clamp(min=0)
+    return weights * (exponents >= 0)
+
+
+def _chain_weights(discounts):
+    '''
+    @params:
+        discounts: [#batch, #sequence] per-step discounts d
+    @return: [#batch, #sequence, #sequence] matrix W with W[b, t, k] = d[b, t] * ... * d[b, k-1] for k >= t
+        (1 on the diagonal), 0 otherwise
+    '''
+    length = discounts.shape[1]
+    upper = torch.ones(length, length, dtype=torch.bool, device=discounts.device).triu()
+    # factors[b, t, j] = d[b, j] for j >= t, then cumulative products along j
+    factors = torch.where(upper, discounts[:, None, :], torch.ones_like(discounts[:, None, :]))
+    products = factors.cumprod(dim=-1)
+    # W[b, t, k] = products[b, t, k-1] for k > t
+    weights = torch.cat([torch.ones_like(products[..., :1]), products[..., :-1]], dim=-1)
+    return weights * upper
+
+
+def _matmul_time(weights, values):
+    '''
+    @brief: out[:, t] = sum_k weights[(b,) t, k] * values[:, k], broadcasting over the trailing dims of values
+    '''
+    flat = values.reshape(values.shape[0], values.shape[1], -1)
+    if weights.dim() == 2:
+        out = torch.einsum('tk,bkf->btf', weights, flat)
+    else:
+        out = torch.bmm(weights, flat)
+    return out.reshape(values.shape)
+
+
+def discounted_scan(values, discounts, block_size=32):
+    '''
+    Reverse linear recurrence out[:, t] = values[:, t] + discounts[:, t] * out[:, t+1], with out[:, T] = 0.
+    A constant discount is one product with a cached [#sequence, #sequence] decay matrix. Per-step discounts
+    use decay matrices of blocks of block_size steps, chained from the last block to the first, which keeps
+    memory at [#batch, #sequence, block_size].
+    @params:
+        values: [#batch, #sequence, ...]
+        discounts: float, or [#batch, #sequence] tensor broadcast over the trailing dims of values
+    @return: [#batch, #sequence, ...]
+    '''
+    if not torch.is_tensor(discounts):
+        weights = _power_matrix(values.shape[1], float(discounts), values.dtype, values.device)
+        return _matmul_time(weights, values)
+
+    batch_size, length = values.shape[:2]
+    num_blocks = -(-length // block_size)
+    padding = num_blocks * block_size - length
+    flat = values.reshape(batch_size, length, -1)
+    discounts = discounts.to(values.dtype)
+    if padding:
+        # Padded steps hold no value and do not discount into the sequence
+        flat = torch.cat([flat, flat.new_zeros(batch_size, padding, flat.shape[-1])], dim=1)
+        discounts = torch.cat([discounts, discounts.new_zeros(batch_size, padding)], dim=1)
+    discounts = discounts.reshape(batch_size * num_blocks, block_size)
+    weights = _chain_weights(discounts)  # [#batch * #blocks, block_size, block_size]
+    local = torch.bmm(weights, flat.reshape(batch_size * num_blocks, block_size, -1))
+    local = local.reshape(batch_size, num_blocks, block_size, -1)
+    # carry[b, n, t]: discount from step t of block n to the first step of block n+1
+    carry = (weights[:, :, -1] * discounts[:, -1:]).reshape(batch_size, num_blocks, block_size, 1)
+
+    blocks = [local[:, -1]]
+    for n in range(num_blocks - 2, -1, -1):
+        blocks.append(local[:, n] + carry[:, n] * blocks[-1][:, :1])
+    out = torch.cat(blocks[::-1], dim=1)[:, :length]
+    return out.reshape(values.shape)
+
+
+def _expand(continues, values):
+    '''
+    @brief: reshape [#batch, #sequence, ...] continues to broadcast against values
+    '''
+    if continues is None:
+        return values.new_ones(values.shape[:2] + (1,) * (values.dim() - 2))
+    continues = continues.to(values.dtype)
+    return continues.reshape(continues.shape + (1,) * (values.dim() - continues.dim()))
+
+
+def following_step(values, mask=None):
+    '''
+    @brief: values of step t+1 at index t (0 for the last step and where step t+1 is masked), for trainers
+        whose target Q values are indexed by the step they are computed at
+    @params:
+        values: [#batch, #sequence, ...]
+        mask: [#batch, #sequence], None if all steps are valid
+    '''
+    if mask is not None:
+        values = values * _expand(mask, values)
+    return torch.cat([values[:, 1:], torch.zeros_like(values[:, :1])], dim=1)
+
+
+def td0_targets(rewards, next_values, continues=None, gamma=0.99):
+    '''
+    One-step targets r_t + gamma * c_t * V(s_{t+1}).
+    @params:
+        rewards, next_values: [#batch, #sequence, ...]
+        continues: [#batch, #sequence, ...] (or a prefix of the shape), None if no step is terminal
+    '''
+    return rewards + gamma * _expand(continues, next_values) * next_values
+
+
+def n_step_targets(rewards, next_values, n, continues=None, gamma=0.99):
+    '''
+    n-step targets sum_{i<m} gamma^i r_{t+i} + gamma^m V(s_{t+m}), with m = n truncated at the end of the
+    sequence and at terminal steps.
+    @params:
+        rewards, next_values: [#batch, #sequence, ...]
+        continues: [#batch, #sequence], None if no step is terminal
+    '''
+    batch_size, length = rewards.shape[:2]
+    if continues is None:
+        continues = rewards.new_ones(batch_size, length)
+    discounts = gamma * continues.to(rewards.dtype)
+    # Windows of the n steps following each step, padded past the end of the sequence
+    padded = torch.cat([discounts, discounts.new_zeros(batch_size, n - 1)], dim=1)
+    windows = padded.unfold(1, n, 1)  # [#batch, #sequence, n]
+    # products[b, t, i] = d[b, t] * ... * d[b, t+i-1]
+    products = torch.cat([torch.ones_like(windows[..., :1]), windows[..., :-1].cumprod(dim=-1)], dim=-1)
+
+    flat = rewards.reshape(batch_size, length, -1)
+    flat = torch.cat([flat, flat.new_zeros(batch_size, n - 1, flat.shape[-1])], dim=1)
+    returns = torch.einsum('bti,btfi->btf', products, flat.unfold(1, n, 1)).reshape(rewards.shape)
+
+    # Bootstrap from the last step of each window
+    steps = torch.arange(length, device=rewards.device)
+    last = (steps + n - 1).clamp(max=length - 1)  # [#sequence]
+    bootstrap = products[:, steps, last - steps] * discounts[:, last]  # [#batch, #sequence]
+    return returns + _expand(bootstrap, next_values) * next_values[:, last]
+
+
+def lambda_returns(rewards, next_values, td_lambda=0.6, continues=None, gamma=0.99):
+    '''
+    TD(lambda) returns G_t = r_t + gamma * c_t * ((1 - lambda) * V(s_{t+1}) + lambda * G_{t+1}),
+    bootstrapping fully from V at the end of the sequence.
+    @params:
+        rewards, next_values: [#batch, #sequence, ...]
+        continues: [#batch, #sequence], None if no step is terminal
+    '''
+    bootstrap = gamma * _expand(continues, next_values) * next_values
+    values = rewards + (1 - td_lambda) * bootstrap
+    # The last step has no G_{t+1}, its lambda share also bootstraps from V
+    values[:, -1] += td_lambda * bootstrap[:, -1]
+    discounts = gamma * td_lambda
+    return discounted_scan(values, discounts if continues is None else discounts * continues.to(rewards.dtype))
@@ -0,0 +1,130 @@
+import torch
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+PRECISIONS = ('fp32', 'bf16', 'fp16', 'auto')
+
+
+def _compile_errors():
+    '''
+    @return: exception types raised when torch.compile itself fails (backend or dynamo internals), as opposed
+        to errors of the compiled code such as shape or dtype mismatches, which are raised as usual
+    '''
+    try:
+        from torch._dynamo import exc
+    except ImportError:
+        return ()
+    names = ('BackendCompilerFailed', 'InternalTorchDynamoError', 'Unsupported')
+    return tuple(getattr(exc, name) for name in names if hasattr(exc, name))
+
+
+COMPILE_ERRORS = _compile_errors()
+
+
+def resolve_precision(precision, device_type=device.type):
+    '''
+    @params:
+        precision: one of PRECISIONS, 'auto' is fp16 on CUDA and bf16 on CPU (the defaults of torch.amp.autocast)
+    @return: autocast dtype, None for fp32
+    '''
+    assert precision in PRECISIONS, f'Unknown precision [{precision}].'
+    if precision == 'auto':
+        precision = 'fp16' if device_type == 'cuda' else 'bf16'
+    return {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+
+
+def make_optimizer(optimizer_cls, params, fused=False, **kwargs):
+    '''
+    @brief: create an optimizer with its fused implementation if requested and supported for the parameters
+        (e.g. CPU tensors need a recent torch), falling back to the multi-tensor foreach implementation
+    @params:
+        optimizer_cls: torch.optim class, e.g. optim.Adam
+        params: parameters or parameter groups
+        kwargs: arguments of optimizer_cls
+    '''
+    params = list(params)
+    if fused:
+        try:
+            return optimizer_cls(params, fused=True, **kwargs)
+        except (RuntimeError, TypeError, ValueError) as e:
+            print(f'Fused {optimizer_cls.__name__} not available ({e}), using foreach')
+        return optimizer_cls(params, foreach=True, **kwargs)
+    return optimizer_cls(params, **kwargs)
+
+
+class TrainStep:
+    '''
+    @brief:
+        One training step of a learner: forward and loss, backward, gradient clipping and optimizer step.
+        The forward runs under autocast at the requested precision and, optionally, compiled with
+        torch.compile (falling back to eager, once, if the compiler fails). The gradient scaler of fp16 training
+        persists across steps and across the updates the engine is reused for.
+    '''
+    def __init__(self, loss_fn, optimizer, precision='fp32', compile=False, grad_clip_norm=None):
+        '''
+        @params:
+            loss_fn: (*batch) -> scalar loss tensor, the forward pass of the learner
+            optimizer: optimizer of the learner, see make_optimizer for fused optimizers
+            precision: one of PRECISIONS
+            compile: compile loss_fn with torch.compile
+            grad_clip_norm: max L2 norm of the gradients, None to disable clipping
+        '''
+        self.loss_fn = loss_fn
+        self.optimizer = optimizer
+        self.precision = precision
+        self.dtype = resolve_precision(precision)
+        self.grad_clip_norm = grad_clip_norm
+        self.forward = torch.compile(loss_fn) if compile else loss_fn
+        self.compiled = compile
+        # Loss scaling is only needed for fp16 gradients
+        self.scaler = torch.amp.GradScaler(device.type, enabled=self.dtype == torch.float16 and device.type == 'cuda')
+        self.steps = 0
+
+    @staticmethod
+    def add_arguments(parser, precision='fp32'):
+        parser.add_argument('--precision', choices=PRECISIONS, default=precision, help='Autocast precision of the training step, auto for fp16 on CUDA and bf16 on CPU')
+        parser.add_argument('--compile', action='store_true', help='Compile the training forward pass with torch.compile')
+        parser.add_argument('--fused_optim', action='store_true', help='Use the fused (or foreach) optimizer implementation')
+
+    @staticmethod
+    def options_from_args(args):
+        '''
+        @return: keyword arguments of the trainers from the --precision, --compile and --fused_optim arguments
+        '''
+        return dict(precision=args.precision, compile=args.compile, fused_optim=args.fused_optim)
+
+    def state_dict(self):
+        return {'scaler': self.scaler.state_dict(), 'steps': self.steps}
+
+    def load_state_dict(self, state):
+        self.scaler.load_state_dict(state['scaler'])
+        self.steps = state['steps']
+
+    def _loss(self, batch):
+        with torch.autocast(device_type=device.type, dtype=self.dtype, enabled=self.dtype is not None):
+            if not self.compiled:
+                return self.loss_fn(*batch)
+            try:
+                return self.forward(*batch)
+            except COMPILE_ERRORS as e:
+                print(f'torch.compile failed ({type(e).__name__}: {e}), training in eager mode')
+                self.forward, self.compiled = self.loss_fn, False
+                return self.loss_fn(*batch)
+
+    def __call__(self, *batch):
+        '''
+        @params:
+            batch: arguments of loss_fn
+        @return: loss (float)
+        '''
+        loss = self._loss(batch)
+        self.optimizer.zero_grad(set_to_none=True)
+        self.scaler.scale(loss).backward()
+        if self.grad_clip_norm is not None:
+            self.scaler.unscale_(self.optimizer)
+            params = [p for group in self.optimizer.param_groups for p in group['params']]
+            torch.nn.utils.clip_grad_norm_(params, self.grad_clip_norm, norm_type=2)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.steps += 1
+        return loss.item()
@@ -0,0 +1,145 @@
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import numpy as np
+
+
+@dataclass
+class UpdateStats:
+    '''
+    Telemetry of one update: gradient steps, time split and loss trajectory
+    '''
+    budget: int
+    steps: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+    sample_seconds: float = 0.0
+    losses: List[float] = field(default_factory=list)
+    stop: str = 'budget'  # 'budget', 'time' or 'loss'
+
+    def summary(self):
+        steps_per_second = self.steps / max(self.seconds, 1e-9)
+        sampling = self.sample_seconds / max(self.seconds, 1e-9)
+        losses = f'loss {self.losses[0]:.4f} -> {self.losses[-1]:.4f}' if self.losses else 'no steps'
+        return (f'Update: {self.steps}/{self.budget} steps on {self.batches} batches in {self.seconds:.2f}s '
+                f'({steps_per_second:.1f} steps/s, sampling {sampling:.0%}), {losses}, stop: {self.stop}')
+
+
+class UpdateScheduler:
+    '''
+    @brief:
+        Budget of the gradient steps of one update, replacing fixed fit-until-loss loops.
+        The number of steps comes from the replay ratio (gradient steps per environment step collected
+        since the previous update) capped by max_steps, the update also stops at the wall-clock cap
+        and, optionally, once the loss reaches target_loss. Batches are either reused for all steps of
+        the update or sampled fresh for every step.
+        The defaults reproduce the original QMIX / RNN update: up to 1000 steps on one batch,
+        stopping once the loss is <= 0.1, checked every 100 steps.
+    '''
+    def __init__(self, replay_ratio: Optional[float] = None, max_steps: int = 1000, max_seconds: Optional[float] = None,
+                 fresh_samples: bool = False, target_loss: Optional[float] = 0.1, check_interval: int = 100,
+                 log_interval: int = 100):
+        '''
+        @params:
+            replay_ratio: gradient steps per environment step, None to always run max_steps
+            max_steps: maximum gradient steps per update
+            max_seconds: wall-clock cap per update, None for no cap
+            fresh_samples: sample a new batch for every gradient step instead of reusing the first one
+            target_loss: stop early once the loss is <= target_loss, None to disable
+            check_interval: gradient steps between early-stop checks
+            log_interval: gradient steps between loss prints, 0 to disable
+        '''
+        self.replay_ratio = replay_ratio
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.fresh_samples = fresh_samples
+        self.target_loss = target_loss
+        self.check_interval = check_interval
+        self.log_interval = log_interval
+        self.credit = 0.0  # fractional gradient steps carried over to the next update
+        self.history = []
+
+    @classmethod
+    def from_args(cls, args):
+        '''
+        @brief: create a scheduler from the --replay_ratio, --max_grad_steps, --max_update_seconds,
+            --fresh_samples and --target_loss command line arguments
+        '''
+        return cls(replay_ratio=args.replay_ratio, max_steps=args.max_grad_steps, max_seconds=args.max_update_seconds,
+                   fresh_samples=args.fresh_samples, target_loss=args.target_loss)
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--replay_ratio', type=float, default=None, help='Gradient steps per environment step, max_grad_steps per update if not set')
+        parser.add_argument('--max_grad_steps', type=int, default=1000, help='Maximum gradient steps per update')
+        parser.add_argument('--max_update_seconds', type=float, default=None, help='Wall-clock cap per update')
+        parser.add_argument('--fresh_samples', action='store_true', help='Sample a new batch for every gradient step')
+        parser.add_argument('--target_loss', type=float, default=0.1, help='Stop an update early once the loss is below, negative to disable')
+
+    def state_dict(self):
+        '''
+        @return: the carried-over gradient step credit, the history is telemetry and is not saved
+        '''
+        return {'credit': self.credit}
+
+    def load_state_dict(self, state):
+        self.credit = state['credit']
+
+    def budget(self, env_steps):
+        '''
+        @params:
+            env_steps: environment steps collected since the previous update
+        @return: number of gradient steps of the next update
+        '''
+        if self.replay_ratio is None:
+            return self.max_steps
+        self.credit += self.replay_ratio * env_steps
+        steps = min(int(self.credit), self.max_steps)
+        self.credit -= steps
+        return steps
+
+    def run(self, sample_fn, step_fn, env_steps=0):
+        '''
+        @params:
+            sample_fn: () -> batch, samples and prepares a batch
+            step_fn: batch -> loss (float), one gradient step
+            env_steps: environment steps collected since the previous update
+        @return: UpdateStats of the update
+        '''
+        stats = UpdateStats(budget=self.budget(env_steps))
+        start = time.time()
+        batch = None
+        target_loss = self.target_loss if self.target_loss is not None and self.target_loss >= 0 else None
+        for step in range(1, stats.budget + 1):
+            if batch is None or self.fresh_samples:
+                sample_start = time.time()
+                batch = sample_fn()
+                stats.sample_seconds += time.time() - sample_start
+                stats.batches += 1
+            stats.losses.append(step_fn(batch))
+            stats.steps = step
+
+            if self.log_interval and step % self.log_interval == 0:
+                print(f'Step {step}/{stats.budget}, Loss: {stats.losses[-1]}')
+            if target_loss is not None and step % self.check_interval == 0 and stats.losses[-1] <= target_loss:
+                stats.stop = 'loss'
+                break
+            if self.max_seconds is not None and time.time() - start >= self.max_seconds:
+                stats.stop = 'time'
+                break
+        stats.seconds = time.time() - start
+        self.history.append(stats)
+        print(stats.summary())
+        return stats
+
+    def summary(self):
+        '''
+        @return: totals over all updates so far
+        '''
+        steps = sum(stats.steps for stats in self.history)
+        seconds = sum(stats.seconds for stats in self.history)
+        batches = sum(stats.batches for stats in self.history)
+        mean_loss = np.mean([stats.losses[-1] for stats in self.history if stats.losses]) if steps else float('nan')
+        return (f'{len(self.history)} updates, {steps} gradient steps on {batches} batches in {seconds:.1f}s, '
+                f'{steps / max(batches, 1):.1f} steps per batch, mean final loss {mean_loss:.4f}')
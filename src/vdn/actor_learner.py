@@ -0,0 +1,287 @@
+import copy
+import os
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from eval import evaluate_model
+from opponents import make_opponent_pool
+from team import TeamManager
+from train import make_train_step, run_episode, train
+from utils import reseed, save_model, seed
+
+import sys
+# Thêm thư mục gốc của project vào PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from src.replay.shared import SERIAL, SharedReplayBuffer
+from src.train_step import make_optimizer
+
+# Per-actor statistics in the shared stats array
+EPISODES, BUSY_TIME, SYNC_TIME, ALIVE_TIME = range(4)
+NUM_STATS = 4
+
+
+class WeightBoard:
+    """
+    Latest weights of a model in shared memory, published by the learner and pulled by the actors.
+
+    A version counter tells actors whether the weights changed since their last pull, and its lock
+    keeps actors from loading half-published weights.
+    """
+    def __init__(self, model, ctx):
+        self.weights = {name: tensor.detach().cpu().clone().share_memory_()
+                        for name, tensor in model.state_dict().items()}
+        self.version = ctx.Value('l', 0)
+
+    def publish(self, model):
+        with self.version.get_lock():
+            for name, tensor in model.state_dict().items():
+                self.weights[name].copy_(tensor.detach())
+            self.version.value += 1
+
+    def pull(self, model, version):
+        """
+        Load the published weights into model if they are newer than version
+        :return: the version of the weights model now holds
+        """
+        with self.version.get_lock():
+            if self.version.value != version:
+                model.load_state_dict(self.weights)
+            return self.version.value
+
+
+def _actor(actor_id, env_fn, models, boards, buffers, stats, scores, episode_counter, stop, hp, opponent_pools=None):
+    """
+    Actor process: play self-play episodes for both teams with the latest published weights
+    and stream the transitions into its shard of each team's shared replay buffer.
+    Opponent pools arrive with their fixed opponents in shared memory; the snapshots an actor
+    adds of the opposing learner stay local to that actor.
+    """
+    torch.set_num_threads(1)
+    reseed(seed + 1 + actor_id)
+    parent = os.getppid()
+    env = env_fn()
+    env.reset(seed=seed + 1 + actor_id)
+    # Actors run single-episode inference, their copies stay on CPU instead of opening a CUDA context each
+    models = [model.eval() for model in models]
+    writers = [buffer.writer(actor_id) for buffer in buffers]
+    versions = [-1] * len(models)
+    start = time.time()
+    episodes_played = 0
+    min_epsilon = hp.min_epsilon
+
+    # Also stop if the learner process died without setting the event
+    while not stop.is_set() and os.getppid() == parent:
+        with episode_counter.get_lock():
+            episode_i = episode_counter.value
+            if episode_i >= hp.max_episodes:
+                break
+            episode_counter.value += 1
+
+        if episodes_played % hp.actor_sync_interval == 0:
+            sync_start = time.time()
+            versions = [board.pull(model, version) for board, model, version in zip(boards, models, versions)]
+            stats[actor_id * NUM_STATS + SYNC_TIME] += time.time() - sync_start
+
+        epsilon = max(min_epsilon,
+                      hp.max_epsilon - (hp.max_epsilon - min_epsilon) * (episode_i / (hp.episode_min_epsilon)))
+        busy_start = time.time()
+        opponents = [models[1], models[0]]
+        names = [None, None]
+        if opponent_pools:
+            for team, pool in enumerate(opponent_pools):
+                names[team], opponents[team] = pool.sample(models[1 - team])
+        with torch.no_grad():
+            if hp.record_both_teams and not opponent_pools:
+                # One episode between the two learners writes the transitions of both teams
+                score_team1, score_team2 = run_episode(env, models[0], models[1], writers[0], epsilon=epsilon,
+                                                       opponent_memory=writers[1])
+            else:
+                score_team1 = run_episode(env, models[0], opponents[0], writers[0], epsilon=epsilon)
+                score_team2 = run_episode(env, models[1], opponents[1], writers[1], epsilon=epsilon)
+        if opponent_pools:
+            for team, (pool, score) in enumerate(zip(opponent_pools, (score_team1, score_team2))):
+                pool.record(names[team], score)
+                if (episodes_played + 1) % hp.opponent_snapshot_interval == 0:
+                    pool.snapshot(models[1 - team], f'team{2 - team}-actor{actor_id}-{episode_i}')
+        stats[actor_id * NUM_STATS + BUSY_TIME] += time.time() - busy_start
+        stats[actor_id * NUM_STATS + EPISODES] += 1
+        stats[actor_id * NUM_STATS + ALIVE_TIME] = time.time() - start
+        episodes_played += 1
+        scores.put((episode_i, score_team1, score_team2))
+
+        if score_team1 > 200 or score_team2 > 200:
+            min_epsilon = 0.05
+
+    stats[actor_id * NUM_STATS + ALIVE_TIME] = time.time() - start
+    env.close()
+
+
+class ActorLearnerStats:
+    """Utilization of the learner and the actor processes"""
+    def __init__(self, stats, num_actors, buffers):
+        self.stats = stats
+        self.num_actors = num_actors
+        self.buffers = buffers
+        self.start = time.time()
+        self.learner_busy = 0.0
+        self.grad_steps = 0
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        rows = np.frombuffer(self.stats.get_obj(), dtype=np.float64).reshape(self.num_actors, NUM_STATS)
+        alive = np.maximum(rows[:, ALIVE_TIME], 1e-9)
+        transitions = sum(int(buffer.cursors[:, SERIAL].sum()) for buffer in self.buffers)
+        actors = ' '.join(f'{busy:.0%}' for busy in rows[:, BUSY_TIME] / alive)
+        return (f'learner busy {self.learner_busy / elapsed:.0%}, {self.grad_steps / elapsed:.1f} grad steps/s | '
+                f'actors busy [{actors}], weight sync {rows[:, SYNC_TIME].sum() / alive.sum():.1%}, '
+                f'{int(rows[:, EPISODES].sum())} episodes, {transitions / elapsed:.0f} transitions/s')
+
+
+def run_actor_learner(
+        env_fn,
+        test_env,
+        model_team1,
+        model_team2,
+        target_model_team1,
+        target_model_team2,
+        save_name_team1,
+        save_name_team2,
+        hp,
+        train_fn=train,
+):
+    """
+    Asynchronous version of run_model_train_test.
+
+    hp.num_actors actor processes play self-play episodes (one per team, as in the synchronous loop)
+    with weight snapshots the learner publishes every hp.weight_sync_interval training rounds,
+    pulled every hp.actor_sync_interval episodes. They stream transitions into one shared-memory
+    replay buffer per team, and the learner trains both teams continuously until the actors
+    have played hp.max_episodes episodes.
+
+    :param env_fn: picklable function creating a training environment, e.g. functools.partial(battle_v4.parallel_env, map_size=45)
+    :param test_env: Testing environment
+    :param hp: Hyperparameters
+    :param train_fn: training function
+    :return: train_scores, test_scores and losses of both teams, as run_model_train_test
+    """
+    # The shared replay buffer stores one-step transitions and the actor-learner state is not checkpointed
+    if hp.n_step > 1:
+        raise ValueError('n-step returns (hp.n_step > 1) are not supported by the actor-learner pipeline')
+    if hp.checkpoint_interval > 0:
+        raise ValueError('checkpointing (hp.checkpoint_interval > 0) is not supported by the actor-learner pipeline')
+    reseed(seed)
+    ctx = mp.get_context('spawn')
+    models = [model_team1, model_team2]
+    targets = [target_model_team1, target_model_team2]
+    for model, target in zip(models, targets):
+        target.load_state_dict(model.state_dict())
+
+    env = env_fn()
+    env.reset(seed=seed)
+    team_manager = TeamManager(env.agents)
+    obs_shape = env.observation_space(team_manager.get_my_agents()[0]).shape
+    env.close()
+    buffers = [SharedReplayBuffer(hp.buffer_limit, model.num_agents, obs_shape, num_writers=hp.num_actors)
+               for model in models]
+    boards = [WeightBoard(model, ctx) for model in models]
+    optimizers = [make_optimizer(optim.Adam, model.parameters(), fused=hp.fused_optim, lr=hp.lr) for model in models]
+    engines = [make_train_step(model, target, optimizer, hp.gamma, hp.precision, hp.compile)
+               for model, target, optimizer in zip(models, targets, optimizers)]
+
+    stats = ctx.Array('d', hp.num_actors * NUM_STATS)
+    scores = ctx.Queue()
+    episode_counter = ctx.Value('l', 0)
+    stop = ctx.Event()
+    actor_models = [copy.deepcopy(model).cpu() for model in models]
+    opponent_pools = None
+    if hp.opponent_pool:
+        # Both learners play my_team in their own episodes, so the opponents of both pools play the other team.
+        # They are sent to the actors, so they run on CPU like the actor copies
+        opponent_pools = [make_opponent_pool(hp, team_manager.get_other_team(), model.n_obs, model.n_act,
+                                             device=torch.device('cpu'))
+                          for model in models]
+        for pool in opponent_pools:
+            pool.share_memory()
+    actors = [ctx.Process(target=_actor, daemon=True,
+                          args=(k, env_fn, actor_models, boards, buffers, stats, scores, episode_counter, stop, hp,
+                                opponent_pools))
+              for k in range(hp.num_actors)]
+
+    train_scores = [[], []]
+    losses = [[], []]
+    test_scores = [[], []]
+    utilization = ActorLearnerStats(stats, hp.num_actors, buffers)
+    rounds = 0
+
+    def read_scores():
+        while True:
+            try:
+                episode_i, score_team1, score_team2 = scores.get_nowait()
+            except queue.Empty:
+                return
+            train_scores[0].append(score_team1)
+            train_scores[1].append(score_team2)
+            print(f'Episodes {episode_i + 1} / {hp.max_episodes}: scores {score_team1:.2f} {score_team2:.2f}')
+
+    try:
+        for actor in actors:
+            actor.start()
+
+        while any(actor.is_alive() for actor in actors):
+            read_scores()
+
+            if min(buffer.size() for buffer in buffers) <= hp.warm_up_steps:
+                time.sleep(0.1)
+                continue
+
+            busy_start = time.time()
+            for team, (model, target, buffer, optimizer, engine) in enumerate(
+                    zip(models, targets, buffers, optimizers, engines)):
+                print(f'Training Team {team + 1}:')
+                model.train()
+                losses[team].append(train_fn(model, target, buffer, optimizer, hp.gamma, hp.batch_size,
+                                             hp.update_iter, hp.chunk_size, prefetch=hp.prefetch, engine=engine,
+                                             augment=hp.augment))
+                utilization.grad_steps += hp.update_iter
+            utilization.learner_busy += time.time() - busy_start
+            rounds += 1
+
+            if rounds % hp.weight_sync_interval == 0:
+                for board, model in zip(boards, models):
+                    board.publish(model)
+            if rounds % hp.update_target_interval == 0:
+                for model, target in zip(models, targets):
+                    target.load_state_dict(model.state_dict())
+            print(utilization.summary())
+    finally:
+        stop.set()
+        for actor in actors:
+            actor.join(timeout=60)
+            if actor.is_alive():
+                actor.terminate()
+        print(utilization.summary())
+        for buffer in buffers:
+            buffer.close()
+    # Scores of the last episodes, sent after the previous read
+    read_scores()
+
+    print("Test phase for both teams:")
+    # With record_both_teams, team 2 learns on the opponent side and is evaluated there
+    opponent_sides = (False, hp.record_both_teams and not opponent_pools)
+    for team, (model, opponent) in enumerate(((model_team1, model_team2), (model_team2, model_team1))):
+        model.eval()
+        opponent.eval()
+        with torch.no_grad():
+            score = evaluate_model(test_env, hp.test_episodes, model, opponent, run_episode, opponent_sides[team])
+        test_scores[team].append(score)
+        print(f"Team {team + 1} Avg Test Score: {score:.2f}")
+    save_model(model_team1, f'vdn-{save_name_team1}-async')
+    save_model(model_team2, f'vdn-{save_name_team2}-async')
+    test_env.close()
+
+    return train_scores[0], train_scores[1], test_scores[0], test_scores[1], losses[0], losses[1]
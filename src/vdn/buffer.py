@@ -1,17 +1,204 @@
 import torch
 import numpy as np
-import collections
 from utils import device
 
+import sys
+import os
+# Thêm thư mục gốc của project vào PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from src.replay.codec import PackedObsArray
+from src.replay.dedup import DedupObsArray
+from src.replay.mmap_storage import MmapAllocator
+from src.replay.nstep import n_step_returns
+
 class ReplayBuffer:
-    def __init__(self, buffer_limit):
-        self.buffer = collections.deque(maxlen=buffer_limit)
+    """Ring buffer of team transitions with index-linked next states.
+
+    Each frame is stored once: within an episode next_state[t] is state[t+1], so the next state of
+    the transition in slot i is the frame in slot i+1. When an episode ends, its last next_state is
+    kept in an extra boundary slot that is marked done for every agent and carries no reward,
+    so it contributes nothing to the loss and resets recurrent hidden states.
+
+    With n_step > 1, n-step discounted returns are computed when transitions are written: the last n
+    transitions of the open episode are staged until their horizon is complete (or the episode ends),
+    then their returns, bootstrap discounts and bootstrap offsets are stored next to the rewards.
+    Sampling returns them in place of the rewards, with the bootstrap states as next states.
+    """
+    def __init__(self, buffer_limit, compact_obs=True, allocator=np.zeros, dedup_obs=False, n_step=1, gamma=0.99):
+        """
+        :param buffer_limit: maximum number of transitions
+        :param compact_obs: store observations bit-packed with ObsCodec instead of float32
+        :param allocator: callable (shape, dtype) -> array used for all storage arrays
+        :param dedup_obs: store each distinct packed observation once in a DedupPool (in memory)
+        :param n_step: horizon of the stored returns, 1 to store the rewards only
+        :param gamma: discount factor of the n-step returns
+        """
+        self.capacity = buffer_limit
+        self.compact_obs = compact_obs
+        self.dedup_obs = dedup_obs
+        self.allocator = allocator
+        # One spare slot always holds the next state of the newest transition
+        self.num_slots = buffer_limit + 1
+        self.position = 0   # next slot to write
+        self.count = 0      # number of filled slots
+        self.steps = 0      # number of slots written so far, used by incremental snapshots
+        self.episode_open = False
+        self.n_step = n_step
+        self.gamma = gamma
+        # Slots, rewards and dones of the staged transitions whose n-step return is not complete yet
+        self.staged = []
+        # Storage is allocated on the first put, when n_agents and obs_shape are known
+        self.states = None
+
+    def _allocate(self, num_agents, obs_shape):
+        """Preallocate the ring storage
+        :param num_agents: number of agents per transition
+        :param obs_shape: shape of a single agent observation
+        """
+        if self.dedup_obs:
+            self.states = DedupObsArray((self.num_slots, num_agents), obs_shape)
+        elif self.compact_obs:
+            self.states = PackedObsArray((self.num_slots, num_agents), obs_shape, allocator=self.allocator)
+        else:
+            self.states = self.allocator((self.num_slots, num_agents, *obs_shape), np.float32)
+        self.actions = self.allocator((self.num_slots, num_agents), np.int8)
+        self.rewards = self.allocator((self.num_slots, num_agents), np.float32)
+        self.dones = self.allocator((self.num_slots, num_agents), bool)
+        self.boundary = self.allocator((self.num_slots,), bool)
+        if self.n_step > 1:
+            self.returns = self.allocator((self.num_slots, num_agents), np.float32)
+            self.discounts = self.allocator((self.num_slots, num_agents), np.float32)
+            self.horizons = self.allocator((self.num_slots,), np.int8)
+
+    def _advance(self):
+        self.position = (self.position + 1) % self.num_slots
+        self.count = min(self.count + 1, self.capacity)
+        self.steps += 1
 
     def put(self, transition):
         """Update buffer with a new transition
         :param transition: tuple of (state, action, reward, next_state, done)
         """
-        self.buffer.append(transition)
+        s, a, r, s_prime, done = transition
+        if self.states is None:
+            self._allocate(len(s), np.shape(s[0]))
+
+        # Write in place, overwriting the oldest transition once the buffer is full
+        i = self.position
+        self.states[i] = s
+        self.actions[i] = a
+        self.rewards[i] = r
+        self.dones[i] = done
+        self.boundary[i] = False
+        self._advance()
+        if self.n_step > 1:
+            self.staged.append((i, np.asarray(r, dtype=np.float32), np.asarray(done, dtype=bool)))
+            if len(self.staged) == self.n_step:
+                # The horizon of the oldest staged transition is complete
+                self._write_returns(self.staged[:1], self.staged)
+                self.staged.pop(0)
+
+        # The next state goes into the following slot, where the next put of the episode
+        # writes the same frame as its state, or end_episode() turns it into a boundary slot
+        self.states[self.position] = s_prime
+        self.episode_open = True
+
+    def _write_returns(self, targets, window):
+        """Store the n-step returns of the first len(targets) staged transitions of window
+        :param targets: leading entries of window to store
+        :param window: staged (slot, reward, done) of consecutive transitions of one episode
+        """
+        returns, discounts, horizons = n_step_returns(np.stack([r for _, r, _ in window]),
+                                                      np.stack([d for _, _, d in window]), self.n_step, self.gamma)
+        slots = [i for i, _, _ in targets]
+        self.returns[slots] = returns[:len(slots)]
+        self.discounts[slots] = discounts[:len(slots)]
+        self.horizons[slots] = horizons[:len(slots)]
+
+    def end_episode(self):
+        """Close the current episode, keeping the next state of its last transition"""
+        if not self.episode_open:
+            return
+        if self.staged:
+            # Horizons are cut at the end of the episode, which bootstraps from the boundary slot
+            self._write_returns(self.staged, self.staged)
+            self.staged = []
+        i = self.position
+        self.actions[i] = 0
+        self.rewards[i] = 0
+        self.dones[i] = True
+        self.boundary[i] = True
+        if self.n_step > 1:
+            self.returns[i] = 0
+            self.discounts[i] = 0
+            self.horizons[i] = 1
+        self._advance()
+        self.episode_open = False
+
+    def put_episode(self, frames, actions, rewards, dones):
+        """Add a whole episode at once, same as a put per transition followed by end_episode()
+        :param frames: [T + 1, n_agents, ...obs_shape] states, the last frame is the next state of the last transition
+        :param actions: [T, n_agents]
+        :param rewards: [T, n_agents]
+        :param dones: [T, n_agents]
+        """
+        if self.states is None:
+            self._allocate(frames.shape[1], frames.shape[2:])
+        self.end_episode()
+        if len(actions) >= self.num_slots:
+            # Only the newest transitions fit in the ring
+            keep = self.num_slots - 1
+            frames, actions, rewards, dones = frames[-keep - 1:], actions[-keep:], rewards[-keep:], dones[-keep:]
+
+        length = len(actions)
+        idx = (self.position + np.arange(length + 1)) % self.num_slots
+        self.states[idx] = frames
+        # The last slot is the boundary slot of the episode
+        self.actions[idx] = np.concatenate([actions, np.zeros_like(actions[:1])])
+        self.rewards[idx] = np.concatenate([rewards, np.zeros_like(rewards[:1])])
+        self.dones[idx] = np.concatenate([dones, np.ones_like(dones[:1])])
+        self.boundary[idx] = np.arange(length + 1) == length
+        if self.n_step > 1:
+            returns, discounts, horizons = n_step_returns(rewards, dones, self.n_step, self.gamma)
+            self.returns[idx] = np.concatenate([returns, np.zeros_like(returns[:1])])
+            self.discounts[idx] = np.concatenate([discounts, np.zeros_like(discounts[:1])])
+            self.horizons[idx] = np.concatenate([horizons, [1]])
+        self.position = (self.position + length + 1) % self.num_slots
+        self.count = min(self.count + length + 1, self.capacity)
+        self.steps += length + 1
+
+    def sample_chunk_arrays(self, batch_size, chunk_size):
+        """Sample a batch of chunk_size transitions as numpy arrays, without any device transfer
+        :param batch_size: number of transitions to sample
+        :param chunk_size: length of horizon of each batch
+        :return: tuple of (frames, actions, rewards, dones), their shapes are respectively:
+        [batch_size, chunk_size + 1, n_agents, ...obs_shape] (states are frames[:, :-1], next states frames[:, 1:]),
+        [batch_size, chunk_size, n_agents] (int8),
+        [batch_size, chunk_size, n_agents],
+        [batch_size, chunk_size, n_agents] (bool)
+
+        With n_step > 1 the tuple is (states, actions, returns, next_states, dones, discounts): next_states are
+        the bootstrap states of the n-step returns, discounts [batch_size, chunk_size, n_agents] their discounts
+        """
+        # Staged transitions have no n-step return yet
+        start_idx = np.random.randint(0, self.count - chunk_size - len(self.staged), batch_size)
+        # Chunks are consecutive in insertion order, which starts at the oldest slot
+        oldest = (self.position - self.count) % self.num_slots
+        idx = (oldest + start_idx[:, None] + np.arange(chunk_size + 1)) % self.num_slots  # [batch_size, chunk_size + 1]
+
+        if self.n_step > 1:
+            idx = idx[:, :-1]
+            # One gather of the states and their bootstrap states
+            frames = self.states[np.stack([idx, (idx + self.horizons[idx]) % self.num_slots], axis=1)]
+            return (frames[:, 0], self.actions[idx], self.returns[idx], frames[:, 1], self.dones[idx],
+                    self.discounts[idx])
+
+        # A single fancy-index gather per field (packed observations are decoded in batch).
+        # Frames cover chunk_size + 1 steps, next states are the same frames shifted by one.
+        frames = self.states[idx]
+        idx = idx[:, :-1]
+        return frames, self.actions[idx], self.rewards[idx], self.dones[idx]
 
     def sample_chunk(self, batch_size, chunk_size):
         """Sample a batch of chunk_size transitions from the buffer
@@ -24,34 +211,113 @@ class ReplayBuffer:
         [batch_size, chunk_size, n_agents],
         [batch_size, chunk_size, n_agents, ...obs_shape],
         [batch_size, chunk_size, n_agents]
+        With n_step > 1, rewards are the n-step returns, next_states the bootstrap states, and the
+        [batch_size, chunk_size, n_agents] bootstrap discounts are appended
         """
-        start_idx = np.random.randint(0, len(self.buffer) - chunk_size, batch_size)
-        s_lst, a_lst, r_lst, s_prime_lst, done_lst = [], [], [], [], []
-
-        for idx in start_idx:
-            for chunk_step in range(idx, idx + chunk_size):
-                # (state, action, reward, next_state, done) * num_agent
-                s, a, r, s_prime, done = self.buffer[chunk_step]
-                s_lst.append(s)
-                a_lst.append(a)
-                r_lst.append(r)
-                s_prime_lst.append(s_prime)
-                done_lst.append(done)
-        num_agents = len(s_lst[0])
-        obs_shape = s_lst[0][0].shape
-
-        s_lst = np.array(s_lst).reshape(batch_size, chunk_size, num_agents, *obs_shape)
-        a_lst = np.array(a_lst).reshape(batch_size, chunk_size, num_agents)
-        r_lst = np.array(r_lst).reshape(batch_size, chunk_size, num_agents)
-        s_prime_lst = np.array(s_prime_lst).reshape(batch_size, chunk_size, num_agents, *obs_shape)
-        done_lst = np.array(done_lst, dtype=bool).reshape(batch_size, chunk_size, num_agents)
+        if self.n_step > 1:
+            batch = self.sample_chunk_arrays(batch_size, chunk_size)
+            states, actions, returns, next_states, dones, discounts = (torch.from_numpy(x).to(device) for x in batch)
+            return states, actions.float(), returns, next_states, dones.float(), discounts
+        frames, actions, rewards, dones = self.sample_chunk_arrays(batch_size, chunk_size)
+        # Wrapped without copying
+        frames = torch.from_numpy(frames).to(device)
         return (
-            torch.tensor(s_lst, dtype=torch.float32).to(device),
-            torch.tensor(a_lst, dtype=torch.float32).to(device),
-            torch.tensor(r_lst, dtype=torch.float32).to(device),
-            torch.tensor(s_prime_lst, dtype=torch.float32).to(device),
-            torch.tensor(done_lst, dtype=torch.float32).to(device)
+            frames[:, :-1],
+            torch.from_numpy(actions).to(device).float(),
+            torch.from_numpy(rewards).to(device),
+            frames[:, 1:],
+            torch.from_numpy(dones).to(device).float()
         )
 
     def size(self):
-        return len(self.buffer)
\ No newline at end of file
+        return self.count
+
+    def _slot_fields(self):
+        fields = ('actions', 'rewards', 'dones', 'boundary')
+        return fields + ('returns', 'discounts', 'horizons') if self.n_step > 1 else fields
+
+    def read_slots(self, start, end):
+        """
+        Copy the storage of slots [start, end), with observations kept encoded
+        :return: dict of arrays, see src.replay.snapshot
+        """
+        arrays = {name: np.array(getattr(self, name)[start:end]) for name in self._slot_fields()}
+        if isinstance(self.states, DedupObsArray):
+            arrays['state_bits'], arrays['state_hp'] = self.states.encoded(slice(start, end))
+        elif isinstance(self.states, PackedObsArray):
+            arrays['state_bits'] = np.array(self.states.bits[start:end])
+            arrays['state_hp'] = np.array(self.states.hp[start:end])
+        else:
+            arrays['states'] = np.array(self.states[start:end])
+        return arrays
+
+    def write_slots(self, start, arrays):
+        """Write arrays returned by read_slots back into the slots starting at start"""
+        key = slice(start, start + len(arrays['actions']))
+        for name in self._slot_fields():
+            getattr(self, name)[key] = arrays[name]
+        if isinstance(self.states, DedupObsArray):
+            self.states.set_encoded(key, arrays['state_bits'], arrays['state_hp'])
+        elif isinstance(self.states, PackedObsArray):
+            self.states.bits[key] = arrays['state_bits']
+            self.states.hp[key] = arrays['state_hp']
+        else:
+            self.states[key] = arrays['states']
+
+    def dedup_summary(self):
+        """Live dedup statistics of the observation store, None without dedup_obs"""
+        if not isinstance(self.states, DedupObsArray):
+            return None
+        return self.states.pool.summary()
+
+    def state_dict(self):
+        """Cursors and storage layout of the buffer, see src.replay.snapshot"""
+        state = {'position': self.position, 'count': self.count, 'steps': self.steps,
+                 'episode_open': self.episode_open,
+                 'staged': [(i, r.tolist(), d.tolist()) for i, r, d in self.staged]}
+        if self.states is not None:
+            state['num_agents'] = self.actions.shape[1]
+            state['obs_shape'] = list(self.states.shape[2:])
+        return state
+
+    def load_state_dict(self, state):
+        if 'num_agents' in state and self.states is None:
+            self._allocate(state['num_agents'], tuple(state['obs_shape']))
+        self.position = state['position']
+        self.count = state['count']
+        self.steps = state['steps']
+        self.episode_open = state['episode_open']
+        self.staged = [(i, np.array(r, dtype=np.float32), np.array(d, dtype=bool)) for i, r, d in state.get('staged', [])]
+
+
+class MmapReplayBuffer(ReplayBuffer):
+    """ReplayBuffer whose storage lives in memory-mapped segment files on local disk.
+
+    Capacity is bounded by disk space instead of RAM: sampling only reads the gathered slots,
+    and the OS page cache keeps the recently used segments in memory.
+    """
+    def __init__(self, buffer_limit, directory, segment_slots=4096, compact_obs=True, n_step=1, gamma=0.99):
+        """
+        :param buffer_limit: maximum number of transitions
+        :param directory: directory for the segment files, previous segment files are removed
+        :param segment_slots: number of slots per segment file
+        :param compact_obs: store observations bit-packed with ObsCodec instead of float32
+        :param n_step, gamma: n-step returns, see ReplayBuffer
+        """
+        allocator = MmapAllocator(directory, segment_slots)
+        allocator.clear()
+        super().__init__(buffer_limit, compact_obs=compact_obs, allocator=allocator, n_step=n_step, gamma=gamma)
+
+    def flush(self):
+        self.allocator.flush()
+
+
+def make_replay_buffer(hp, name):
+    """Create the replay buffer selected by hp.buffer_backend
+    :param hp: VdnHyperparameters
+    :param name: name of the buffer, used for its on-disk directory
+    :return: ReplayBuffer
+    """
+    if hp.buffer_backend == 'mmap':
+        return MmapReplayBuffer(hp.buffer_limit, os.path.join(hp.buffer_dir, name), n_step=hp.n_step, gamma=hp.gamma)
+    return ReplayBuffer(hp.buffer_limit, dedup_obs=hp.dedup_obs, n_step=hp.n_step, gamma=hp.gamma)
@@ -1,14 +1,20 @@
-def evaluate_model(env, num_episodes, model, run_episode_fn):
+def evaluate_model(env, num_episodes, model, opponent_model, run_episode_fn, opponent_side=False):
     """
 
     :param env: Environment
     :param num_episodes: How many episodes to test
     :param model: Trained model
+    :param opponent_model: model playing the other team
     :param run_episode_fn: function to run an episode
+    :param opponent_side: evaluate model on the opponent side of the episodes, the side a team trained with
+        hp.record_both_teams learns on
     :return: average score over num_episodes
     """
     model.eval()
     score = 0
     for _ in range(num_episodes):
-        score += run_episode_fn(env, model, epsilon=0)
-    return score / num_episodes
\ No newline at end of file
+        if opponent_side:
+            score += run_episode_fn(env, opponent_model, model, epsilon=0, return_opponent_score=True)[1]
+        else:
+            score += run_episode_fn(env, model, opponent_model, epsilon=0)
+    return score / num_episodes
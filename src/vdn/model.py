@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from utils import compute_output_dim, device
+from utils import compute_output_dim
 
 class VdnQNet(nn.Module):
     def __init__(self, agents, observation_spaces, action_spaces, recurrent=False):
@@ -36,20 +36,30 @@ class VdnQNet(nn.Module):
             self.gru =  nn.GRUCell(self.hx_size, self.hx_size)  # shape: hx_size, hx_size
         self.q_val = nn.Linear(self.hx_size, self.n_act)    # shape: hx_size, n_actions
 
+    @property
+    def device(self):
+        """Device of the weights, inputs are moved there (the first convolution is never quantized)"""
+        return self.feature_cnn[0].weight.device
+
+    def features(self, obs):
+        """CNN features of a batch of observations
+        :param obs: [...batch dims, ...n_obs]
+        :return: features: [...batch dims, hx_size]
+        """
+        obs = obs.to(self.device)
+        batch_dims, (height, width, channels) = obs.shape[:-3], obs.shape[-3:]
+        obs = obs.reshape(-1, height, width, channels).permute(0, 3, 1, 2)  # (batch, channels, height, width)
+        return self.feature_cnn(obs).view(*batch_dims, self.hx_size)
+
     def forward(self, obs, hidden):
         """Predict q values for each agent's actions in the batch
         :param obs: [batch_size, num_agents, ...n_obs]
         :param hidden: [batch_size, num_agents, hx_size]
         :return: q_values: [batch_size, num_agents, n_actions], hidden: [batch_size, num_agents, hx_size]
         """
-        obs = obs.to(device)
-        hidden = hidden.to(device)
-        
-        batch_size, num_agents, height, width, channels = obs.shape
-        obs = obs.permute(0, 1, 4, 2, 3)  # (batch_size, num_agents, channels, height, width)
-        obs = obs.reshape(batch_size * num_agents, channels, height, width)  # (batch_size * num_agents, channels, height, width)
-        
-        x = self.feature_cnn(obs)  # (batch_size * num_agents, hx_size)
+        hidden = hidden.to(self.device)
+        batch_size, num_agents = obs.shape[:2]
+        x = self.features(obs).view(batch_size * num_agents, -1)  # (batch_size * num_agents, hx_size)
         
         if self.recurrent:
             hidden = hidden.reshape(batch_size * num_agents, -1)  # (batch_size * num_agents, hx_size)
@@ -66,6 +76,29 @@ class VdnQNet(nn.Module):
         
         return q_values, next_hidden
 
+    def forward_sequence(self, obs, hidden, dones=None):
+        """Predict q values for a chunk of consecutive steps: the CNN features of all steps are computed
+        in one batched call and only the GRU cell is rolled over the steps
+        :param obs: [batch_size, chunk_size, num_agents, ...n_obs]
+        :param hidden: [batch_size, num_agents, hx_size], hidden state before the first step
+        :param dones: [batch_size, chunk_size, num_agents], the hidden state of an agent is reset after a step it is done at
+        :return: q_values: [batch_size, chunk_size, num_agents, n_actions], hidden: [batch_size, num_agents, hx_size]
+        """
+        hidden = hidden.to(self.device)
+        x = self.features(obs)  # (batch_size, chunk_size, num_agents, hx_size)
+        if self.recurrent:
+            batch_size, chunk_size, num_agents = x.shape[:3]
+            keep = None if dones is None else (1 - dones.to(self.device).float()).unsqueeze(-1)
+            outputs = []
+            for step_i in range(chunk_size):
+                hidden = self.gru(x[:, step_i].reshape(batch_size * num_agents, -1),
+                                  hidden.reshape(batch_size * num_agents, -1)).view(batch_size, num_agents, -1)
+                outputs.append(hidden)
+                if keep is not None:
+                    hidden = hidden * keep[:, step_i]  # (batch_size, num_agents, hx_size)
+            x = torch.stack(outputs, dim=1)
+        return self.q_val(x), hidden
+
     def sample_action(self, obs, hidden, epsilon=1e3):
         """Choose action with epsilon-greedy policy, for each agent in the batch
         :param obs: a batch of observations, [batch_size, num_agents, n_obs]
@@ -73,16 +106,16 @@ class VdnQNet(nn.Module):
         :param epsilon: exploration rate
         :return: actions: [batch_size, num_agents], hidden: [batch_size, num_agents, hx_size]
         """
-        obs = obs.to(device)
-        hidden = hidden.to(device)
+        obs = obs.to(self.device)
+        hidden = hidden.to(self.device)
         
         q_values, hidden = self.forward(obs, hidden)    # [batch_size, num_agents, n_actions], [batch_size, num_agents, hx_size]
         # epsilon-greedy action selection: choose random action with epsilon probability
-        mask = (torch.rand((q_values.shape[0],), device=device) <= epsilon)  # [batch_size]
-        actions = torch.empty((q_values.shape[0], q_values.shape[1]), device=device)  # [batch_size, num_agents]
-        actions[mask] = torch.randint(0, q_values.shape[2], actions[mask].shape, device=device).float()
+        mask = (torch.rand((q_values.shape[0],), device=self.device) <= epsilon)  # [batch_size]
+        actions = torch.empty((q_values.shape[0], q_values.shape[1]), device=self.device)  # [batch_size, num_agents]
+        actions[mask] = torch.randint(0, q_values.shape[2], actions[mask].shape, device=self.device).float()
         actions[~mask] = q_values[~mask].argmax(dim=2).float()  # choose action with max q value
         return actions, hidden   # [batch_size, num_agents], [batch_size, num_agents, hx_size]
 
     def init_hidden(self, batch_size=1):
-        return torch.zeros((batch_size, self.num_agents, self.hx_size), device=device)
\ No newline at end of file
+        return torch.zeros((batch_size, self.num_agents, self.hx_size), device=self.device)
\ No newline at end of file
@@ -0,0 +1,251 @@
+import copy
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils import device
+
+import sys
+# Thêm thư mục gốc của project vào PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+from src.torch_model import QNetwork
+from src.final_torch_model import QNetwork as FinalQNetwork
+from src.rule_based.model import RuleBasedAgent
+
+
+def freeze(model, quantize=False, compile=False, device=device):
+    """Make an inference-only copy of a model
+    :param quantize: quantize the linear layers to int8 (dynamic quantization, CPU only)
+    :param compile: compile the forward pass with torch.compile (not picklable, so in-process only)
+    :param device: device the copy runs on
+    :return: frozen copy of the model
+    """
+    model = copy.deepcopy(model).eval()
+    model.requires_grad_(False)
+    if quantize:
+        if torch.device(device).type != 'cpu':
+            print('Opponent quantization is only supported on CPU, keeping float weights')
+        else:
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if compile:
+        model.forward = torch.compile(model.forward)
+    return model
+
+
+class FrozenVdnOpponent:
+    """Frozen snapshot of a VdnQNet, used as a fixed self-play opponent"""
+    def __init__(self, model, quantize=False, compile=False):
+        self.model = freeze(model, quantize, compile, model.device)
+
+    def sample_action(self, obs, hidden, epsilon=0):
+        """Greedy actions, the exploration rate of the learner does not apply to frozen opponents
+        :param obs: [batch_size, num_agents, ...n_obs]
+        :param hidden: [batch_size, num_agents, hx_size]
+        :return: actions: [batch_size, num_agents], hidden: [batch_size, num_agents, hx_size]
+        """
+        with torch.inference_mode():
+            return self.model.sample_action(obs, hidden, epsilon=0)
+
+    def share_memory(self):
+        self.model.share_memory()
+
+
+class PretrainedOpponent:
+    """Per-agent pretrained QNetwork (red.pt, red_final.pt) acting for a whole team"""
+    def __init__(self, network, quantize=False, compile=False, device=device):
+        self.device = device
+        self.network = freeze(network, quantize, compile, device).to(device)
+
+    def sample_action(self, obs, hidden, epsilon=0):
+        """Greedy actions of the network for every agent, see FrozenVdnOpponent.sample_action"""
+        batch_size, num_agents = obs.shape[:2]
+        with torch.inference_mode():
+            obs = obs.to(self.device).reshape(batch_size * num_agents, *obs.shape[2:]).permute(0, 3, 1, 2)
+            actions = self.network(obs).argmax(dim=-1)
+        return actions.view(batch_size, num_agents).float(), hidden
+
+    def share_memory(self):
+        self.network.share_memory()
+
+
+class RuleBasedOpponent:
+    """RuleBasedAgent acting for a whole team
+
+    The rules of RuleBasedAgent are applied to all agents at once with tensor operations on their views,
+    instead of one RuleBasedAgent decision per agent, so a step costs a few small tensor ops whatever the
+    number of agents. Only the random draws of the rules differ in order from RuleBasedAgent.get_action.
+    """
+    def __init__(self, team):
+        self.agent = RuleBasedAgent(my_team=team)
+        self.center = self.agent._get_agent_position().long()
+        # Actions of the rules for every clamped move offset in [-2, 2]^2 and every attack offset in [-1, 1]^2
+        self.move_table = self._table(2, attack=False)
+        self.attack_table = self._table(1, attack=True)
+
+    def _table(self, radius, attack):
+        offsets = torch.arange(-radius, radius + 1)
+        origin = torch.zeros(2)
+        return torch.tensor([[self.agent._direction_to_action(origin, torch.stack([dy, dx]).float(), attack=attack)
+                              for dx in offsets] for dy in offsets])
+
+    def _actions(self, views):
+        """
+        :param views: [n, height, width, channels] observations of n agents
+        :return: actions: [n] (long)
+        """
+        n, height, width = views.shape[:3]
+        allies = views[..., 1] > 0
+        enemies = views[..., 3] > 0
+        allies[:, self.center[0], self.center[1]] = False  # the agent itself
+        dy = (torch.arange(height) - self.center[0]).view(height, 1).expand(height, width).reshape(-1)
+        dx = (torch.arange(width) - self.center[1]).view(1, width).expand(height, width).reshape(-1)
+        distances = torch.sqrt((dy ** 2 + dx ** 2).float())
+        allies, enemies = allies.reshape(n, -1), enemies.reshape(n, -1)
+        inf = torch.tensor(float('inf'))
+
+        # Closest enemy and ally, the first one in row-major order on ties, as RuleBasedAgent
+        closest_enemy = torch.where(enemies, distances, inf).argmin(dim=1)
+        closest_ally = torch.where(allies, distances, inf).argmin(dim=1)
+        num_enemies, num_allies = enemies.sum(dim=1), allies.sum(dim=1)
+        # Outnumbered agents regroup with their closest ally, the others go for the closest enemy
+        regroup = (num_enemies > num_allies) & (num_allies > 0)
+        target = torch.where(regroup, closest_ally, closest_enemy)
+        move = self.move_table[dy[target].clamp(-2, 2) + 2, dx[target].clamp(-2, 2) + 2]
+        attack = self.attack_table[dy[closest_enemy].clamp(-1, 1) + 1, dx[closest_enemy].clamp(-1, 1) + 1]
+        actions = torch.where(distances[closest_enemy] < 2, attack, move)
+
+        # Without enemies in view: half of the time towards the farthest ally on the team's side, otherwise
+        # a random 2-cell move
+        side = dx < 0 if self.agent.my_team == 'blue' else dx > 0
+        side_allies = allies & side
+        farthest_ally = torch.where(side_allies, distances, -inf).argmax(dim=1)
+        to_ally = self.move_table[dy[farthest_ally].clamp(-2, 2) + 2, dx[farthest_ally].clamp(-2, 2) + 2]
+        random_move = torch.randint(0, 4, (n,)) * 4
+        follow = side_allies.any(dim=1) & (torch.rand(n) < 0.5)
+        wander = torch.where(follow, to_ally, random_move)
+        return torch.where(num_enemies > 0, actions, wander)
+
+    def sample_action(self, obs, hidden, epsilon=0):
+        """Rule-based actions for every agent, see FrozenVdnOpponent.sample_action"""
+        batch_size, num_agents = obs.shape[:2]
+        actions = self._actions(obs.cpu().reshape(batch_size * num_agents, *obs.shape[2:]))
+        return actions.view(batch_size, num_agents).float().to(hidden.device), hidden
+
+    def share_memory(self):
+        pass
+
+
+class OpponentPool:
+    """League of opponents for one learning team
+
+    Holds fixed opponents (pretrained networks, the rule-based agent) and frozen snapshots of the
+    opposing learner taken every snapshot_interval episodes, all cached as inference-only models.
+    sample() picks the opponent of the next episode according to the schedule:
+    - 'latest': always the current opposing model, i.e. plain self-play
+    - 'uniform': uniformly over the current opposing model and the pool
+    - 'mixed': the current opposing model with probability latest_prob, otherwise uniformly over the pool
+    - 'pfsp': prioritized fictitious self-play, opponents against which the team scores lower are sampled more
+    """
+    SCHEDULES = ('latest', 'uniform', 'mixed', 'pfsp')
+
+    def __init__(self, schedule='mixed', latest_prob=0.5, max_snapshots=10, quantize=False, compile=False):
+        """
+        :param schedule: one of OpponentPool.SCHEDULES
+        :param latest_prob: probability of the current opposing model with the 'mixed' schedule
+        :param max_snapshots: number of frozen snapshots kept, the oldest ones are evicted first
+        :param quantize: quantize frozen network opponents to int8 (CPU only)
+        :param compile: compile frozen network opponents with torch.compile
+        """
+        assert schedule in self.SCHEDULES, f'Unknown opponent schedule [{schedule}].'
+        self.schedule = schedule
+        self.latest_prob = latest_prob
+        self.max_snapshots = max_snapshots
+        self.quantize = quantize
+        self.compile = compile
+        self.opponents = {}  # name -> opponent
+        self.snapshots = []  # names of evictable snapshots, oldest first
+        self.scores = {}     # name -> [sum of scores, number of episodes]
+
+    def add(self, name, opponent):
+        self.opponents[name] = opponent
+        self.scores.setdefault(name, [0.0, 0])
+
+    def snapshot(self, model, name):
+        """Add a frozen copy of the opposing learner"""
+        self.add(name, FrozenVdnOpponent(model, self.quantize, self.compile))
+        self.snapshots.append(name)
+        while len(self.snapshots) > self.max_snapshots:
+            evicted = self.snapshots.pop(0)
+            del self.opponents[evicted]
+            del self.scores[evicted]
+
+    def sample(self, current):
+        """Choose the opponent of the next episode
+        :param current: current opposing model
+        :return: (name, opponent), name is None for the current model
+        """
+        if self.schedule == 'latest' or not self.opponents:
+            return None, current
+        names = list(self.opponents)
+        if self.schedule == 'mixed':
+            if np.random.rand() < self.latest_prob:
+                return None, current
+            name = names[np.random.randint(len(names))]
+        elif self.schedule == 'uniform':
+            k = np.random.randint(len(names) + 1)
+            if k == len(names):
+                return None, current
+            name = names[k]
+        else:
+            # Weight by how hard each opponent is: mean score of the team, unseen opponents first
+            means = np.array([total / count if count else -np.inf for total, count in
+                              (self.scores[name] for name in names)])
+            if np.isinf(means).any():
+                name = names[int(np.flatnonzero(np.isinf(means))[0])]
+            else:
+                weights = means.max() - means + 1e-3
+                name = names[np.random.choice(len(names), p=weights / weights.sum())]
+        return name, self.opponents[name]
+
+    def record(self, name, score):
+        """Record the score of an episode of the learning team against opponent name"""
+        if name in self.scores:
+            self.scores[name][0] += score
+            self.scores[name][1] += 1
+
+    def share_memory(self):
+        """Move the weights of frozen network opponents to shared memory, so actor processes
+        receive them without copies"""
+        if not (self.quantize or self.compile):
+            for opponent in self.opponents.values():
+                opponent.share_memory()
+
+    def summary(self):
+        return ', '.join(f'{name}: {total / max(count, 1):.1f} ({count})'
+                         for name, (total, count) in self.scores.items())
+
+
+def make_opponent_pool(hp, team, observation_shape, n_actions, device=device):
+    """Create the opponent pool of a learning team with the fixed opponents of hp
+    :param hp: Hyperparameters
+    :param team: team name of the opponents, used by the rule-based agent
+    :param observation_shape: shape of an agent observation
+    :param n_actions: number of actions of an agent
+    :param device: device the pretrained network opponents run on
+    :return: OpponentPool
+    """
+    pool = OpponentPool(hp.opponent_schedule, hp.opponent_latest_prob, hp.opponent_max_snapshots,
+                        hp.opponent_quantize, hp.opponent_compile)
+    for file_name, network_cls in (('red.pt', QNetwork), ('red_final.pt', FinalQNetwork)):
+        path = os.path.join(hp.opponent_weights_dir, file_name)
+        if os.path.exists(path):
+            network = network_cls(observation_shape, n_actions)
+            network.load_state_dict(torch.load(path, weights_only=True, map_location='cpu'))
+            pool.add(file_name, PretrainedOpponent(network, hp.opponent_quantize, hp.opponent_compile, device))
+        else:
+            print(f'Opponent weights {path} not found, skipping')
+    if hp.opponent_rule_based:
+        pool.add('rule_based', RuleBasedOpponent(team))
+    return pool
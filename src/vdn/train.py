@@ -4,86 +4,141 @@ import time
 import torch.optim as optim
 import torch.nn.functional as F
 
-from torch.amp import GradScaler, autocast
-
-from buffer import ReplayBuffer
+from buffer import make_replay_buffer
 from team import TeamManager
 from utils import reseed, save_model, device, seed
 from eval import evaluate_model
+from opponents import make_opponent_pool
 
 import sys
 import os
 # Thêm thư mục gốc của project vào PYTHONPATH
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
-def train(q, q_target, memory, optimizer, gamma, batch_size, update_iter=10, chunk_size=10, grad_clip_norm=5):
+from src.replay.prefetch import BatchPrefetcher
+from src.replay.snapshot import RingSnapshotter
+from src.replay.augment import augment_batch
+from src.td_targets import td0_targets
+from src.train_step import TrainStep, make_optimizer
+from src.checkpoint import Checkpointer
+
+def vdn_loss(q, q_target, gamma, states, actions, rewards, next_states, dones, discounts=None):
+    """Loss of a batch of chunks: sum over the chunk of the per-step smooth L1 losses of the team Q values
+    :param states, next_states: [batch_size, chunk_size, num_agents, ...n_obs]
+    :param actions, rewards, dones: [batch_size, chunk_size, num_agents]
+    :param discounts: [batch_size, chunk_size, num_agents] bootstrap discounts of n-step returns stored in the
+        replay buffer (rewards are then the returns and next_states the bootstrap states), None for one-step targets
+    :return: scalar loss
+    """
+    batch_size = states.shape[0]
+    hidden = q.init_hidden(batch_size)
+    target_hidden = q_target.init_hidden(batch_size)
+
+    # Hidden states of terminated agents are reset after their last step
+    q_out, _ = q.forward_sequence(states, hidden, dones)  # [batch_size, chunk_size, num_agents, n_actions]
+    q_a = q_out.gather(3, actions.unsqueeze(-1).long()).squeeze(-1)  # [batch_size, chunk_size, num_agents]: q values of actions taken
+    sum_q = (q_a * (1 - dones)).sum(dim=2)  # [batch_size, chunk_size]
+
+    with torch.no_grad():
+        max_q_prime, _ = q_target.forward_sequence(next_states, target_hidden, dones)
+        max_q_prime = max_q_prime.max(dim=3)[0]  # [batch_size, chunk_size, num_agents]
+        if discounts is None:
+            target_q = td0_targets(rewards, max_q_prime, 1 - dones, gamma).sum(dim=2)  # [batch_size, chunk_size]
+        else:
+            # Returns precomputed at insertion time, only the bootstrap is left
+            target_q = (rewards + discounts * max_q_prime).sum(dim=2)
+
+    return F.smooth_l1_loss(sum_q, target_q.detach(), reduction='none').mean(dim=0).sum()
+
+def make_train_step(q, q_target, optimizer, gamma, precision='auto', compile=False, grad_clip_norm=5):
+    """Training step engine of a VDN learner, kept across train calls so its state (gradient scaler,
+    compiled graph) persists
+    :param precision: autocast precision, 'auto' is fp16 on CUDA and bf16 on CPU
+    :param compile: compile the forward pass and loss with torch.compile
+    :return: TrainStep taking (states, actions, rewards, next_states, dones[, discounts])
+    """
+    return TrainStep(lambda *batch: vdn_loss(q, q_target, gamma, *batch), optimizer,
+                     precision=precision, compile=compile, grad_clip_norm=grad_clip_norm)
+
+def train(q, q_target, memory, optimizer, gamma, batch_size, update_iter=10, chunk_size=10, grad_clip_norm=5, prefetch=2,
+          engine=None, augment=False):
+    """
+    :param prefetch: number of batches sampled ahead on a background thread, 0 to sample synchronously
+    :param engine: TrainStep of the learner from make_train_step, a new one with the default precision if None
+        (gamma and grad_clip_norm then come from the engine)
+    :param augment: transform every sampled chunk by a random symmetry of the map, see src/replay/augment.py
+    """
     q.train()
     q_target.eval()
     chunk_size = chunk_size if q.recurrent else 1
     losses = []
 
-    scaler = GradScaler()
+    if engine is None:
+        engine = make_train_step(q, q_target, optimizer, gamma, grad_clip_norm=grad_clip_norm)
+
+    n_step = getattr(memory, 'n_step', 1)
+
+    def sample():
+        batch = memory.sample_chunk_arrays(batch_size, chunk_size)
+        if augment:
+            # With n-step returns, states and bootstrap states are separate arrays
+            batch = augment_batch(batch, frames=(0, 3) if n_step > 1 else (0,), actions=(1,))
+        return batch
+
+    prefetcher = None
+    if prefetch > 0:
+        prefetcher = BatchPrefetcher(sample, num_batches=update_iter, depth=prefetch, device=device)
     
     for i in range(update_iter):
         # Get data from buffer
-        states, actions, rewards, next_states, dones = memory.sample_chunk(batch_size, chunk_size)
-
-        hidden = q.init_hidden(batch_size).to(device)
-        target_hidden = q_target.init_hidden(batch_size).to(device)
-        
-        loss = 0
-        for step_i in range(chunk_size):
-            with autocast(device_type=device.type):
-                q_out, hidden = q(states[:, step_i].to(device), hidden)  # [batch_size, num_agents, n_actions]
-                q_out = q_out.to(device)
-                hidden = hidden.to(device)
-                q_a = q_out.gather(2, actions[:, step_i, :].unsqueeze(-1).long().to(device)).squeeze(-1)  # [batch_size, num_agents]: q values of actions taken
-                sum_q = (q_a * (1 - dones[:, step_i].to(device))).sum(dim=1, keepdims=True)  # [batch_size, 1]
-    
-                with torch.no_grad():
-                    max_q_prime, target_hidden = q_target(next_states[:, step_i].to(device), target_hidden.detach())
-                    target_hidden = target_hidden.to(device)
-                    max_q_prime = max_q_prime.max(dim=2)[0].squeeze(-1)  # [batch_size, num_agents]
-                    target_q = rewards[:, step_i, :].to(device).sum(dim=1, keepdims=True)  # [batch_size, 1]
-                    target_q += gamma * ((1 - dones[:, step_i].to(device)) * max_q_prime.to(device)).sum(dim=1, keepdims=True)
-            
-                loss += F.smooth_l1_loss(sum_q, target_q.detach())
-            
-                # Create a mask for each agent separately
-                done_mask = dones[:, step_i].to(device).bool()  # Shape: (batch_size, num_agents)
-                
-                # Lấy chỉ số batch và agent nơi done_mask == 1
-                batch_indices, agent_indices = torch.where(done_mask)
-                
-                # Số lượng agents đã kết thúc
-                num_terminated = len(batch_indices)
-                
-                if num_terminated > 0:  # Chỉ xử lý nếu có agent nào bị kết thúc
-                    # Khởi tạo hidden states mới cho tất cả các agents bị kết thúc
-                    new_hidden = q.init_hidden(batch_size=num_terminated).to(device)  # Shape: (num_terminated, num_agents, hx_size)
-                    new_target_hidden = q_target.init_hidden(batch_size=num_terminated).to(device)  # Same shape
-                
-                    # Lấy hidden states tương ứng với từng agent
-                    new_hidden_agents = new_hidden[range(num_terminated), agent_indices, :]  # Shape: (num_terminated, hx_size)
-                    new_target_hidden_agents = new_target_hidden[range(num_terminated), agent_indices, :]  # Same shape
-                
-                    # Gán các hidden states mới vào các vị trí tương ứng trong tensor `hidden` và `target_hidden`
-                    hidden[batch_indices, agent_indices, :] = new_hidden_agents
-                    target_hidden[batch_indices, agent_indices, :] = new_target_hidden_agents
-
-        losses.append(loss.item())
-        optimizer.zero_grad()
-        scaler.scale(loss).backward()
-        torch.nn.utils.clip_grad_norm_(q.parameters(), grad_clip_norm, norm_type=2)
-        scaler.step(optimizer)
-        scaler.update()
-
+        if prefetcher is not None:
+            batch = prefetcher.get()
+        else:
+            batch = tuple(torch.from_numpy(x) for x in sample())
+        if n_step > 1:
+            states, actions, returns, next_states, dones, discounts = batch
+            batch = states, actions.float(), returns, next_states, dones.float(), discounts
+        else:
+            frames, actions, rewards, dones = batch
+            batch = frames[:, :-1], actions.float(), rewards, frames[:, 1:], dones.float()
+
+        losses.append(engine(*(x.to(device) for x in batch)))
+
+    if prefetcher is not None:
+        prefetcher.close()
+        print(prefetcher.summary())
     print('Loss: ' + " ".join([str(round(loss, 2)) for loss in losses]))
     return losses
 
-def run_episode(env, q, opponent_q, memory=None, random_rate=0, epsilon=0.1):
+def _team_transition(team_manager, team, team_observations, agent_actions, agent_rewards, observations, agent_dones,
+                     zeros):
+    """Transition of a team for its replay buffer, with zero observations and actions for terminated agents
+    :return: tuple of (state, action, reward, next_state, done)
+    """
+    agents = team_manager.get_team_agents(team)
+    next_observations = [
+        observations[agent] if agent in observations and observations[agent] is not None else zeros
+        for agent in agents
+    ]
+    team_actions = [
+        agent_actions[agent] if agent in agent_actions and agent_actions[agent] is not None else 0
+        for agent in agents
+    ]
+    return (
+        list(team_observations.values()),
+        team_actions,
+        list(team_manager.get_info_of_team(team, agent_rewards, 0).values()),
+        next_observations,
+        list(team_manager.get_info_of_team(team, agent_dones).values())
+    )
+
+def run_episode(env, q, opponent_q, memory=None, random_rate=0, epsilon=0.1, opponent_memory=None,
+                return_opponent_score=False):
     """Run an episode in self-play mode
-    :return: total score of the episode
+    :param opponent_memory: replay buffer of the opponent team: the transitions of both teams are recorded
+        from the same episode, each into its own buffer
+    :param return_opponent_score: also return the score of the opponent team
+    :return: total score of the episode, (score, opponent score) with opponent_memory or return_opponent_score
     """
     observations, infos = env.reset()
     team_manager = TeamManager(env.agents)
@@ -94,6 +149,8 @@ def run_episode(env, q, opponent_q, memory=None, random_rate=0, epsilon=0.1):
     hidden = q.init_hidden()
     opponent_hidden = q.init_hidden()
     score = 0.0
+    opponent_score = 0.0
+    zeros = np.zeros(q.n_obs, dtype=np.float32)
 
     while not team_manager.has_terminated_teams():
         # Fill rows with zeros for terminated agents
@@ -136,31 +193,14 @@ def run_episode(env, q, opponent_q, memory=None, random_rate=0, epsilon=0.1):
         # Step the environment
         observations, agent_rewards, agent_terminations, agent_truncations, agent_infos = env.step(agent_actions)
         score += sum(team_manager.get_info_of_team(my_team, agent_rewards, 0).values())
+        opponent_score += sum(team_manager.get_info_of_team(opponent_team, agent_rewards, 0).values())
 
-        if memory is not None:
-            # Fill rows with zeros for terminated agents
-            next_observations = [
-                observations[agent]
-                if agent in observations and observations[agent] is not None
-                else np.zeros(q.n_obs, dtype=np.float32)
-                for agent in team_manager.get_my_agents()
-            ]
-            my_team_actions = [
-                agent_actions[agent]
-                if agent in agent_actions and agent_actions[agent] is not None
-                else 0
-                for agent in team_manager.get_my_agents()
-            ]
-
-            memory.put((
-                list(my_team_observations.values()),
-                my_team_actions,
-                list(team_manager.get_info_of_team(my_team, agent_rewards, 0).values()),
-                next_observations,
-                list(team_manager.get_info_of_team(
-                    my_team,
-                    TeamManager.merge_terminates_truncates(agent_terminations, agent_truncations)).values())
-            ))
+        agent_dones = TeamManager.merge_terminates_truncates(agent_terminations, agent_truncations)
+        for team, team_memory, team_observations in ((my_team, memory, my_team_observations),
+                                                     (opponent_team, opponent_memory, opponent_observations)):
+            if team_memory is not None:
+                team_memory.put(_team_transition(team_manager, team, team_observations, agent_actions, agent_rewards,
+                                                 observations, agent_dones, zeros))
 
         # Check for termination
         for agent, done in agent_terminations.items():
@@ -174,9 +214,109 @@ def run_episode(env, q, opponent_q, memory=None, random_rate=0, epsilon=0.1):
         if len(team_manager.get_other_team_remains()) <= 3:
             break
 
+    for team_memory in (memory, opponent_memory):
+        if team_memory is not None:
+            team_memory.end_episode()
+
     print('Score:', score)
+    if opponent_memory is not None or return_opponent_score:
+        return score, opponent_score
     return score
 
+def _team_array(data, agents, zeros):
+    """Stack the entries of agents in data into one array, zeros for missing or None entries"""
+    return np.stack([data[agent] if data.get(agent) is not None else zeros for agent in agents])
+
+def run_episodes(envs, q, opponent_q, memory=None, epsilon=0.1, opponent_memory=None):
+    """Run one self-play episode in each of K environments, stepping them together
+
+    The observations of all running environments go through one sample_action call per team.
+    Episodes end independently: finished environments stop stepping while the others continue.
+    Transitions are staged per environment and written with memory.put_episode when its episode ends,
+    so every episode stays contiguous in the replay buffer.
+    :param envs: list of K parallel environments
+    :param opponent_memory: replay buffer of the opponent team, recorded from the same episodes as memory
+    :return: list of the K episode scores, (scores, opponent scores) with opponent_memory
+    """
+    num_envs = len(envs)
+    observations = [env.reset()[0] for env in envs]
+    team_managers = [TeamManager(env.agents) for env in envs]
+    my_team = team_managers[0].get_my_team()
+    opponent_team = team_managers[0].get_other_team()
+    my_agents = team_managers[0].get_team_agents(my_team)
+    opponent_agents = team_managers[0].get_team_agents(opponent_team)
+    zeros = np.zeros(q.n_obs, dtype=np.float32)
+
+    hidden = q.init_hidden(num_envs)
+    opponent_hidden = q.init_hidden(num_envs)
+    scores = [0.0] * num_envs
+    opponent_scores = [0.0] * num_envs
+    # Recorded teams: agents, replay buffer and staged episode of every environment (states, actions, rewards, dones)
+    recorded = [(agents, team_memory, [([], [], [], []) for _ in range(num_envs)])
+                for agents, team_memory in ((my_agents, memory), (opponent_agents, opponent_memory))
+                if team_memory is not None]
+    running = [not team_manager.has_terminated_teams() for team_manager in team_managers]
+
+    while any(running):
+        active = [k for k in range(num_envs) if running[k]]
+        index = torch.tensor(active)
+        # Fill rows with zeros for terminated agents
+        for k in active:
+            for agent in team_managers[k].agents:
+                if observations[k].get(agent) is None:
+                    observations[k][agent] = zeros
+                    team_managers[k].terminate_agent(agent)
+
+        # One batched action selection per team: [K_active, num_agents, ...n_obs]
+        my_obs = np.stack([_team_array(observations[k], my_agents, zeros) for k in active])
+        opponent_obs = np.stack([_team_array(observations[k], opponent_agents, zeros) for k in active])
+        actions, hidden[index] = q.sample_action(torch.from_numpy(my_obs), hidden[index], epsilon)
+        opponent_actions, opponent_hidden[index] = opponent_q.sample_action(
+            torch.from_numpy(opponent_obs), opponent_hidden[index], epsilon)
+        actions = actions.long().cpu().numpy()
+        opponent_actions = opponent_actions.long().cpu().numpy()
+
+        for row, k in enumerate(active):
+            team_manager = team_managers[k]
+            agent_actions = {**dict(zip(my_agents, actions[row].tolist())),
+                             **dict(zip(opponent_agents, opponent_actions[row].tolist()))}
+            # Terminated agents use None action
+            for agent in team_manager.terminated_agents:
+                agent_actions[agent] = None
+
+            next_observations, agent_rewards, agent_terminations, agent_truncations, _ = envs[k].step(agent_actions)
+            scores[k] += sum(agent_rewards.get(agent, 0) for agent in my_agents)
+            opponent_scores[k] += sum(agent_rewards.get(agent, 0) for agent in opponent_agents)
+
+            for agents, _, episodes in recorded:
+                states, episode_actions, episode_rewards, episode_dones = episodes[k]
+                states.append(my_obs[row] if agents is my_agents else opponent_obs[row])
+                episode_actions.append([agent_actions.get(agent) or 0 for agent in agents])
+                episode_rewards.append([agent_rewards.get(agent, 0) for agent in agents])
+                episode_dones.append([bool(agent_terminations.get(agent) or agent_truncations.get(agent))
+                                      for agent in agents])
+
+            # Check for termination
+            for agent in my_agents + opponent_agents:
+                if agent_terminations.get(agent) or agent_truncations.get(agent):
+                    team_manager.terminate_agent(agent)
+            observations[k] = next_observations
+
+            # Stop if a team is terminated or the other team has less than 3 agents
+            if team_manager.has_terminated_teams() or len(team_manager.get_other_team_remains()) <= 3:
+                running[k] = False
+                for agents, team_memory, episodes in recorded:
+                    states, episode_actions, episode_rewards, episode_dones = episodes[k]
+                    if states:
+                        frames = np.stack(states + [_team_array(next_observations, agents, zeros)])
+                        team_memory.put_episode(frames, np.array(episode_actions),
+                                                np.array(episode_rewards, dtype=np.float32), np.array(episode_dones))
+                print('Score:', scores[k])
+
+    if opponent_memory is not None:
+        return scores, opponent_scores
+    return scores
+
 def run_model_train_test(
         env,
         test_env,
@@ -191,6 +331,8 @@ def run_model_train_test(
         train_fn,
         run_episode_fn,
         num_test_runs=1,
+        vector_envs=None,
+        report=None,
 ):
     """
     Run training and testing loop of a model
@@ -204,12 +346,32 @@ def run_model_train_test(
     :param hp: Hyperparameters
     :param train_fn: training function
     :param run_episode_fn: function to run an episode
+    :param vector_envs: list of K training environments to collect K episodes per team at once with run_episodes,
+        instead of one episode in env with run_episode_fn
+    :param report: optional callback report(episode, score) of the training score of team 1, see src/sweep.py
     :return: train_scores, test_scores
+
+    With hp.checkpoint_interval > 0 the full training state (models, target models, optimizers, training steps,
+    replay buffers, random generators, scores and losses) is checkpointed every hp.checkpoint_interval episodes
+    under hp.checkpoint_dir, and the run resumes from the latest checkpoint there.
     """
     reseed(seed)
     # create env.
-    memory_team1 = ReplayBuffer(hp.buffer_limit)
-    memory_team2 = ReplayBuffer(hp.buffer_limit)
+    memory_team1 = make_replay_buffer(hp, save_name_team1)
+    memory_team2 = make_replay_buffer(hp, save_name_team2)
+
+    snapshotters = []
+    if hp.checkpoint_interval > 0:
+        # The replay buffers are snapshotted with every checkpoint and restored with it
+        for memory, name in ((memory_team1, save_name_team1), (memory_team2, save_name_team2)):
+            snapshotters.append(RingSnapshotter(memory, os.path.join(hp.checkpoint_dir, 'replay', name)))
+    elif hp.snapshot_interval > 0:
+        # Resume from the replay snapshots of an interrupted run, if any
+        for memory, name in ((memory_team1, save_name_team1), (memory_team2, save_name_team2)):
+            snapshotter = RingSnapshotter(memory, os.path.join(hp.snapshot_dir, name))
+            if snapshotter.restore():
+                print(f'Restored {memory.size()} transitions of {name} from {snapshotter.directory}')
+            snapshotters.append(snapshotter)
 
     test_env.reset(seed=seed)
     env.reset(seed=seed)
@@ -223,14 +385,45 @@ def run_model_train_test(
     test_scores_team1, test_scores_team2 = [], []
     losses_team1, losses_team2 = [], []
 
-    optimizer_team1 = optim.Adam(model_team1.parameters(), lr=hp.lr)
-    optimizer_team2 = optim.Adam(model_team2.parameters(), lr=hp.lr)
+    optimizer_team1 = make_optimizer(optim.Adam, model_team1.parameters(), fused=hp.fused_optim, lr=hp.lr)
+    optimizer_team2 = make_optimizer(optim.Adam, model_team2.parameters(), fused=hp.fused_optim, lr=hp.lr)
+    engine_team1 = make_train_step(model_team1, target_model_team1, optimizer_team1, hp.gamma, hp.precision, hp.compile)
+    engine_team2 = make_train_step(model_team2, target_model_team2, optimizer_team2, hp.gamma, hp.precision, hp.compile)
+
+    opponent_pools = None
+    if hp.opponent_pool:
+        # Both learners play my_team in their own episodes, so the opponents of both pools play the other team
+        opponent_pools = (
+            make_opponent_pool(hp, team_manager.get_other_team(), model_team1.n_obs, model_team1.n_act),
+            make_opponent_pool(hp, team_manager.get_other_team(), model_team2.n_obs, model_team2.n_act),
+        )
+
+    checkpointer, start_episode = None, 0
+    if hp.checkpoint_interval > 0:
+        checkpointer = Checkpointer(hp.checkpoint_dir, keep_last=hp.keep_checkpoints, snapshotters=snapshotters)
+        state = checkpointer.restore(map_location=device)
+        if state is not None:
+            for module, key in ((model_team1, 'model_team1'), (model_team2, 'model_team2'),
+                                (target_model_team1, 'target_model_team1'), (target_model_team2, 'target_model_team2'),
+                                (optimizer_team1, 'optimizer_team1'), (optimizer_team2, 'optimizer_team2'),
+                                (engine_team1, 'engine_team1'), (engine_team2, 'engine_team2')):
+                module.load_state_dict(state[key])
+            hp.min_epsilon = state['min_epsilon']
+            train_scores_team1, train_scores_team2 = state['train_scores']
+            test_scores_team1, test_scores_team2 = state['test_scores']
+            losses_team1, losses_team2 = state['losses']
+            start_episode = state['episode'] + 1
+            print(f'Resumed from {checkpointer.latest()} at episode {start_episode + 1}')
 
     # Train and test
     start_train = time.time()
-    for episode_i in range(hp.max_episodes):
+    for episode_i in range(start_episode, hp.max_episodes):
         start = time.time()
         print(f'Episodes {episode_i + 1} / {hp.max_episodes}')
+        if checkpointer is not None:
+            # Episodes do not depend on the environment state before them, so a resumed run replays them exactly
+            for k, train_env in enumerate(vector_envs or [env]):
+                train_env.reset(seed=seed + episode_i * len(vector_envs or [env]) + k)
         # Collect data
         epsilon = max(hp.min_epsilon,
                       hp.max_epsilon - (hp.max_epsilon - hp.min_epsilon) * (episode_i / (hp.episode_min_epsilon)))
@@ -238,22 +431,57 @@ def run_model_train_test(
         model_team1.eval()
         model_team2.eval()
         
-        train_score_team1 = run_episode_fn(env, model_team1, model_team2, memory_team1, epsilon=epsilon)
-        train_score_team2 = run_episode_fn(env, model_team2, model_team1, memory_team2, epsilon=epsilon)
+        opponent_team1, opponent_team2 = model_team2, model_team1
+        if opponent_pools:
+            opponent_name_team1, opponent_team1 = opponent_pools[0].sample(model_team2)
+            opponent_name_team2, opponent_team2 = opponent_pools[1].sample(model_team1)
+            print(f'Opponents: {opponent_name_team1 or "current"} / {opponent_name_team2 or "current"}')
+
+        if hp.record_both_teams and not opponent_pools:
+            # One episode between the two learners fills both replay buffers, team 2 playing the other side
+            if vector_envs:
+                scores_team1, scores_team2 = run_episodes(vector_envs, model_team1, model_team2, memory_team1,
+                                                          epsilon=epsilon, opponent_memory=memory_team2)
+                train_score_team1, train_score_team2 = np.mean(scores_team1), np.mean(scores_team2)
+            else:
+                train_score_team1, train_score_team2 = run_episode_fn(env, model_team1, model_team2, memory_team1,
+                                                                      epsilon=epsilon, opponent_memory=memory_team2)
+        elif vector_envs:
+            train_score_team1 = np.mean(run_episodes(vector_envs, model_team1, opponent_team1, memory_team1, epsilon=epsilon))
+            train_score_team2 = np.mean(run_episodes(vector_envs, model_team2, opponent_team2, memory_team2, epsilon=epsilon))
+        else:
+            train_score_team1 = run_episode_fn(env, model_team1, opponent_team1, memory_team1, epsilon=epsilon)
+            train_score_team2 = run_episode_fn(env, model_team2, opponent_team2, memory_team2, epsilon=epsilon)
+
+        if opponent_pools:
+            opponent_pools[0].record(opponent_name_team1, train_score_team1)
+            opponent_pools[1].record(opponent_name_team2, train_score_team2)
+            if (episode_i + 1) % hp.opponent_snapshot_interval == 0:
+                opponent_pools[0].snapshot(model_team2, f'{save_name_team2}-{episode_i}')
+                opponent_pools[1].snapshot(model_team1, f'{save_name_team1}-{episode_i}')
+                print(f'Opponent pool team 1: {opponent_pools[0].summary()}')
+                print(f'Opponent pool team 2: {opponent_pools[1].summary()}')
 
         train_scores_team1.append(train_score_team1)
         train_scores_team2.append(train_score_team2)
+        if report is not None:
+            report(episode_i, train_score_team1)
 
         if train_score_team1 > 200 or train_score_team2 > 200:
             hp.min_epsilon = 0.05
 
+        if hp.dedup_obs:
+            print(f'Replay team 1: {memory_team1.dedup_summary()}')
+            print(f'Replay team 2: {memory_team2.dedup_summary()}')
+
         # Train models
         if memory_team1.size() > hp.warm_up_steps:
             print("Training Team 1:")
             model_team1.train()
             episode_losses_team1 = train_fn(
                 model_team1, target_model_team1, memory_team1, optimizer_team1,
-                hp.gamma, hp.batch_size, hp.update_iter, hp.chunk_size
+                hp.gamma, hp.batch_size, hp.update_iter, hp.chunk_size, prefetch=hp.prefetch, engine=engine_team1,
+                augment=hp.augment
             )
             losses_team1.append(episode_losses_team1)
 
@@ -262,10 +490,15 @@ def run_model_train_test(
             model_team2.train()
             episode_losses_team2 = train_fn(
                 model_team2, target_model_team2, memory_team2, optimizer_team2,
-                hp.gamma, hp.batch_size, hp.update_iter, hp.chunk_size
+                hp.gamma, hp.batch_size, hp.update_iter, hp.chunk_size, prefetch=hp.prefetch, engine=engine_team2,
+                augment=hp.augment
             )
             losses_team2.append(episode_losses_team2)
 
+        if checkpointer is None and snapshotters and (episode_i + 1) % hp.snapshot_interval == 0:
+            for snapshotter in snapshotters:
+                snapshotter.snapshot()
+
         if episode_i % hp.update_target_interval == 0 and episode_i > 0:
             target_model_team1.load_state_dict(model_team1.state_dict())
             target_model_team2.load_state_dict(model_team2.state_dict())
@@ -279,9 +512,11 @@ def run_model_train_test(
             avg_test_score_team1 = 0
             avg_test_score_team2 = 0
 
+            # With record_both_teams, team 2 learns on the opponent side and is evaluated there
             for _ in range(num_test_runs):
                 avg_test_score_team1 += evaluate_model(test_env, hp.test_episodes, model_team1, model_team2, run_episode_fn)
-                avg_test_score_team2 += evaluate_model(test_env, hp.test_episodes, model_team2, model_team1,  run_episode_fn)
+                avg_test_score_team2 += evaluate_model(test_env, hp.test_episodes, model_team2, model_team1, run_episode_fn,
+                                                       opponent_side=hp.record_both_teams and not opponent_pools)
 
             avg_test_score_team1 /= num_test_runs
             avg_test_score_team2 /= num_test_runs
@@ -290,16 +525,36 @@ def run_model_train_test(
             test_scores_team2.append(avg_test_score_team2)
 
             save_model(model_team1, f'vdn-{save_name_team1}-{episode_i}')
-            save_model(model_team1, f'vdn-{save_name_team2}-{episode_i}')
+            save_model(model_team2, f'vdn-{save_name_team2}-{episode_i}')
 
             print(f"Team 1 Avg Test Score: {avg_test_score_team1:.2f}")
             print(f"Team 2 Avg Test Score: {avg_test_score_team2:.2f}")
             print('#' * 90)
 
+        if checkpointer is not None and (episode_i + 1) % hp.checkpoint_interval == 0:
+            checkpointer.save(episode_i, {
+                'model_team1': model_team1.state_dict(), 'model_team2': model_team2.state_dict(),
+                'target_model_team1': target_model_team1.state_dict(), 'target_model_team2': target_model_team2.state_dict(),
+                'optimizer_team1': optimizer_team1.state_dict(), 'optimizer_team2': optimizer_team2.state_dict(),
+                'engine_team1': engine_team1.state_dict(), 'engine_team2': engine_team2.state_dict(),
+                'min_epsilon': hp.min_epsilon,
+                'train_scores': (train_scores_team1, train_scores_team2),
+                'test_scores': (test_scores_team1, test_scores_team2),
+                'losses': (losses_team1, losses_team2),
+                'episode': episode_i,
+            })
+
         print(f'Time: {time.time() - start}')
         print(f'Total Time: {time.time() - start_train}')
         print('-' * 90)
 
+    if checkpointer is not None:
+        checkpointer.wait()
+    else:
+        for snapshotter in snapshotters:
+            snapshotter.snapshot(block=True)
+            snapshotter.wait()
+
     env.close()
     test_env.close()
 
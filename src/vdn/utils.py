@@ -1,3 +1,4 @@
+import os
 import torch
 import numpy as np
 import random
@@ -23,9 +24,38 @@ class VdnHyperparameters:
     warm_up_steps: int = 3000
     chunk_size: int = 1
     recurrent: bool = False
+    buffer_backend: str = 'memory'  # 'memory' or 'mmap'
+    buffer_dir: str = 'replay'
+    dedup_obs: bool = False  # store each distinct observation once (memory backend)
+    n_step: int = 1  # horizon of the returns stored in the replay buffer, 1 for one-step targets
+    augment: bool = False  # random map symmetries of the sampled chunks, see src/replay/augment.py
+    prefetch: int = 2  # batches sampled ahead on a background thread, 0 to disable
+    snapshot_interval: int = 0  # episodes between incremental replay snapshots, 0 to disable
+    snapshot_dir: str = 'replay_snapshot'
+    num_actors: int = 2  # actor processes of actor_learner.run_actor_learner
+    weight_sync_interval: int = 1  # learner training rounds between weight publications to the actors
+    actor_sync_interval: int = 1  # episodes between actor weight pulls
+    record_both_teams: bool = False  # one self-play episode per iteration records the transitions of both teams
+    opponent_pool: bool = False  # sample self-play opponents from an OpponentPool, see opponents.py
+    opponent_schedule: str = 'mixed'  # 'latest', 'uniform', 'mixed' or 'pfsp'
+    opponent_latest_prob: float = 0.5  # probability of the current opponent with the 'mixed' schedule
+    opponent_snapshot_interval: int = 20  # episodes between frozen snapshots of the opposing learner
+    opponent_max_snapshots: int = 10
+    opponent_weights_dir: str = '../../weight_models'  # directory of red.pt and red_final.pt
+    opponent_rule_based: bool = True
+    opponent_quantize: bool = False  # int8 frozen network opponents (CPU only)
+    opponent_compile: bool = False
+    precision: str = 'auto'  # autocast precision of the training step: 'fp32', 'bf16', 'fp16' or 'auto' (fp16 on CUDA, bf16 on CPU)
+    compile: bool = False  # compile the training forward pass with torch.compile
+    fused_optim: bool = False  # fused (or foreach) Adam
+    checkpoint_interval: int = 0  # episodes between full-state checkpoints (src/checkpoint.py), 0 to disable
+    checkpoint_dir: str = 'checkpoints'  # the run resumes from the latest checkpoint in it, if any
+    keep_checkpoints: int = 3
 
 def save_model(model, name):
-    torch.save(model.state_dict(), f'{name}.pth')
+    # Write under a temporary name first, an interrupted save never leaves a truncated model behind
+    torch.save(model.state_dict(), f'{name}.pth.tmp')
+    os.replace(f'{name}.pth.tmp', f'{name}.pth')
 
 def save_data(data, name='data'):
     np.save(f'{name}.npy', data)